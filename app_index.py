@@ -0,0 +1,168 @@
+# Copyright (c) 2018 Foundries.io Limited.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+'''Index of the Zephyr applications in a source tree.
+
+An application is a directory with both a CMakeLists.txt and a
+prj.conf. Finding them means walking the whole tree, which is slow in
+a large checkout, so the results are cached in a JSON file along with
+each directory's modification time. Adding, removing or renaming a
+file changes its directory's modification time, so on the next lookup
+only directories whose times changed are listed again; the rest just
+get a stat().
+
+Directories matching an ignore pattern aren't searched. Patterns are
+fnmatch-style, matched against both a directory's name and its path
+relative to the top of the tree. Besides DEFAULT_IGNORE, patterns are
+read from IGNORE_FILE at the top of the tree, one per line ('#' starts
+a comment).'''
+
+import fnmatch
+import json
+import os
+
+# Name of the index file, at the top of the tree.
+INDEX_FILE = '.zmp-app-index.json'
+
+# Name of the optional ignore pattern file, at the top of the tree.
+IGNORE_FILE = '.zmpignore'
+
+# Not searched by default: hidden directories (like .repo and .git),
+# the Zephyr and MCUboot trees (whose samples and tests aren't
+# microPlatform applications), and build output.
+DEFAULT_IGNORE = ['.*', 'zephyr', 'mcuboot', 'outdir', 'build']
+
+# Bump this if the index format changes.
+FORMAT_VERSION = 1
+
+_APP_FILES = ('CMakeLists.txt', 'prj.conf')
+
+
+def _read_ignore_file(top):
+    path = os.path.join(top, IGNORE_FILE)
+    if not os.path.isfile(path):
+        return []
+    with open(path, 'r') as f:
+        lines = [line.split('#', 1)[0].strip() for line in f]
+    return [line.rstrip('/') for line in lines if line]
+
+
+class AppIndex:
+    '''The applications under a directory.
+
+    extra_ignore is a list of patterns to ignore besides DEFAULT_IGNORE
+    and those in IGNORE_FILE.'''
+
+    def __init__(self, top, extra_ignore=()):
+        self.top = os.path.abspath(top)
+        self.ignore = (DEFAULT_IGNORE + _read_ignore_file(self.top) +
+                       list(extra_ignore))
+        self.index_path = os.path.join(self.top, INDEX_FILE)
+
+    def _ignored(self, rel, name):
+        return any(fnmatch.fnmatchcase(name, pattern) or
+                   fnmatch.fnmatchcase(rel, pattern)
+                   for pattern in self.ignore)
+
+    def _load(self):
+        try:
+            with open(self.index_path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if data.get('version') != FORMAT_VERSION or \
+           data.get('ignore') != self.ignore:
+            return {}
+        return data.get('dirs', {})
+
+    def _save(self, dirs):
+        data = {'version': FORMAT_VERSION, 'ignore': self.ignore,
+                'dirs': dirs}
+        tmp = '{}.{}'.format(self.index_path, os.getpid())
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(data, f, separators=(',', ':'), sort_keys=True)
+            os.replace(tmp, self.index_path)
+        except OSError:
+            # The index is only a cache; a read-only tree still works.
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def _scan(self, rel, path, mtime):
+        # Returns the directory's index entry: its modification time
+        # (from before listing it, so changes while listing aren't
+        # missed next time), whether it's an app, and the
+        # subdirectories to search.
+        subdirs = []
+        names = set()
+        with os.scandir(path) as it:
+            for entry in it:
+                names.add(entry.name)
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.name)
+        is_app = all(name in names for name in _APP_FILES)
+        # Don't look inside apps or build directories.
+        if is_app or 'CMakeCache.txt' in names:
+            subdirs = []
+        subdirs = sorted(
+            d for d in subdirs
+            if not self._ignored(os.path.join(rel, d) if rel else d, d))
+        return {'mtime': mtime, 'app': is_app, 'subdirs': subdirs}
+
+    def apps(self):
+        '''Get the relative paths of all applications, sorted.
+
+        This refreshes the cached index as needed.'''
+        old = self._load()
+        new = {}
+        ret = []
+        changed = False
+        stack = ['']
+        while stack:
+            rel = stack.pop()
+            path = os.path.join(self.top, rel) if rel else self.top
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except FileNotFoundError:
+                changed = True
+                continue
+            entry = old.get(rel)
+            if entry is None or entry['mtime'] != mtime:
+                try:
+                    entry = self._scan(rel, path, mtime)
+                except OSError:
+                    changed = True
+                    continue
+                changed = True
+            new[rel] = entry
+            if entry['app']:
+                ret.append(rel)
+            stack.extend(os.path.join(rel, d) if rel else d
+                         for d in entry['subdirs'])
+
+        if changed or set(new) != set(old):
+            self._save(new)
+        return sorted(ret)
+
+    def select(self, patterns):
+        '''Get the applications matching any of the patterns.
+
+        Patterns are fnmatch-style ('*' also matches '/'); a pattern
+        without wildcards is used as is, even if it isn't indexed.
+        Raises ValueError if a pattern with wildcards matches nothing.'''
+        apps = None
+        ret = []
+        for pattern in patterns:
+            pattern = pattern.rstrip(os.path.sep)
+            if not any(c in pattern for c in '*?['):
+                matches = [pattern]
+            else:
+                if apps is None:
+                    apps = self.apps()
+                matches = fnmatch.filter(apps, pattern)
+                if not matches:
+                    raise ValueError('no applications match {}'.format(
+                        pattern))
+            ret.extend(m for m in matches if m not in ret)
+        return ret
@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2018 Foundries.io Limited.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+'''Shared cache of build outputs.
+
+Cache entries are gzipped tarballs of the final artifacts from a build
+directory, keyed by a fingerprint of everything that went into the
+build. Two backends are provided:
+
+- DirectoryCache: a directory, possibly on a shared file system
+- HTTPCache: a server which answers GET and PUT for <url>/<key>.tar.gz
+
+This file can also be run as a script to serve a directory over
+HTTP for HTTPCache clients:
+
+    python3 artifact_cache.py serve /path/to/cache --port 8080'''
+
+import abc
+import argparse
+import hashlib
+import http.server
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import urllib.error
+import urllib.request
+
+# Suffix for cache entry files.
+ENTRY_SUFFIX = '.tar.gz'
+
+# Bump this if the entry format or what goes into keys changes.
+FORMAT_VERSION = '1'
+
+
+#
+# Fingerprinting
+#
+
+class Fingerprint:
+    '''Accumulates inputs into a cache key.
+
+    Each input is tagged with a name, so e.g. a file's contents and
+    an option with the same bytes don't collide.'''
+
+    def __init__(self):
+        self._sha = hashlib.sha256()
+        self.add('format', FORMAT_VERSION)
+
+    def add(self, name, value):
+        if isinstance(value, str):
+            value = value.encode('utf-8')
+        self._sha.update(name.encode('utf-8') + b'\0')
+        self._sha.update(str(len(value)).encode('utf-8') + b'\0')
+        self._sha.update(value)
+
+    def add_file(self, name, path):
+        '''Add a file's contents; a missing file counts as an input too.'''
+        if os.path.isfile(path):
+            self.add(name, file_digest(path))
+        else:
+            self.add(name, '<missing>')
+
+    def add_tree(self, name, path):
+        '''Add a source tree; see tree_fingerprint().'''
+        self.add(name, tree_fingerprint(path))
+
+    def hexdigest(self):
+        return self._sha.hexdigest()
+
+
+def file_digest(path):
+    '''Get the SHA-256 hex digest of a file's contents.'''
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _git(path, *args):
+    return subprocess.check_output(['git', '-C', path] + list(args),
+                                   stderr=subprocess.DEVNULL)
+
+
+def tree_fingerprint(path):
+    '''Get a fingerprint of the sources in a directory.
+
+    If the directory is inside a Git repository, this is derived from
+    the directory's tree in the HEAD commit and any changes to files
+    under it, including untracked ones, so it's cheap even for large
+    trees.
+    Otherwise, every file under the directory is hashed.'''
+    path = os.path.abspath(path)
+    sha = hashlib.sha256()
+    try:
+        sha.update(_git(path, 'rev-parse', 'HEAD:./'))
+        sha.update(_git(path, 'diff', 'HEAD', '--binary', '--', '.'))
+        untracked = _git(path, 'ls-files', '-z', '--others',
+                         '--exclude-standard', '--', '.')
+    except (OSError, subprocess.CalledProcessError):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                file_path = os.path.join(root, name)
+                sha.update(os.path.relpath(file_path, path).encode('utf-8'))
+                sha.update(file_digest(file_path).encode('utf-8'))
+        return sha.hexdigest()
+
+    for rel in sorted(p for p in untracked.split(b'\0') if p):
+        file_path = os.path.join(path, rel.decode('utf-8'))
+        sha.update(rel)
+        if os.path.isfile(file_path):
+            sha.update(file_digest(file_path).encode('utf-8'))
+    return sha.hexdigest()
+
+
+#
+# Backends
+#
+
+class CacheBackend(abc.ABC):
+    '''Storage for cache entries.'''
+
+    @abc.abstractmethod
+    def get(self, key, path):
+        '''Download the entry for key into the file at path.
+
+        Returns True if the entry exists, and False otherwise.'''
+
+    @abc.abstractmethod
+    def put(self, key, path):
+        '''Upload the file at path as the entry for key.'''
+
+
+class DirectoryCache(CacheBackend):
+    '''Cache entries stored as files in a (shared) directory.'''
+
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+
+    def entry_path(self, key):
+        return os.path.join(self.directory, key[:2], key + ENTRY_SUFFIX)
+
+    def get(self, key, path):
+        try:
+            shutil.copyfile(self.entry_path(key), path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def put(self, key, path):
+        entry = self.entry_path(key)
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        # Other runners may be reading or writing the same entry, so
+        # only ever rename complete files into place.
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(entry),
+                                   suffix='.tmp')
+        os.close(fd)
+        try:
+            shutil.copyfile(path, tmp)
+            os.replace(tmp, entry)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def __repr__(self):
+        return 'DirectoryCache({!r})'.format(self.directory)
+
+
+class HTTPCache(CacheBackend):
+    '''Cache entries stored on an HTTP server.
+
+    The entry for key is at <url>/<key>.tar.gz. It is fetched with GET
+    (404 means there is no entry) and stored with PUT.'''
+
+    def __init__(self, url, timeout=60):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def entry_url(self, key):
+        return '{}/{}{}'.format(self.url, key, ENTRY_SUFFIX)
+
+    def get(self, key, path):
+        try:
+            with urllib.request.urlopen(self.entry_url(key),
+                                        timeout=self.timeout) as response:
+                with open(path, 'wb') as f:
+                    shutil.copyfileobj(response, f)
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                return False
+            raise
+        return True
+
+    def put(self, key, path):
+        with open(path, 'rb') as f:
+            request = urllib.request.Request(
+                self.entry_url(key), data=f, method='PUT',
+                headers={'Content-Length': str(os.path.getsize(path)),
+                         'Content-Type': 'application/gzip'})
+            with urllib.request.urlopen(request, timeout=self.timeout):
+                pass
+
+    def __repr__(self):
+        return 'HTTPCache({!r})'.format(self.url)
+
+
+def backend_for(spec):
+    '''Get a CacheBackend from a URL or directory path.'''
+    if spec.startswith(('http://', 'https://')):
+        return HTTPCache(spec)
+    if spec.startswith('file://'):
+        spec = spec[len('file://'):]
+    return DirectoryCache(spec)
+
+
+#
+# Entries
+#
+
+def fetch(backend, key, outdir):
+    '''Fetch the entry for key, extracting it into outdir.
+
+    Returns the list of files extracted, relative to outdir, or None
+    if there is no entry for key.'''
+    with tempfile.TemporaryDirectory() as tmpdir:
+        archive = os.path.join(tmpdir, key + ENTRY_SUFFIX)
+        if not backend.get(key, archive):
+            return None
+        with tarfile.open(archive, 'r:gz') as tar:
+            members = tar.getmembers()
+            for member in members:
+                if (not member.isfile() or os.path.isabs(member.name) or
+                        os.pardir in member.name.split('/')):
+                    raise tarfile.TarError('bad member {} in cache entry {}'.
+                                           format(member.name, key))
+            os.makedirs(outdir, exist_ok=True)
+            tar.extractall(outdir, members=members)
+        return [m.name for m in members]
+
+
+def store(backend, key, outdir, files):
+    '''Store files (paths relative to outdir) as the entry for key.'''
+    with tempfile.TemporaryDirectory() as tmpdir:
+        archive = os.path.join(tmpdir, key + ENTRY_SUFFIX)
+        with tarfile.open(archive, 'w:gz') as tar:
+            for rel in files:
+                tar.add(os.path.join(outdir, rel), arcname=rel,
+                        recursive=False)
+        backend.put(key, archive)
+
+
+#
+# Test/stand-in server
+#
+
+class CacheRequestHandler(http.server.BaseHTTPRequestHandler):
+    '''Serves HTTPCache requests from the server's directory.'''
+
+    def entry_path(self):
+        name = os.path.basename(self.path.rstrip('/'))
+        if not name.endswith(ENTRY_SUFFIX) or name.startswith('.'):
+            return None
+        return os.path.join(self.server.directory, name)
+
+    def do_GET(self):
+        path = self.entry_path()
+        if path is None or not os.path.isfile(path):
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/gzip')
+        self.send_header('Content-Length', str(os.path.getsize(path)))
+        self.end_headers()
+        with open(path, 'rb') as f:
+            shutil.copyfileobj(f, self.wfile)
+
+    def do_PUT(self):
+        path = self.entry_path()
+        if path is None:
+            self.send_error(400)
+            return
+        remaining = int(self.headers['Content-Length'])
+        fd, tmp = tempfile.mkstemp(dir=self.server.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            while remaining:
+                chunk = self.rfile.read(min(remaining, 1 << 16))
+                if not chunk:
+                    break
+                f.write(chunk)
+                remaining -= len(chunk)
+        if remaining:
+            os.unlink(tmp)
+            self.send_error(400)
+            return
+        os.replace(tmp, path)
+        self.send_response(201)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+def serve(directory, host='', port=8080):
+    '''Serve a cache directory over HTTP until interrupted.'''
+    os.makedirs(directory, exist_ok=True)
+    server = http.server.HTTPServer((host, port), CacheRequestHandler)
+    server.directory = os.path.abspath(directory)
+    print('Serving {} on port {}'.format(server.directory,
+                                         server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ZMP build cache server')
+    subparsers = parser.add_subparsers(dest='cmd')
+    serve_parser = subparsers.add_parser('serve',
+                                         help='serve a cache directory')
+    serve_parser.add_argument('directory')
+    serve_parser.add_argument('--host', default='')
+    serve_parser.add_argument('--port', type=int, default=8080)
+
+    args = parser.parse_args()
+    if args.cmd != 'serve':
+        parser.print_usage(file=sys.stderr)
+        sys.exit(1)
+    serve(args.directory, host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
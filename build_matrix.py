@@ -0,0 +1,209 @@
+# Copyright (c) 2018 Foundries.io Limited.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+'''Build matrix files.
+
+A build matrix lists what 'zmp build' should build, instead of giving
+it on the command line. It is a YAML (or JSON) file like this:
+
+    defaults:
+      boards: [nrf52_blenano2]
+    builds:
+      - apps: [zmp-samples/dm-hawkbit-mqtt, zmp-samples/dm-lwm2m]
+        boards: [nrf52_blenano2, frdm_k64f]
+        overlay_config: [overlay-debug.conf]
+        variants:
+          - name: release
+            signing_key: /path/to/release-key.pem
+            key_type: ecdsa-p256
+            imgtool_version: 1.2.0+4
+          - name: dev
+
+Each entry in 'builds' is expanded into one job per app, board,
+variant and output. Settings not given in an entry come from
+'defaults', then from the command line. A named variant's results go
+into a subdirectory of the output directory with the same name.
+
+Jobs which would do the same build are grouped by dedup(), so each
+distinct configuration is only built once.'''
+
+import collections
+import json
+import os
+
+# Keys allowed in build entries (and 'defaults').
+ENTRY_KEYS = {'apps', 'boards', 'outputs', 'variants'}
+
+# Keys which may appear in entries and variants, with the types of
+# their values. These override the 'zmp build' option with the same
+# name, as stored in its arguments.
+OPTION_KEYS = {
+    'conf_file': str,
+    'overlay_config': list,
+    'signing_key': str,
+    'key_type': str,
+    'imgtool_version': str,
+    'imgtool_pad': bool,
+    'no_bootloader': bool,
+}
+
+# Keys allowed in variants.
+VARIANT_KEYS = {'name'} | set(OPTION_KEYS)
+
+
+class MatrixJob:
+    '''One output to build for an app and board.
+
+    - app: application, as given by the user
+    - board: Zephyr board name
+    - output: one of 'app' or 'mcuboot'
+    - variant: variant name, or None
+    - options: dict of 'zmp build' option overrides; jobs from the
+      same variant share the same dict'''
+
+    def __init__(self, app, board, output, variant=None, options=None):
+        self.app = app
+        self.board = board
+        self.output = output
+        self.variant = variant
+        self.options = options if options is not None else {}
+
+    def outdir(self, outdir):
+        '''Get the output directory for this job's variant.'''
+        if self.variant is None:
+            return outdir
+        return os.path.join(outdir, self.variant)
+
+    def __str__(self):
+        ret = '{} {} ({})'.format(self.app, self.output, self.board)
+        if self.variant is not None:
+            ret += ' [{}]'.format(self.variant)
+        return ret
+
+    def __repr__(self):
+        return ('MatrixJob(app={!r}, board={!r}, output={!r}, '
+                'variant={!r}, options={!r})').format(
+                    self.app, self.board, self.output, self.variant,
+                    self.options)
+
+
+def _check_keys(what, dct, allowed):
+    if not isinstance(dct, dict):
+        raise ValueError('{} must be a mapping, not {!r}'.format(what, dct))
+    unknown = set(dct) - allowed
+    if unknown:
+        raise ValueError('unknown key{} in {}: {}'.format(
+            's' if len(unknown) > 1 else '', what,
+            ', '.join(sorted(unknown))))
+    for key, value in dct.items():
+        typ = OPTION_KEYS.get(key)
+        if typ is not None and not isinstance(value, typ):
+            raise ValueError('{}: {} must be a {}, not {!r}'.format(
+                what, key, typ.__name__, value))
+
+
+def _as_list(what, value):
+    if isinstance(value, str):
+        return [value]
+    if not isinstance(value, list) or not value:
+        raise ValueError('{} must be a string or a non-empty list'.format(
+            what))
+    return value
+
+
+def load(path):
+    '''Load a matrix file, returning its contents as a dict.'''
+    with open(path, 'r') as f:
+        contents = f.read()
+
+    if path.endswith('.json'):
+        data = json.loads(contents)
+    else:
+        try:
+            import yaml
+        except ImportError:
+            raise RuntimeError('PyYAML is required to read {}; install it, '
+                               'or use a .json matrix file'.format(path))
+        data = yaml.safe_load(contents)
+
+    _check_keys(path, data, {'defaults', 'builds'})
+    if not isinstance(data.get('builds'), list):
+        raise ValueError('{}: "builds" must be a list'.format(path))
+    return data
+
+
+def expand(data, default_boards, default_outputs):
+    '''Expand matrix file data into a list of MatrixJob.
+
+    default_boards and default_outputs are used for entries which
+    don't give them (and aren't covered by 'defaults').'''
+    defaults = data.get('defaults', {})
+    _check_keys('defaults', defaults,
+                (ENTRY_KEYS | set(OPTION_KEYS)) - {'apps', 'variants'})
+
+    jobs = []
+    for i, entry in enumerate(data['builds']):
+        what = 'builds[{}]'.format(i)
+        _check_keys(what, entry, ENTRY_KEYS | set(OPTION_KEYS))
+        if 'apps' not in entry:
+            raise ValueError('{}: missing "apps"'.format(what))
+
+        settings = dict(defaults)
+        settings.update(entry)
+        apps = _as_list(what + '.apps', settings['apps'])
+        boards = _as_list(what + '.boards',
+                          settings.get('boards', default_boards))
+        outputs = settings.get('outputs', default_outputs)
+        if outputs == 'all':
+            outputs = ['app', 'mcuboot']
+        outputs = _as_list(what + '.outputs', outputs)
+
+        base = {k: v for k, v in settings.items() if k in OPTION_KEYS}
+        variants = settings.get('variants', [{}])
+        if not isinstance(variants, list) or not variants:
+            raise ValueError('{}: "variants" must be a non-empty list'.format(
+                what))
+
+        for j, variant in enumerate(variants):
+            _check_keys('{}.variants[{}]'.format(what, j), variant,
+                        VARIANT_KEYS)
+            options = dict(base)
+            options.update((k, v) for k, v in variant.items() if k != 'name')
+            name = variant.get('name')
+            for app in apps:
+                app = app.rstrip(os.path.sep)
+                for board in boards:
+                    for output in ['mcuboot', 'app']:
+                        if output not in outputs:
+                            continue
+                        if output == 'mcuboot' and \
+                           options.get('no_bootloader'):
+                            continue
+                        jobs.append(MatrixJob(app, board, output,
+                                              variant=name, options=options))
+
+    return jobs
+
+
+def dedup(jobs, key):
+    '''Group jobs which would do the same build.
+
+    key is a function from a MatrixJob to a hashable value identifying
+    the build it would do. Returns a list of lists of jobs: the first
+    job in each group is the one to build, and the rest can have its
+    results copied to them. Groups are in the order their first jobs
+    appear in. Duplicates of a job (same app, board, output and
+    variant) are dropped, or raise ValueError if their settings
+    differ.'''
+    groups = collections.OrderedDict()
+    seen = {}
+    for job in jobs:
+        ident = (job.app, job.board, job.output, job.variant)
+        if ident in seen:
+            if seen[ident] != job.options:
+                raise ValueError('conflicting settings for {}'.format(job))
+            continue
+        seen[ident] = job.options
+        groups.setdefault(key(job), []).append(job)
+    return list(groups.values())
@@ -0,0 +1,243 @@
+# Copyright (c) 2018 Foundries.io Limited.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+'''Build directory bookkeeping.
+
+Each CMake build directory ("tree") zmp works in gets two marker
+files: a lock file, which is flock()ed while a zmp process is using
+the tree, and a last-used stamp, whose modification time records when
+that was. These are used to evict the least recently used trees once
+an output directory grows past a size budget, without touching any
+tree another zmp process is working in.'''
+
+import fcntl
+import os
+import re
+import shutil
+import threading
+import time
+
+# Marker files kept in each build directory.
+LOCK_FILE = '.zmp-lock'
+LAST_USED_FILE = '.zmp-last-used'
+
+# Files which identify a directory as a build tree.
+TREE_MARKERS = ['CMakeCache.txt', LAST_USED_FILE]
+
+_SIZE_SUFFIXES = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30,
+                  'T': 1 << 40}
+
+# Locks held by each thread: (thread ID, realpath) -> [fd, count,
+# shared]. flock() locks belong to open file descriptions, so each
+# thread opens its own, which keeps threads from sharing a tree the way
+# separate processes can't. Taking a second one in the same thread
+# would deadlock, so nested TreeLocks share the outermost one.
+_held = {}
+_held_lock = threading.Lock()
+
+
+class TreeBusyError(RuntimeError):
+    '''A build tree is locked by another process or thread.'''
+
+
+class TreeLock:
+    '''Advisory lock on a build directory.
+
+    Use as a context manager. Threads in one process exclude each
+    other just like separate processes do. Nested locks on the same
+    tree from one thread are allowed and share the outermost lock,
+    except that an exclusive lock can't be nested in a shared one.
+    Unless touch is False, acquiring the lock also updates the tree's
+    last-used stamp.
+
+    Shared locks are for only reading a tree (e.g. to flash from it):
+    several processes or threads can hold them at once, but not while
+    another holds an exclusive lock.'''
+
+    def __init__(self, outdir, blocking=True, touch=True, shared=False):
+        self.outdir = os.path.realpath(outdir)
+        self.blocking = blocking
+        self.touch = touch
+        self.shared = shared
+        self.key = None
+
+    def acquire(self):
+        '''Acquire the lock. Returns False if the tree is busy and
+        the lock is non-blocking, and True otherwise.
+
+        Raises RuntimeError if this thread already holds a shared lock
+        on the tree, and this one is exclusive: upgrading a flock()
+        isn't atomic, so another holder could get in between.'''
+        self.key = (threading.get_ident(), self.outdir)
+        with _held_lock:
+            held = _held.get(self.key)
+            if held is not None:
+                if held[2] and not self.shared:
+                    raise RuntimeError(
+                        '{}: exclusive lock requested while holding a '
+                        'shared one'.format(self.outdir))
+                held[1] += 1
+                if self.touch:
+                    touch(self.outdir)
+                return True
+
+        fd = os.open(os.path.join(self.outdir, LOCK_FILE),
+                     os.O_RDWR | os.O_CREAT, 0o644)
+        flags = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+        if not self.blocking:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(fd, flags)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+
+        with _held_lock:
+            _held[self.key] = [fd, 1, self.shared]
+        if self.touch:
+            touch(self.outdir)
+        return True
+
+    def release(self):
+        with _held_lock:
+            held = _held[self.key]
+            held[1] -= 1
+            if held[1]:
+                return
+            del _held[self.key]
+        fcntl.flock(held[0], fcntl.LOCK_UN)
+        os.close(held[0])
+
+    def __enter__(self):
+        if not self.acquire():
+            raise TreeBusyError('{} is in use by another process or '
+                                'thread'.format(self.outdir))
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+def touch(outdir):
+    '''Record that a build tree was just used.'''
+    stamp = os.path.join(outdir, LAST_USED_FILE)
+    with open(stamp, 'a'):
+        pass
+    os.utime(stamp)
+
+
+def last_used(outdir):
+    '''Get the time a build tree was last used, as a timestamp.
+
+    Trees without a stamp, e.g. from older versions of zmp, fall back
+    on their CMake cache's modification time.'''
+    for name in [LAST_USED_FILE, 'CMakeCache.txt']:
+        try:
+            return os.stat(os.path.join(outdir, name)).st_mtime
+        except FileNotFoundError:
+            pass
+    return os.stat(outdir).st_mtime
+
+
+def tree_size(path):
+    '''Get the disk space used by the files under path, in bytes.'''
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            try:
+                st = os.lstat(os.path.join(root, name))
+            except FileNotFoundError:
+                continue
+            total += st.st_blocks * 512
+    return total
+
+
+def find_trees(outdir):
+    '''Find the build trees under an output directory.
+
+    Directories starting with '.' are skipped, and the search doesn't
+    descend into build trees themselves.'''
+    ret = []
+    for root, dirs, files in os.walk(outdir):
+        if any(marker in files for marker in TREE_MARKERS):
+            ret.append(root)
+            dirs[:] = []
+        else:
+            dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+    return ret
+
+
+def parse_size(size):
+    '''Parse a size like '512M' or '20G' into a number of bytes.'''
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMGT]?)(?:i?B)?\s*',
+                         size, flags=re.IGNORECASE)
+    if match is None:
+        raise ValueError('invalid size: {}'.format(size))
+    return int(float(match.group(1)) *
+               _SIZE_SUFFIXES[match.group(2).upper()])
+
+
+def format_size(size):
+    '''Format a number of bytes for humans.'''
+    for suffix in ['', 'K', 'M', 'G']:
+        if size < 1024:
+            break
+        size /= 1024
+    else:
+        suffix = 'T'
+    if suffix == '':
+        return '{} B'.format(size)
+    return '{:.1f} {}iB'.format(size, suffix)
+
+
+def _remove_empty_parents(path, top):
+    top = os.path.realpath(top)
+    path = os.path.dirname(os.path.realpath(path))
+    while path != top and path.startswith(top + os.sep):
+        try:
+            os.rmdir(path)
+        except OSError:
+            break
+        path = os.path.dirname(path)
+
+
+def collect(outdir, max_size, keep=(), dry_run=False):
+    '''Evict least recently used build trees until outdir fits max_size.
+
+    Trees in keep, and trees locked by other processes, are never
+    evicted. Returns (evicted, total), where evicted is a list of
+    (tree, size, last_used) tuples, in eviction order, and total is
+    the size of the remaining trees.'''
+    keep = set(os.path.realpath(k) for k in keep)
+    trees = [(last_used(t), t, tree_size(t)) for t in find_trees(outdir)]
+    total = sum(size for _, _, size in trees)
+    evicted = []
+
+    for used, tree, size in sorted(trees):
+        if total <= max_size:
+            break
+        if os.path.realpath(tree) in keep:
+            continue
+        lock = TreeLock(tree, blocking=False, touch=False)
+        if not lock.acquire():
+            continue
+        try:
+            # Check again now that we hold the lock, in case another
+            # process used the tree since we looked.
+            if last_used(tree) != used:
+                continue
+            if not dry_run:
+                shutil.rmtree(tree)
+        finally:
+            lock.release()
+        if not dry_run:
+            _remove_empty_parents(tree, outdir)
+        evicted.append((tree, size, used))
+        total -= size
+
+    return evicted, total
+
+
+def format_time(timestamp):
+    return time.strftime('%Y-%m-%d %H:%M', time.localtime(timestamp))
@@ -5,19 +5,50 @@
 # SPDX-License-Identifier: Apache-2.0
 
 import abc
+import argparse
+import collections
+import concurrent.futures
+import contextlib
+import copy
 import glob
+import hashlib
+import json
 import multiprocessing
 import os
 import platform
 import re
 import shlex
 import shutil
+import statistics
 import subprocess
 import sys
+import tarfile
+import threading
+import time
 
 from west.runners.core import BuildConfiguration
 from west import main as west_main
 
+import app_index
+import artifact_cache
+import build_matrix
+import buildtree
+import configure_cache
+import delta_image
+import dotconfig
+import file_dedup
+import flash_broker
+import flash_history
+import image_sizes
+import intel_hex
+import jobrunner
+import joblog
+import jobserver
+import mcuboot_image
+import ninja_files
+import shard
+import stack_usage
+
 # We could be smarter about this (search for .repo, e.g.), but it seems
 # unnecessary.
 ZMP_ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
@@ -48,8 +79,36 @@ CONFIGURATORS = ['menuconfig']
 # menuconfig is portable and the one most examples are based off of.
 CONFIGURATOR_DEFAULT = 'menuconfig'
 
-# Development-only firmware binary signing key.
-MCUBOOT_DEV_KEY = 'root-rsa-2048.pem'
+# Compiler flag which writes a .su file for each object file.
+STACK_USAGE_FLAG = '-fstack-usage'
+# Image sizes by key type, in the output directory.
+IMAGE_SIZES_FILE = '.zmp-image-sizes.json'
+# Default build time history file, in the output directory.
+BUILD_TIMES_FILE = '.zmp-build-times.json'
+# Estimated build times in seconds per output, for sharding jobs with
+# no history. These must not depend on anything local to a machine,
+# or machines would disagree about the shards.
+SHARD_ESTIMATE = {'app': 60, 'mcuboot': 40}
+# Signing key types: name -> (development-only key in the MCUboot
+# tree, MCUboot Kconfig settings for the signature type and its crypto
+# backend, image signature TLV). Older MCUboot trees lack some of these
+# (ED25519, RSA_LEN); build_mcuboot_tree() checks they took effect.
+MCUBOOT_KEY_TYPES = collections.OrderedDict([
+    ('rsa-2048', ('root-rsa-2048.pem',
+                  ['CONFIG_BOOT_SIGNATURE_TYPE_RSA=y'], 'RSA2048-PSS')),
+    ('rsa-3072', ('root-rsa-3072.pem',
+                  ['CONFIG_BOOT_SIGNATURE_TYPE_RSA=y',
+                   'CONFIG_BOOT_SIGNATURE_TYPE_RSA_LEN=3072'],
+                  'RSA3072-PSS')),
+    ('ecdsa-p256', ('root-ec-p256.pem',
+                    ['CONFIG_BOOT_SIGNATURE_TYPE_ECDSA_P256=y',
+                     'CONFIG_BOOT_ECDSA_TINYCRYPT=y'], 'ECDSA256')),
+    ('ed25519', ('root-ed25519.pem',
+                 ['CONFIG_BOOT_SIGNATURE_TYPE_ED25519=y'], 'ED25519')),
+])
+MCUBOOT_KEY_TYPE_DEFAULT = 'rsa-2048'
+# Development-only firmware binary signing key (for the default type).
+MCUBOOT_DEV_KEY = MCUBOOT_KEY_TYPES[MCUBOOT_KEY_TYPE_DEFAULT][0]
 # Version to write to signed binaries when none is specified.
 MCUBOOT_IMGTOOL_VERSION_DEFAULT = '0.0.0+0'
 # imgtool.py state. This post-processes binaries for chain-loading by mcuboot.
@@ -58,6 +117,24 @@ MCUBOOT_IMGTOOL = os.path.join('scripts', 'imgtool.py')
 # Any globally desirable CMake options can be added here.
 CMAKE_OPTIONS = []
 
+# Builds don't start in a --scratch directory with less free space.
+SCRATCH_MIN_FREE = 256 << 20
+
+# Final artifacts of a build, as glob patterns relative to its build
+# directory. These are what's needed to flash or distribute the
+# results; everything else in the build directory is intermediate.
+BUILD_ARTIFACTS = [
+    'CMakeCache.txt',
+    os.path.join('zephyr', '.config'),
+    os.path.join('zephyr', 'include', 'generated',
+                 'generated_dts_board.conf'),
+    os.path.join('zephyr', 'zephyr.elf'),
+    os.path.join('zephyr', 'zephyr.bin'),
+    os.path.join('zephyr', 'zephyr.hex'),
+    os.path.join('zephyr', '*-signed.bin'),
+    os.path.join('zephyr', '*-signed.hex'),
+]
+
 
 #
 # Helpers
@@ -164,6 +241,92 @@ def signed_app_name(app, board, app_outdir, ext):
     return path
 
 
+def merged_app_name(app, board, app_outdir):
+    '''Get the path of the merged MCUboot and signed app hex file.'''
+    app_base = os.path.basename(app)
+    file_name = '{}-{}-merged.hex'.format(app_base, board)
+    return os.path.join(app_outdir, 'zephyr', file_name)
+
+
+def find_apps(patterns, all_apps=False):
+    '''Expand application arguments.
+
+    Arguments with wildcards, like 'zmp-samples/*', are matched
+    against the applications in the ZMP tree; others are used as is.
+    If all_apps is True, every application is returned instead.'''
+    index = app_index.AppIndex(find_zmp_root())
+    if all_apps:
+        if patterns:
+            raise ValueError('--all-apps is incompatible with giving apps')
+        apps = index.apps()
+        if not apps:
+            raise RuntimeError('no applications found in {}'.format(
+                find_zmp_root()))
+        return apps
+    return index.select(patterns)
+
+
+def parse_outdir(outdir, tree):
+    '''Split a build directory into (app, board, output).
+
+    The tree must be a directory laid out like find_app_outdir() or
+    find_mcuboot_outdir() do under outdir. Returns None otherwise.'''
+    parts = os.path.relpath(tree, outdir).split(os.path.sep)
+    if len(parts) < 3 or parts[-1] not in BUILD_OUTPUTS or \
+       os.pardir in parts:
+        return None
+    return os.path.join(*parts[:-2]), parts[-2], parts[-1]
+
+
+def build_artifacts(outdir):
+    '''Get the BUILD_ARTIFACTS present in outdir, relative to it.'''
+    ret = []
+    for pattern in BUILD_ARTIFACTS:
+        matches = glob.glob(os.path.join(outdir, pattern))
+        ret.extend(sorted(os.path.relpath(m, outdir) for m in matches))
+    return ret
+
+
+def copy_cmake_cache(src, dst, old_dir, new_dir):
+    '''Copy the CMakeCache.txt at src to dst (which may be the same
+    file), replacing the build directory old_dir with new_dir.
+
+    Flashing reads runner settings (like the path to zephyr.elf) from
+    the CMake cache, so they have to point at the directory the build's
+    artifacts are in.'''
+    with open(src, 'r') as f:
+        contents = f.read()
+    tmp = '{}.{}'.format(dst, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write(contents.replace(old_dir, new_dir))
+    shutil.copystat(src, tmp)
+    os.replace(tmp, dst)
+
+
+def zephyr_image(outdir):
+    '''Get the image a runner flashes from a build directory by
+    default: zephyr.hex if there is one, or zephyr.bin.'''
+    for name in ('zephyr.hex', 'zephyr.bin'):
+        path = os.path.join(outdir, 'zephyr', name)
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def cmake_cache_value(outdir, name):
+    '''Get a variable's value from outdir's CMakeCache.txt, or '' if
+    it isn't set.'''
+    prefix = name + ':'
+    try:
+        with open(os.path.join(outdir, 'CMakeCache.txt'), 'r') as f:
+            for line in f:
+                if line.startswith(prefix):
+                    return line.rstrip('\n').partition('=')[2]
+    except FileNotFoundError:
+        pass
+    return ''
+
+
 def append_to_pythonpath(directory):
     pp = os.environ.get('PYTHONPATH')
     os.environ['PYTHONPATH'] = ':'.join(([pp] if pp else []) + [directory])
@@ -186,7 +349,15 @@ HELP = {
     '--outdir': '''build directory (default: '{}').'''.format(
         find_default_outdir()),
     '--outputs': 'which outputs to {} (default: all)',
-    'app': 'application(s) sources',
+    'app': '''application(s) sources; wildcards, like 'zmp-samples/*',
+           match applications in the ZMP tree''',
+    '--all-apps': '''{} every application in the ZMP tree: each directory
+                  with a CMakeLists.txt and prj.conf, except those
+                  matching a pattern in {} at its top level.''',
+    '--max-size': '''Size budget for the output directory, like 500M or
+                  20G. Least recently used build directories are deleted
+                  until the output directory fits; directories in use by
+                  other zmp processes are left alone.''',
 }
 
 
@@ -202,6 +373,12 @@ class Command(abc.ABC):
         self.stdout = stdout
         self.stderr = stderr
 
+        self.zephyr_base = None
+        '''Zephyr tree to use instead of the microPlatform's, if set.'''
+
+        self.job_log = None
+        '''joblog.JobLog that command output goes to, if set.'''
+
     #
     # Abstract interfaces and overridable behavior.
     #
@@ -244,6 +421,10 @@ class Command(abc.ABC):
         if self.arguments.debug:
             print(*args, sep=sep, end=end, file=self.stdout, flush=flush)
 
+    def inf(self, *args, sep='  ', end='\n', flush=False):
+        '''Display an informational message.'''
+        print(*args, sep=sep, end=end, file=self.stdout, flush=flush)
+
     def wrn(self, *args, sep='  ', end='\n', flush=False):
         '''Display a warning message.'''
         print(*args, sep=sep, end=end, file=self.stderr, flush=flush)
@@ -269,10 +450,12 @@ class Command(abc.ABC):
 
         The instance variable 'command_env' will be set upon return.
         It will be used when running commands with check_call().'''
-        # Override ZEPHYR_BASE to the microPlatform's tree.
-        zephyr_base = find_zephyr_base()
+        # Override ZEPHYR_BASE to the microPlatform's tree (or the
+        # one we were told to use).
+        zephyr_base = self.zephyr_base or find_zephyr_base()
         env_val = os.environ.get('ZEPHYR_BASE')
-        if env_val is not None and env_val != zephyr_base:
+        if env_val is not None and env_val != zephyr_base and \
+           self.zephyr_base is None:
             self.wrn('Warning: overriding ZEPHYR_BASE:')
             self.wrn('\tenvironment value: {}'.format(env_val))
             self.wrn('\tusing value:       {}'.format(zephyr_base))
@@ -282,18 +465,23 @@ class Command(abc.ABC):
         command_env['ZEPHYR_BASE'] = zephyr_base
         self.command_env = command_env
 
-        if len(self.arguments.boards) == 0:
+        # Commands which don't work on particular boards or outputs
+        # (like gc) don't have these arguments.
+        boards = getattr(self.arguments, 'boards', None)
+        if boards is not None and len(boards) == 0:
             self.arguments.boards = [BOARD_DEFAULT]
         if 'BOARD' in command_env:
-            if [command_env['BOARD']] != self.arguments.boards:
+            if boards is not None and \
+               [command_env['BOARD']] != self.arguments.boards:
                 self.wrn('Ignoring BOARD={}: targeting {}'.format(
                     command_env['BOARD'], self.arguments.boards))
             del command_env['BOARD']
 
-        if self.arguments.outputs == 'all':
+        outputs = getattr(self.arguments, 'outputs', None)
+        if outputs == 'all':
             self.arguments.outputs = BUILD_OUTPUTS
-        else:
-            self.arguments.outputs = [self.arguments.outputs]
+        elif outputs is not None:
+            self.arguments.outputs = [outputs]
 
     def invoke(self, arguments):
         '''Invoke the command, with given arguments.'''
@@ -301,6 +489,23 @@ class Command(abc.ABC):
         self.prep_for_run()
         self.do_invoke()
 
+    def run_command(self, cls, argv, zephyr_base=None):
+        '''Run another command, as if from the command line.
+
+        cls is the Command subclass, and argv its arguments. The new
+        command shares this one's output streams and --debug setting,
+        and uses the given Zephyr tree, if any. Returns the command
+        instance after it has run.'''
+        command = cls(stdout=self.stdout, stderr=self.stderr)
+        command.zephyr_base = zephyr_base
+        parser = argparse.ArgumentParser(prog=command.command_name)
+        command.do_register(parser)
+        arguments = parser.parse_args(argv)
+        arguments.debug = self.arguments.debug
+        arguments.cmd = command.command_name
+        command.invoke(arguments)
+        return command
+
     #
     # Miscellaneous
     #
@@ -311,7 +516,7 @@ class Command(abc.ABC):
         return fmt.format(*args)
 
     def _subprocess(self, subprocess_runner, command, **kwargs):
-        msg = kwargs.get('msg', 'Running command')
+        msg = kwargs.pop('msg', 'Running command')
         env = kwargs.get('env', self.command_env)
 
         if self.arguments.debug:
@@ -322,26 +527,108 @@ class Command(abc.ABC):
             self.dbg('\t{}'.format(self._cmd_to_string(command)))
 
         kwargs['env'] = env
+        kwargs.setdefault('stream', self.stdout)
+        if self.job_log is not None and 'on_line' not in kwargs:
+            self.job_log.command(self._cmd_to_string(command))
+            kwargs['on_line'] = self.job_log.line
         try:
             ret = subprocess_runner(command, **kwargs)
         except subprocess.CalledProcessError:
             cmd = self._cmd_to_string(command)
             print('Failed to run command: {}'.format(cmd), file=sys.stderr)
             raise
+        except subprocess.TimeoutExpired:
+            cmd = self._cmd_to_string(command)
+            print('Timed out after {}s: {}'.format(kwargs['timeout'], cmd),
+                  file=sys.stderr)
+            raise
 
         return ret
 
     def check_call(self, command, **kwargs):
-        return self._subprocess(subprocess.check_call, command, **kwargs)
+        return self._subprocess(jobrunner.check_call, command, **kwargs)
 
     def check_output_enc(self, command, **kwargs):
-        outbytes = self._subprocess(subprocess.check_output, command, **kwargs)
-        encoding = kwargs.get('encoding', sys.getdefaultencoding())
+        encoding = kwargs.pop('encoding', sys.getdefaultencoding())
+        outbytes = self._subprocess(jobrunner.check_output, command, **kwargs)
         return outbytes.decode(encoding)
 
+    def west_command(self, args):
+        '''Get the command line which runs west with the given arguments.'''
+        return [sys.executable, west_main.__file__] + args
+
     def check_west_call(self, args, **kwargs):
-        '''Runs west with check_call and the given arguments.'''
-        self.check_call([sys.executable, west_main.__file__] + args, **kwargs)
+        '''Runs west with check_call and the given arguments.
+
+        West always runs in a new process: its main() isn't meant to
+        be called more than once per process, and commands like flash
+        have side effects. Read-only queries, like a build directory's
+        runner configuration, use west's library APIs in this process
+        instead (see BuildConfiguration).'''
+        self.check_call(self.west_command(args), **kwargs)
+
+    @contextlib.contextmanager
+    def logging_to(self, name, path, tail_lines):
+        '''Send the output of commands run in the with block to a
+        compressed log file at path, instead of the terminal.
+
+        A progress line is printed for the job with the given name,
+        and if it fails, the last tail_lines lines of its output.'''
+        start = time.time()
+        saved = self.job_log
+        with joblog.JobLog(name, path, tail_lines=tail_lines,
+                           on_progress=self.show_progress) as log:
+            self.job_log = log
+            try:
+                yield log
+            except (subprocess.CalledProcessError,
+                    subprocess.TimeoutExpired):
+                self.end_progress(log)
+                self.wrn('{}: FAILED; last {} lines of output:'.format(
+                    name, len(log.tail)))
+                for line in log.tail:
+                    self.wrn('  ' + line)
+                self.wrn('{}: full log in {}'.format(name, path), flush=True)
+                raise
+            finally:
+                self.job_log = saved
+        self.end_progress(log)
+        self.inf('{}: done in {:.1f} s (log: {})'.format(
+            name, time.time() - start, path), flush=True)
+
+    def show_progress(self, log, done, total):
+        # Only a terminal can have its progress line rewritten.
+        if self.stdout.isatty():
+            print('\r{}: [{}/{}]'.format(log.name, done, total), end='',
+                  file=self.stdout, flush=True)
+
+    def end_progress(self, log):
+        if self.stdout.isatty():
+            print('\r\033[K', end='', file=self.stdout, flush=True)
+
+    def run_jobs(self, jobs, max_jobs=None):
+        '''Run several jobrunner.Job instances concurrently.
+
+        Jobs without an environment get the command environment. If
+        any job fails, the rest are cancelled and the failure is
+        raised; see jobrunner.run_jobs() for details.'''
+        for job in jobs:
+            if job.env is None:
+                job.env = self.command_env
+            self.dbg('Queueing job{}:'.format(
+                '' if job.prefix is None else ' ' + job.prefix.strip()))
+            if job.cwd is not None:
+                self.dbg('\tcwd: {}'.format(job.cwd))
+            self.dbg('\t{}'.format(self._cmd_to_string(job.command)))
+
+        try:
+            return jobrunner.run_jobs(jobs, stream=self.stdout,
+                                      max_jobs=max_jobs)
+        except (subprocess.CalledProcessError,
+                subprocess.TimeoutExpired) as e:
+            cmd = self._cmd_to_string(e.cmd)
+            print('Failed to run command: {}'.format(cmd), file=sys.stderr)
+            raise
 
 
 #
@@ -367,12 +654,39 @@ class Build(Command):
                             action='append', help=HELP['--board'])
         parser.add_argument('-O', '--outdir', default=find_default_outdir(),
                             help=HELP['--outdir'])
-        parser.add_argument('app', nargs='+', help=HELP['app'])
+        parser.add_argument('app', nargs='*', help=HELP['app'])
+        parser.add_argument('--all-apps', action='store_true',
+                            help=HELP['--all-apps'].format(
+                                'Build', app_index.IGNORE_FILE))
         parser.add_argument('-o', '--outputs', choices=BUILD_OUTPUTS + ['all'],
                             default='all',
                             help=HELP['--outputs'].format('build'))
 
         # Build-specific arguments
+        parser.add_argument('--matrix',
+                            help='''YAML or JSON file listing apps, boards,
+                            configuration files and signing variants to
+                            build, instead of giving them on the command
+                            line. Jobs which would do identical builds are
+                            only built once, and the results copied.''')
+        parser.add_argument('--shard', metavar='I/N',
+                            help='''Only build shard I of N (counting from
+                            1), for splitting builds among N machines.
+                            All outputs and variants for an app and board
+                            are in the same shard, and usually stay in it
+                            from run to run. Shards are balanced by the
+                            build times in the --build-times file if one
+                            is given, or by estimates otherwise.''')
+        parser.add_argument('--build-times', metavar='FILE',
+                            default=os.environ.get('ZMP_BUILD_TIMES'),
+                            help='''Build time history file, updated after
+                            each build (default: the ZMP_BUILD_TIMES
+                            environment variable if set, or {} in the
+                            output directory). If given, --shard is
+                            balanced with it, so every machine building
+                            a shard must start with the same copy of it,
+                            or they disagree about the shards.'''.format(
+                                BUILD_TIMES_FILE))
         parser.add_argument('-G', '--generator', default='Ninja',
                             help='''CMake generator to use; default is Ninja.
                             Note that you must run 'pristine' between builds
@@ -405,11 +719,26 @@ class Build(Command):
                             help='''Number of jobs to run simultaneously (the
                             default is derived from the number of available
                             CPUs)''')
+        parser.add_argument('--job-pool', metavar='DIR',
+                            default=os.environ.get('ZMP_JOB_POOL'),
+                            help='''Directory holding job tokens shared with
+                            other zmp processes, so that all of their
+                            builds together run at most --jobs compilers
+                            (the largest --jobs, if they differ). Builds
+                            within one zmp process always share its
+                            --jobs (default: the ZMP_JOB_POOL environment
+                            variable, if set).''')
         parser.add_argument('-K', '--signing-key',
                             help='''Path to signing key for application
                                  binary. WARNING: if not given, an INSECURE
                                  default key is used which should NOT be
                                  used for production images.''')
+        parser.add_argument('--key-type', choices=list(MCUBOOT_KEY_TYPES),
+                            help='''Type of the signing key, which MCUboot
+                                 is built to verify (default: {}). EC keys
+                                 make smaller signatures, which MCUboot
+                                 checks faster.'''.format(
+                                     MCUBOOT_KEY_TYPE_DEFAULT))
         parser.add_argument('-V', '--imgtool-version',
                             help='''Image version in X.Y.Z+B semantic
                                  versioning format (default: {})'''.format(
@@ -426,66 +755,482 @@ class Build(Command):
                                  end of the sector. This is not normally a
                                  good idea, as it wastes space and consumes
                                  extra bandwidth to transmit.""")
+        parser.add_argument('--cache', default=os.environ.get('ZMP_CACHE'),
+                            help='''Shared build cache to fetch build outputs
+                                 from before compiling, and to store them in
+                                 after a successful build. This is a
+                                 directory, or an http(s):// URL of a server
+                                 which supports GET and PUT (default: the
+                                 ZMP_CACHE environment variable, if set).''')
+        parser.add_argument('--cache-read-only', action='store_true',
+                            help='''If given, only fetch from the --cache;
+                                 don't store new build outputs in it.''')
+        parser.add_argument('--configure-cache', nargs='?', const='',
+                            default=os.environ.get('ZMP_CONFIGURE_CACHE'),
+                            metavar='DIR',
+                            help='''Directory in which to keep a copy of each
+                                 build directory as it is right after CMake
+                                 configures it. New build directories with
+                                 the same board, sources, toolchain and
+                                 configuration files are cloned from it
+                                 instead of being configured from scratch.
+                                 If DIR isn't given, .configure-cache in the
+                                 output directory is used (default: the
+                                 ZMP_CONFIGURE_CACHE environment variable,
+                                 if set).''')
+        parser.add_argument('--scratch', metavar='DIR',
+                            default=os.environ.get('ZMP_SCRATCH'),
+                            help='''Build in a subdirectory of DIR, which
+                                 should be on a fast (e.g. RAM-backed, like
+                                 /dev/shm) file system, and copy only the
+                                 final artifacts to the output directory.
+                                 Scratch build directories are kept between
+                                 runs for incremental builds, and evicted
+                                 when the scratch space is over budget; if
+                                 it's full, builds fall back to the output
+                                 directory (default: the ZMP_SCRATCH
+                                 environment variable, if set).''')
+        parser.add_argument('--scratch-max-size', metavar='SIZE',
+                            default=os.environ.get('ZMP_SCRATCH_MAX_SIZE'),
+                            help='''Size budget for --scratch, like 4G
+                                 (default: the ZMP_SCRATCH_MAX_SIZE
+                                 environment variable if set, or half the
+                                 size of the file system DIR is on).''')
+        parser.add_argument('--log-dir', metavar='DIR',
+                            default=os.environ.get('ZMP_LOG_DIR'),
+                            help='''Write the output of each app and MCUboot
+                                 build to its own gzip-compressed log file in
+                                 DIR, printing only a progress line, and the
+                                 end of the log if it fails (default: the
+                                 ZMP_LOG_DIR environment variable, if
+                                 set).''')
+        parser.add_argument('--log-tail', type=int, default=50, metavar='N',
+                            help='''With --log-dir, how many lines of a
+                                 failed build's log to print (default:
+                                 50).''')
+        parser.add_argument('--hotspots', nargs='?', type=int, const=10,
+                            metavar='N',
+                            help='''After building, print the N (default: 10)
+                                 slowest build steps for each app, board,
+                                 output and variant built, with total CPU
+                                 time, wall time, and the effective
+                                 parallelism achieved.
+                                 Requires the Ninja generator.''')
+        parser.add_argument('--hotspots-json', metavar='FILE',
+                            help='''Write the build times of every build
+                                 step of each build to FILE, as JSON.''')
+        parser.add_argument('--stack-usage', nargs='?', type=int, const=10,
+                            metavar='N',
+                            help='''Compile with -fstack-usage, and after
+                                 building, print the N (default: 10)
+                                 functions with the largest stack frames,
+                                 and the modules containing them, for each
+                                 build. Builds fetched from
+                                 --cache have no stack usage data.''')
+        parser.add_argument('--stack-usage-json', metavar='FILE',
+                            help='''Write the stack frame size of every
+                                 function in each build to FILE, as JSON,
+                                 for use with
+                                 --stack-usage-baseline. Implies
+                                 -fstack-usage.''')
+        parser.add_argument('--stack-usage-baseline', metavar='FILE',
+                            help='''Compare stack frame sizes with FILE,
+                                 written by an earlier --stack-usage-json,
+                                 printing the functions which changed the
+                                 most. Builds are matched by app, board,
+                                 output and variant. Implies
+                                 -fstack-usage.''')
+        parser.add_argument('--max-outdir-size',
+                            default=os.environ.get('ZMP_OUTDIR_MAX_SIZE'),
+                            help=HELP['--max-size'] + ''' This is done
+                                 after building, and never deletes the
+                                 directories just built (default: the
+                                 ZMP_OUTDIR_MAX_SIZE environment variable,
+                                 if set).''')
 
     def do_prep_for_run(self):
-        if self.arguments.no_bootloader:
-            if self.arguments.signing_key is not None:
+        if self.arguments.app or self.arguments.all_apps:
+            self.arguments.app = find_apps(self.arguments.app,
+                                           self.arguments.all_apps)
+        if bool(self.arguments.app) == bool(self.arguments.matrix):
+            raise ValueError('give either apps or --matrix')
+
+        if self.arguments.shard is not None:
+            self.shard = shard.parse(self.arguments.shard)
+        else:
+            self.shard = None
+        self.build_times = shard.BuildTimes(
+            self.arguments.build_times or
+            os.path.join(self.arguments.outdir, BUILD_TIMES_FILE))
+        # The default file is local to this machine, so it can't be used
+        # for sharding: other machines would balance their shards by
+        # different times.
+        self.shared_build_times = self.arguments.build_times is not None
+
+        # Matrix variants start over from the command line options.
+        self.raw_arguments = copy.copy(self.arguments)
+        self.prep_signing_options(self.arguments)
+
+        check_boards(self.arguments.boards)
+        check_dependencies(['cmake', 'dtc'])
+        if self.arguments.jobs < 1:
+            raise ValueError('--jobs must be at least 1')
+        self.job_pool = jobserver.pool(self.arguments.jobs,
+                                       directory=self.arguments.job_pool)
+        if self.arguments.generator == 'Ninja':
+            check_dependencies(['ninja'])
+        elif (self.arguments.hotspots is not None or
+              self.arguments.hotspots_json):
+            raise ValueError('--hotspots requires the Ninja generator')
+        # The MatrixJob being built, which reports are labeled with,
+        # since the build directory may be a scratch one.
+        self.current_job = None
+        self.profiles = []
+        self.stack_usages = []
+        if self.arguments.stack_usage_baseline:
+            with open(self.arguments.stack_usage_baseline, 'r') as f:
+                self.stack_usage_baseline = json.load(f)['builds']
+        else:
+            self.stack_usage_baseline = None
+
+        if self.arguments.max_outdir_size is not None:
+            self.max_outdir_size = buildtree.parse_size(
+                self.arguments.max_outdir_size)
+        else:
+            self.max_outdir_size = None
+
+        if self.arguments.cache:
+            self.cache = artifact_cache.backend_for(self.arguments.cache)
+        else:
+            self.cache = None
+        self.tree_fingerprints = {}
+        self.job_namespaces = {}
+
+        if self.arguments.configure_cache is None:
+            self.configure_cache = None
+        else:
+            self.configure_cache = configure_cache.ConfigureCache(
+                self.arguments.configure_cache or
+                os.path.join(self.arguments.outdir, '.configure-cache'))
+        self.cmake_version = None
+
+        if self.arguments.scratch is not None:
+            # Scratch space is often shared (like /dev/shm), so each
+            # user gets a directory of their own.
+            self.scratch = os.path.join(
+                os.path.abspath(self.arguments.scratch),
+                'zmp-{}'.format(os.getuid()))
+            os.makedirs(self.scratch, exist_ok=True)
+            if self.arguments.scratch_max_size is not None:
+                self.scratch_max_size = buildtree.parse_size(
+                    self.arguments.scratch_max_size)
+            else:
+                self.scratch_max_size = shutil.disk_usage(
+                    self.scratch).total // 2
+        else:
+            self.scratch = None
+
+    def prep_signing_options(self, args):
+        if args.no_bootloader:
+            if args.signing_key is not None:
                 raise ValueError('{} is incompatible with {}'.format(
                     '--no-bootloader', '--signing-key'))
-            elif self.arguments.imgtool_version is not None:
+            elif args.key_type is not None:
+                raise ValueError('{} is incompatible with {}'.format(
+                    '--no-bootloader', '--key-type'))
+            elif args.imgtool_version is not None:
                 raise ValueError('{} is incompatible with {}'.format(
                     '--no-bootloader', '--imgtool-version'))
-            elif self.arguments.imgtool_pad:
+            elif args.imgtool_pad:
                 raise ValueError('{} is incompatible with {}'.format(
                     '--no-bootloader', '--imgtool-pad'))
-            self.arguments.outputs = 'app'
+            args.outputs = 'app'
         else:
-            if self.arguments.imgtool_version is None:
+            if args.imgtool_version is None:
                 default = MCUBOOT_IMGTOOL_VERSION_DEFAULT
                 self.wrn('No --imgtool-version given, using {}'.format(
                     default))
-                self.arguments.imgtool_version = default
-            if not self.version_is_semver(self.arguments.imgtool_version):
+                args.imgtool_version = default
+            if not self.version_is_semver(args.imgtool_version):
                 msg = '{} is not in semantic versioning format'
-                raise ValueError(msg.format(self.arguments.imgtool_version))
-
-            if self.arguments.signing_key is None:
-                key = os.path.join(find_mcuboot_root(), MCUBOOT_DEV_KEY)
-                self.insecure_requested = True
+                raise ValueError(msg.format(args.imgtool_version))
+
+            if args.key_type is None:
+                args.key_type = MCUBOOT_KEY_TYPE_DEFAULT
+            elif args.key_type not in MCUBOOT_KEY_TYPES:
+                # Build matrix values aren't checked by argparse.
+                raise ValueError('unknown key type {}; choose from {}'.format(
+                    args.key_type, ', '.join(MCUBOOT_KEY_TYPES)))
+            if args.signing_key is None:
+                key = os.path.join(find_mcuboot_root(),
+                                   MCUBOOT_KEY_TYPES[args.key_type][0])
             else:
-                key = self.arguments.signing_key
-                self.insecure_requested = False
-            self.arguments.signing_key = os.path.abspath(key)
+                key = args.signing_key
+            args.signing_key = os.path.abspath(key)
 
-        check_boards(self.arguments.boards)
-        check_dependencies(['cmake', 'dtc'])
-        if self.arguments.generator == 'Ninja':
-            check_dependencies(['ninja'])
+    @property
+    def insecure_requested(self):
+        dev_keys = [os.path.abspath(os.path.join(find_mcuboot_root(), key))
+                    for key, _, _ in MCUBOOT_KEY_TYPES.values()]
+        return self.arguments.signing_key in dev_keys
 
     def do_invoke(self):
-        for app in self.arguments.app:
-            app = app.rstrip(os.path.sep)
-            for board in self.arguments.boards:
-                if 'mcuboot' in self.arguments.outputs:
-                    self.build_mcuboot(app, board)
-                if 'app' in self.arguments.outputs:
-                    self.build_app(app, board)
+        jobs = self.matrix_jobs()
+        if self.shard is not None:
+            jobs = self.shard_jobs(jobs)
+        used = []
+        times = {}
+        try:
+            for group in build_matrix.dedup(jobs, self.dedup_key):
+                start = time.monotonic()
+                self.build_job(group[0])
+                times[str(group[0])] = time.monotonic() - start
+                for job in group[1:]:
+                    self.inf('Reusing {} for {}'.format(group[0], job))
+                    start = time.monotonic()
+                    self.fan_out(group[0], job)
+                    times[str(job)] = time.monotonic() - start
+                used.extend(self.job_outdir(job) for job in group)
+        finally:
+            try:
+                self.build_times.record(times)
+            except OSError as e:
+                self.wrn('Warning: recording build times in {} failed: {}'.
+                         format(self.build_times.path, e))
+
+        if self.arguments.hotspots is not None:
+            self.print_hotspots(self.arguments.hotspots)
+        if self.arguments.hotspots_json:
+            self.write_hotspots_json(self.arguments.hotspots_json)
+        if self.arguments.stack_usage is not None:
+            self.print_stack_usage(self.arguments.stack_usage)
+        if self.stack_usage_baseline is not None:
+            self.print_stack_usage_diff(self.arguments.stack_usage or 10)
+        if self.arguments.stack_usage_json:
+            self.write_stack_usage_json(self.arguments.stack_usage_json)
+
+        if self.max_outdir_size is not None:
+            evicted, _ = buildtree.collect(self.arguments.outdir,
+                                           self.max_outdir_size, keep=used)
+            for tree, size, _ in evicted:
+                self.dbg('Evicted {} ({})'.format(
+                    tree, buildtree.format_size(size)))
 
     def cmake_build(self, sourcedir, outdir, gen_options):
         os.makedirs(outdir, exist_ok=True)
 
         if 'CMakeFiles' not in os.listdir(outdir):
-            cmd_generate = (['cmake',
-                             '-G{}'.format(self.arguments.generator)] +
-                            CMAKE_OPTIONS +
-                            gen_options + [shlex.quote(sourcedir)])
+            self.remove_foreign_cmake_cache(outdir)
+            self.cmake_generate(sourcedir, outdir, gen_options)
+        elif self.stack_usage_requested and \
+                STACK_USAGE_FLAG not in cmake_cache_value(outdir,
+                                                          'EXTRA_CFLAGS'):
+            # An existing build directory only gets new -D options if
+            # CMake is run again.
+            cmd_generate = ['cmake'] + gen_options + [shlex.quote(sourcedir)]
             self.check_call(cmd_generate, cwd=outdir)
 
-        cmd_build = (['cmake',
-                      '--build', shlex.quote(outdir),
-                      '--',
-                      '-j{}'.format(self.arguments.jobs)])
-        self.check_call(cmd_build, cwd=outdir)
+        # Compile with as many jobs as we get tokens for, so builds
+        # running at the same time don't oversubscribe the machine.
+        with self.job_pool.acquire(self.arguments.jobs) as tokens:
+            if tokens.count < self.arguments.jobs:
+                self.dbg('Building {} with {} of {} jobs'.format(
+                    outdir, tokens.count, self.arguments.jobs))
+            cmd_build = (['cmake',
+                          '--build', shlex.quote(outdir),
+                          '--',
+                          '-j{}'.format(tokens.count)])
+            with self.profiling(outdir):
+                self.check_call(cmd_build, cwd=outdir)
+
+    def cmake_generate(self, sourcedir, outdir, gen_options):
+        key = None
+        if self.configure_cache is not None:
+            key = self.configure_key(sourcedir, outdir, gen_options)
+            if self.configure_cache.restore(key, outdir):
+                self.dbg('Cloned {} from configure cache entry {}'.format(
+                    outdir, key))
+                return
+
+        cmd_generate = (['cmake',
+                         '-G{}'.format(self.arguments.generator)] +
+                        CMAKE_OPTIONS +
+                        gen_options + [shlex.quote(sourcedir)])
+        self.check_call(cmd_generate, cwd=outdir)
+
+        if key is not None:
+            try:
+                self.configure_cache.save(key, outdir)
+            except OSError as e:
+                self.wrn('Warning: saving {} in {} failed: {}'.format(
+                    outdir, self.configure_cache, e))
+
+    @contextlib.contextmanager
+    def profiling(self, outdir):
+        # Ninja appends a line to its log for each step it runs, so
+        # the steps from this build are the ones after the current end.
+        if self.arguments.hotspots is None and \
+           not self.arguments.hotspots_json:
+            yield
+            return
+
+        log = os.path.join(outdir, ninja_files.LOG_FILE)
+        try:
+            st = os.stat(log)
+            offset, inode = st.st_size, st.st_ino
+        except FileNotFoundError:
+            offset, inode = 0, None
+        start = time.time()
+
+        yield
+
+        if not os.path.isfile(log):
+            return
+        if os.stat(log).st_ino == inode:
+            entries, _ = ninja_files.read_log(log, offset=offset)
+        else:
+            # Ninja rewrote ("recompacted") its log, so fall back on
+            # the recorded modification times of the outputs.
+            entries, _ = ninja_files.read_log(log)
+            entries = [e for e in entries
+                       if ninja_files.mtime_to_seconds(e.mtime) >= start - 1]
+        if entries:
+            self.profiles.append((self.current_job,
+                                  ninja_files.build_profile(entries)))
+
+    def job_fields(self, job):
+        '''Get the JSON report fields identifying a MatrixJob.'''
+        return {
+            'build_dir': self.job_outdir(job),
+            'app': job.app,
+            'board': job.board,
+            'output': job.output,
+            'variant': job.variant,
+        }
+
+    @property
+    def stack_usage_requested(self):
+        return (self.arguments.stack_usage is not None or
+                bool(self.arguments.stack_usage_json) or
+                bool(self.arguments.stack_usage_baseline))
+
+    def stack_usage_args(self):
+        if not self.stack_usage_requested:
+            return []
+        return ['-DEXTRA_CFLAGS={}'.format(STACK_USAGE_FLAG)]
+
+    def collect_stack_usage(self, build_dir):
+        # The .su files are in build_dir, which is a scratch directory
+        # with --scratch.
+        if not self.stack_usage_requested:
+            return
+        functions = stack_usage.collect(build_dir)
+        if not functions:
+            self.wrn('Warning: no stack usage information for {}'.format(
+                self.current_job))
+            return
+        self.stack_usages.append((self.current_job, functions))
+
+    def print_stack_usage(self, count):
+        for job, functions in self.stack_usages:
+            self.inf('{}: {} functions'.format(job, len(functions)))
+            self.inf('  Largest stack frames:')
+            for f in stack_usage.worst_functions(functions, count):
+                self.inf('  {:8d}  {} ({}{})'.format(
+                    f.size, f.name, f.module,
+                    '' if f.qualifiers == 'static' else
+                    ', ' + f.qualifiers))
+            self.inf('  Modules with the largest stack frames:')
+            worst = stack_usage.worst_modules(functions, count)
+            for module, size, n in worst:
+                self.inf('  {:8d}  {} ({} functions)'.format(size, module,
+                                                             n))
+
+    def print_stack_usage_diff(self, count):
+        for job, functions in self.stack_usages:
+            name = str(job)
+            baseline = self.stack_usage_baseline.get(name)
+            if baseline is None:
+                self.inf('{}: not in stack usage baseline'.format(name))
+                continue
+            changes = stack_usage.diff(baseline['functions'],
+                                       stack_usage.as_dict(functions))
+            if not changes:
+                self.inf('{}: stack usage unchanged'.format(name))
+                continue
+            self.inf('{}: {} functions changed stack usage'.format(
+                name, len(changes)))
+            for key, before, after in changes[:count]:
+                self.inf('  {:+8d}  {} ({} -> {})'.format(
+                    (after or 0) - (before or 0), key,
+                    'new' if before is None else before,
+                    'gone' if after is None else after))
+
+    def write_stack_usage_json(self, path):
+        builds = {}
+        # Keyed by job rather than build directory, so baselines from
+        # another output directory still match.
+        for job, functions in self.stack_usages:
+            build = self.job_fields(job)
+            build['functions'] = stack_usage.as_dict(functions)
+            builds[str(job)] = build
+        data = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'builds': builds,
+        }
+        with open(path, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    def print_hotspots(self, count):
+        for job, profile in self.profiles:
+            self.inf('{}: {:.1f} s wall, {:.1f} s CPU, {:.1f}x parallelism'.
+                     format(job, profile['wall_ms'] / 1000,
+                            profile['cpu_ms'] / 1000,
+                            profile['parallelism']))
+            for output, ms in profile['targets'][:count]:
+                self.inf('  {:8.2f} s  {}'.format(ms / 1000, output))
+
+    def write_hotspots_json(self, path):
+        builds = []
+        for job, profile in self.profiles:
+            build = self.job_fields(job)
+            build.update({
+                'wall_ms': profile['wall_ms'],
+                'cpu_ms': profile['cpu_ms'],
+                'parallelism': profile['parallelism'],
+                'targets': [{'output': target, 'ms': ms}
+                            for target, ms in profile['targets']],
+            })
+            builds.append(build)
+        data = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'jobs': self.arguments.jobs,
+            'zephyr_toolchain_variant':
+                self.arguments.zephyr_toolchain_variant,
+            'builds': builds,
+        }
+        with open(path, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    def remove_foreign_cmake_cache(self, outdir):
+        # Build artifacts copied into outdir (from the build cache, or
+        # from an identical build) include a CMakeCache.txt for another
+        # directory, which CMake would refuse to use here.
+        cache = os.path.join(outdir, 'CMakeCache.txt')
+        if not os.path.isfile(cache):
+            return
+        with open(cache, 'r') as f:
+            for line in f:
+                if line.startswith('CMAKE_CACHEFILE_DIR:INTERNAL='):
+                    cache_dir = line.split('=', 1)[1].strip()
+                    break
+            else:
+                return
+        if os.path.realpath(cache_dir) != os.path.realpath(outdir):
+            self.dbg('Removing {} (made for {})'.format(cache, cache_dir))
+            os.unlink(cache)
 
     def toolchain_args(self):
         if not self.arguments.prebuilt_toolchain.startswith('y'):
@@ -501,10 +1246,9 @@ class Build(Command):
             raise NotImplementedError(
                 "no prebuilts available for {}".format(toolchain_variant))
 
-    def build_mcuboot(self, app, board):
-        outdir = find_mcuboot_outdir(self.arguments.outdir, app, board)
-        mcuboot_source = os.path.join(find_mcuboot_root(), 'boot', 'zephyr')
-        gen_options = ['-DBOARD={}'.format(board)] + self.toolchain_args()
+    def mcuboot_gen_options(self, app, board):
+        gen_options = (['-DBOARD={}'.format(board)] + self.toolchain_args() +
+                       self.stack_usage_args())
 
         # If the application sources contain mcuboot.overlay, bring it
         # into the MCUboot build as well.
@@ -514,16 +1258,69 @@ class Build(Command):
             gen_options.extend(['-DDTC_OVERLAY_FILE={}'.format(
                     shlex.quote(mcuboot_overlay))])
 
+        return gen_options
+
+    def app_gen_options(self, app, board):
+        gen_options = (['-DBOARD={}'.format(board)] + self.toolchain_args() +
+                       self.stack_usage_args())
+        overlay_config = self.app_overlay_config()
+
+        if self.arguments.conf_file:
+            gen_options.append('-DCONF_FILE={}'.format(
+                self.arguments.conf_file))
+
+        if overlay_config:
+            gen_options.append('-DOVERLAY_CONFIG={}'.format(
+                shlex.quote(';'.join(overlay_config))))
+
+        return gen_options
+
+    def app_overlay_config(self):
+        overlay_config = list(self.arguments.overlay_config)
+        if not self.arguments.no_bootloader:
+            overlay_config.append(os.path.join(find_sdk_build_root(),
+                                               'mcuboot-overlay.conf'))
+        return overlay_config
+
+    def build_mcuboot(self, app, board):
+        outdir = find_mcuboot_outdir(self.arguments.outdir, app, board)
+        mcuboot_source = os.path.join(find_mcuboot_root(), 'boot', 'zephyr')
+        gen_options = self.mcuboot_gen_options(app, board)
+
+        os.makedirs(outdir, exist_ok=True)
+        with buildtree.TreeLock(outdir):
+            file_dedup.unshare(outdir)
+            self.build_mcuboot_locked(app, board, outdir, mcuboot_source,
+                                      gen_options)
+
+    def build_mcuboot_locked(self, app, board, outdir, mcuboot_source,
+                             gen_options):
+        key, hit = self.cache_fetch(app, board, 'mcuboot', outdir,
+                                    gen_options)
+        if not hit:
+            def build(build_dir):
+                self.build_mcuboot_tree(build_dir, mcuboot_source,
+                                        gen_options)
+                self.collect_stack_usage(build_dir)
+
+            self.build_in_tree(outdir, build)
+            self.cache_store(key, outdir)
+        self.report_size('MCUboot for {} ({})'.format(app, board),
+                         os.path.join(outdir, 'zephyr', 'zephyr.bin'))
+
+    def build_mcuboot_tree(self, outdir, mcuboot_source, gen_options):
         # MCUboot requires a key Kconfig option, so we need an overlay
         # file; the only convenient ways to bake them in from here are
         # with an explicit -DOVERLAY_CONFIG=xx, or by putting the
         # setting into the build directory. Since we're generating it
         # dynamically, we choose the latter option to avoid messing
         # with the cmake command line.
-        os.makedirs(outdir, exist_ok=True)
         key_overlay = os.path.join(outdir, 'mcuboot-key-file.conf')
-        overlay_contents = 'CONFIG_BOOT_SIGNATURE_KEY_FILE="{}"\n'.format(
-            self.arguments.signing_key)
+        settings = MCUBOOT_KEY_TYPES[self.arguments.key_type][1]
+        overlay_contents = ''.join(
+            line + '\n' for line in
+            ['CONFIG_BOOT_SIGNATURE_KEY_FILE="{}"'.format(
+                self.arguments.signing_key)] + settings)
         write = True
         if os.path.isfile(key_overlay):
             # Don't write to this file if it already contains the
@@ -538,32 +1335,59 @@ class Build(Command):
 
         self.cmake_build(mcuboot_source, outdir, gen_options)
 
+        # Kconfig only warns about symbols it doesn't know, so an
+        # MCUboot without support for the key type would silently
+        # build with another one.
+        with open(os.path.join(outdir, 'zephyr', '.config'), 'r') as f:
+            config = set(line.rstrip('\n') for line in f)
+        missing = [s for s in settings if s not in config]
+        if missing:
+            raise ValueError(
+                '{} keys are not supported by MCUboot in {}: {} not set'.
+                format(self.arguments.key_type, find_mcuboot_root(),
+                       ', '.join(missing)))
+
     def build_app(self, app, board):
         outdir = find_app_outdir(self.arguments.outdir, app, board)
-        gen_options = ['-DBOARD={}'.format(board)] + self.toolchain_args()
-        overlay_config = self.arguments.overlay_config
-
-        if self.arguments.conf_file:
-            gen_options.append('-DCONF_FILE={}'.format(
-                self.arguments.conf_file))
+        gen_options = self.app_gen_options(app, board)
 
+        os.makedirs(outdir, exist_ok=True)
+        with buildtree.TreeLock(outdir):
+            file_dedup.unshare(outdir)
+            self.build_app_locked(app, board, outdir, gen_options)
+
+    def build_app_locked(self, app, board, outdir, gen_options):
+        key, hit = self.cache_fetch(app, board, 'app', outdir, gen_options)
+        if not hit:
+            def build(build_dir):
+                self.build_app_tree(app, board, build_dir, gen_options)
+                self.collect_stack_usage(build_dir)
+
+            self.build_in_tree(outdir, build)
+            self.cache_store(key, outdir)
         if not self.arguments.no_bootloader:
-            overlay_config.append(os.path.join(find_sdk_build_root(),
-                                               'mcuboot-overlay.conf'))
-
-        if overlay_config:
-            gen_options.append('-DOVERLAY_CONFIG={}'.format(
-                shlex.quote(';'.join(overlay_config))))
+            self.report_size('Signed {} ({})'.format(app, board),
+                             signed_app_name(app, board, outdir, 'bin'))
 
+    def build_app_tree(self, app, board, outdir, gen_options):
         self.cmake_build(find_app_root(app), outdir, gen_options)
 
         if not self.arguments.no_bootloader:
-            self.sign_app(app, board)
+            self.sign_app(app, board, outdir)
 
-    def sign_app(self, app, board):
-        outdir = find_app_outdir(self.arguments.outdir, app, board)
+    def sign_app(self, app, board, outdir):
         for cmd_sign in self.sign_commands(app, board, outdir):
             self.check_call(cmd_sign, cwd=outdir)
+        # imgtool signs with whatever key it's given, so make sure it
+        # matches what MCUboot was built to verify.
+        info = mcuboot_image.read(signed_app_name(app, board, outdir, 'bin'))
+        expected = MCUBOOT_KEY_TYPES[self.arguments.key_type][2]
+        if info.signature_type != expected:
+            raise ValueError(
+                '{} is not a {} key (image signature type: {}); '
+                'use --key-type'.format(self.arguments.signing_key,
+                                        self.arguments.key_type,
+                                        info.signature_type))
         if self.insecure_requested:
             self.wrn('Warning: used insecure default signing key.',
                      'IMAGES ARE NOT SUITABLE FOR PRODUCTION USE.')
@@ -609,9 +1433,461 @@ class Build(Command):
 
         return cmd
 
+    def report_size(self, name, path):
+        '''Print the size of a build's image, and the sizes it had when
+        built with other key types (like in other matrix variants).'''
+        if not os.path.isfile(path):
+            return
+        size = os.path.getsize(path)
+        key_type = self.arguments.key_type
+        record = os.path.join(self.arguments.outdir, IMAGE_SIZES_FILE)
+        try:
+            previous = image_sizes.record(record, name, key_type, size)
+        except OSError as e:
+            self.wrn('Warning: recording image sizes in {} failed: {}'.
+                     format(record, e))
+            previous = {}
+
+        msg = '{}: {} bytes ({} key)'.format(name, size, key_type)
+        notes = []
+        if previous.get(key_type, size) != size:
+            notes.append('was {} bytes, {:+d}'.format(
+                previous[key_type], size - previous[key_type]))
+        for other in sorted(previous):
+            if other != key_type:
+                notes.append('{}: {} bytes, {:+d}'.format(
+                    other, previous[other], size - previous[other]))
+        if notes:
+            self.inf('{}; {}'.format(msg, '; '.join(notes)))
+        else:
+            self.dbg(msg)
+
     def version_is_semver(self, version):
         return re.match('^\d+[.]\d+[.]\d+([+]\d+)?$', version) is not None
 
+    #
+    # Scratch build directories
+    #
+
+    def build_in_tree(self, outdir, build):
+        '''Call build() with the directory to build outdir's outputs in.
+
+        Without --scratch, that's just outdir. Otherwise, it's a
+        directory in the scratch space, and the final artifacts are
+        copied back to outdir afterwards. If the scratch space is over
+        budget, fills up during the build, or copying to or from it
+        fails, outdir is used instead.'''
+        scratch = self.scratch_tree(outdir)
+        if scratch is None:
+            build(outdir)
+            return
+
+        # Lock the scratch tree before making room, so no other build
+        # evicts it in between.
+        lock = buildtree.TreeLock(scratch)
+        try:
+            os.makedirs(scratch, exist_ok=True)
+            lock.acquire()
+        except OSError as e:
+            self.wrn('Warning: cannot use scratch space {}: {}; building {} '
+                     'on disk'.format(self.scratch, e, outdir))
+            build(outdir)
+            return
+
+        try:
+            if not self.scratch_room(scratch, outdir):
+                shutil.rmtree(scratch, ignore_errors=True)
+                build(outdir)
+                return
+
+            self.dbg('Building {} in {}'.format(outdir, scratch))
+            try:
+                build(scratch)
+                self.write_back(scratch, outdir)
+                return
+            except subprocess.CalledProcessError:
+                if not self.scratch_full():
+                    raise
+                self.wrn('Warning: scratch space {} is full; building {} '
+                         'on disk'.format(self.scratch, outdir))
+            except OSError as e:
+                self.wrn('Warning: building {} in scratch space {} failed: '
+                         '{}; building on disk'.format(outdir, self.scratch,
+                                                       e))
+            shutil.rmtree(scratch, ignore_errors=True)
+            build(outdir)
+        finally:
+            lock.release()
+
+    def scratch_tree(self, outdir):
+        '''Get the scratch directory to build outdir's outputs in, or
+        None if they should be built in outdir.'''
+        if self.scratch is None:
+            return None
+
+        outdir = os.path.realpath(outdir)
+        name = '{}-{}'.format(
+            hashlib.sha256(outdir.encode('utf-8')).hexdigest()[:16],
+            os.path.basename(outdir))
+        return os.path.join(self.scratch, name)
+
+    def scratch_room(self, tree, outdir):
+        '''Make room in the scratch space for tree, which must be
+        locked. Returns False if there isn't enough.'''
+        # Evict least recently used scratch trees (their artifacts are
+        # all on disk already).
+        _, total = buildtree.collect(self.scratch, self.scratch_max_size,
+                                     keep=[tree])
+        free = shutil.disk_usage(self.scratch).free
+        if total >= self.scratch_max_size or free < SCRATCH_MIN_FREE:
+            self.wrn('Warning: scratch space {} is full ({} used, {} '
+                     'free); building {} on disk'.format(
+                         self.scratch, buildtree.format_size(total),
+                         buildtree.format_size(free), outdir))
+            return False
+        return True
+
+    def scratch_full(self):
+        return (buildtree.tree_size(self.scratch) >= self.scratch_max_size or
+                shutil.disk_usage(self.scratch).free < SCRATCH_MIN_FREE)
+
+    def write_back(self, scratch, outdir):
+        '''Copy the final artifacts in scratch to outdir.'''
+        for rel in build_artifacts(scratch):
+            src = os.path.join(scratch, rel)
+            dst = os.path.join(outdir, rel)
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            if rel == 'CMakeCache.txt':
+                copy_cmake_cache(src, dst, os.path.realpath(scratch),
+                                 os.path.realpath(outdir))
+            else:
+                shutil.copy2(src, dst)
+
+    #
+    # Build matrix
+    #
+
+    def matrix_jobs(self):
+        '''Get the list of build_matrix.MatrixJob to build.'''
+        if not self.arguments.matrix:
+            jobs = []
+            for app in self.arguments.app:
+                app = app.rstrip(os.path.sep)
+                for board in self.arguments.boards:
+                    for output in ['mcuboot', 'app']:
+                        if output in self.arguments.outputs:
+                            jobs.append(build_matrix.MatrixJob(app, board,
+                                                               output))
+            return jobs
+
+        data = build_matrix.load(self.arguments.matrix)
+        jobs = build_matrix.expand(data, self.arguments.boards,
+                                   self.arguments.outputs)
+        check_boards(sorted(set(job.board for job in jobs)))
+        return jobs
+
+    def shard_jobs(self, jobs):
+        '''Get the jobs in this run's shard.'''
+        index, count = self.shard
+        history = self.build_times.load() if self.shared_build_times else {}
+        recorded = {}
+        estimates = {}
+        for job in jobs:
+            name = str(job)
+            recorded[name] = history.get(name)
+            estimates[name] = SHARD_ESTIMATE[job.output]
+        costs = shard.estimate_costs(recorded, estimates)
+
+        unit_costs = collections.OrderedDict()
+        for job in jobs:
+            unit = '{} {}'.format(job.app, job.board)
+            unit_costs[unit] = unit_costs.get(unit, 0) + costs[str(job)]
+        shards = shard.assign(unit_costs, count)
+
+        loads = [0] * (count + 1)
+        for unit, unit_shard in shards.items():
+            loads[unit_shard] += unit_costs[unit]
+        ret = [job for job in jobs
+               if shards['{} {}'.format(job.app, job.board)] == index]
+        self.inf('Shard {}/{}: {} of {} jobs, about {:.0f} s of {:.0f} s '
+                 '(largest shard: {:.0f} s)'.format(
+                     index, count, len(ret), len(jobs), loads[index],
+                     sum(loads), max(loads)))
+        missing = sum(1 for name in recorded if recorded[name] is None)
+        if missing and self.shared_build_times:
+            self.dbg('{} jobs have no recorded build time in {}'.format(
+                missing, self.build_times.path))
+        return ret
+
+    def job_arguments(self, job):
+        '''Get the arguments to use when building a MatrixJob.'''
+        if not job.options and job.variant is None:
+            return self.arguments
+
+        # Jobs from the same variant share options, so only prepare
+        # (and warn about) each variant's arguments once.
+        ident = (id(job.options), job.variant)
+        if ident not in self.job_namespaces:
+            args = copy.copy(self.raw_arguments)
+            for option, value in job.options.items():
+                setattr(args, option, value)
+            args.outdir = job.outdir(self.raw_arguments.outdir)
+            self.prep_signing_options(args)
+            self.job_namespaces[ident] = args
+        return self.job_namespaces[ident]
+
+    @contextlib.contextmanager
+    def using_arguments(self, arguments):
+        saved = self.arguments
+        self.arguments = arguments
+        try:
+            yield
+        finally:
+            self.arguments = saved
+
+    def job_outdir(self, job):
+        outdir = job.outdir(self.raw_arguments.outdir)
+        if job.output == 'mcuboot':
+            return find_mcuboot_outdir(outdir, job.app, job.board)
+        return find_app_outdir(outdir, job.app, job.board)
+
+    def build_job(self, job):
+        self.current_job = job
+        try:
+            with self.using_arguments(self.job_arguments(job)):
+                with self.job_logging(job):
+                    if job.output == 'mcuboot':
+                        self.build_mcuboot(job.app, job.board)
+                    else:
+                        self.build_app(job.app, job.board)
+        finally:
+            self.current_job = None
+
+    @contextlib.contextmanager
+    def job_logging(self, job):
+        if not self.arguments.log_dir:
+            yield
+            return
+
+        name = '-'.join([job.app.replace(os.path.sep, '_'), job.board,
+                         job.output] +
+                        ([job.variant] if job.variant is not None else []))
+        path = os.path.join(self.arguments.log_dir, name + '.log.gz')
+        with self.logging_to(str(job), path, self.arguments.log_tail):
+            yield
+
+    def dedup_key(self, job):
+        '''Get a value which is the same for jobs doing identical builds.'''
+        with self.using_arguments(self.job_arguments(job)):
+            args = self.arguments
+            if job.output == 'mcuboot':
+                source = os.path.join(find_mcuboot_root(), 'boot', 'zephyr')
+                gen_options = self.mcuboot_gen_options(job.app, job.board)
+                signing = (args.signing_key, args.key_type)
+            else:
+                source = find_app_root(job.app)
+                gen_options = self.app_gen_options(job.app, job.board)
+                signing = (args.no_bootloader, args.signing_key,
+                           args.key_type, args.imgtool_version,
+                           args.imgtool_pad)
+
+        return (job.output, os.path.realpath(source), job.board,
+                tuple(self.option_digests(gen_options)), signing)
+
+    def option_digests(self, gen_options, relative_to=None):
+        '''Get (name, value) pairs for CMake -D options.
+
+        Options naming files (like an app's mcuboot.overlay) are
+        identified by the files' contents, not their paths. Relative
+        paths are looked up in relative_to, if given.'''
+        options = []
+        for option in gen_options:
+            name, _, value = option.partition('=')
+            paths = []
+            for token in (shlex.split(value) if value else []):
+                paths.extend(p for p in token.split(';') if p)
+            if relative_to is not None:
+                paths = [os.path.join(relative_to, p) for p in paths]
+            if paths and all(os.path.isfile(p) for p in paths):
+                value = ' '.join(artifact_cache.file_digest(p)
+                                 for p in paths)
+            options.append((name, value))
+        return options
+
+    def fan_out(self, src_job, dst_job):
+        '''Copy the results of src_job's build to dst_job's outdir.'''
+        src = self.job_outdir(src_job)
+        dst = self.job_outdir(dst_job)
+        src_signed = os.path.basename(
+            signed_app_name(src_job.app, src_job.board, src, ''))
+        dst_signed = os.path.basename(
+            signed_app_name(dst_job.app, dst_job.board, dst, ''))
+
+        os.makedirs(dst, exist_ok=True)
+        with buildtree.TreeLock(dst):
+            file_dedup.unshare(dst)
+            for rel in build_artifacts(src):
+                head, name = os.path.split(rel)
+                if name.startswith(src_signed):
+                    name = dst_signed + name[len(src_signed):]
+                dst_file = os.path.join(dst, head, name)
+                os.makedirs(os.path.dirname(dst_file), exist_ok=True)
+                if rel == 'CMakeCache.txt':
+                    old_dir = (configure_cache.cmake_binary_dir(src) or
+                               os.path.realpath(src))
+                    copy_cmake_cache(os.path.join(src, rel), dst_file,
+                                     old_dir, os.path.realpath(dst))
+                else:
+                    shutil.copy2(os.path.join(src, rel), dst_file)
+
+    #
+    # Build cache
+    #
+
+    def tree_fingerprint(self, path):
+        if path not in self.tree_fingerprints:
+            self.tree_fingerprints[path] = artifact_cache.tree_fingerprint(
+                path)
+        return self.tree_fingerprints[path]
+
+    def toolchain_fingerprint(self):
+        ret = [self.arguments.zephyr_toolchain_variant] + self.toolchain_args()
+        for var in ['ZEPHYR_TOOLCHAIN_VARIANT', 'GNUARMEMB_TOOLCHAIN_PATH',
+                    'ZEPHYR_SDK_INSTALL_DIR']:
+            ret.append('{}={}'.format(var, self.command_env.get(var, '')))
+
+        if self.arguments.prebuilt_toolchain.startswith('y'):
+            gcc_dir = os.path.join(find_arm_none_eabi_gcc(), 'bin')
+        else:
+            gcc_dir = self.command_env.get('GNUARMEMB_TOOLCHAIN_PATH')
+            gcc_dir = os.path.join(gcc_dir, 'bin') if gcc_dir else None
+        gcc = os.path.join(gcc_dir, 'arm-none-eabi-gcc') if gcc_dir else None
+        if gcc and os.path.isfile(gcc):
+            ret.append(subprocess.check_output([gcc, '--version']).decode(
+                sys.getdefaultencoding()))
+
+        return '\n'.join(ret)
+
+    def cache_key(self, app, board, output, gen_options):
+        '''Compute the cache key for an app or mcuboot build.'''
+        app_root = find_app_root(app)
+        fingerprint = artifact_cache.Fingerprint()
+        fingerprint.add('output', output)
+        fingerprint.add('board', board)
+        fingerprint.add('generator', self.arguments.generator)
+        fingerprint.add('gen_options', '\n'.join(CMAKE_OPTIONS + gen_options))
+        fingerprint.add('toolchain', self.toolchain_fingerprint())
+        fingerprint.add('zephyr', self.tree_fingerprint(
+            self.command_env['ZEPHYR_BASE']))
+        fingerprint.add('mcuboot', self.tree_fingerprint(find_mcuboot_root()))
+        # A cached CMakeCache.txt holds absolute paths to the sources
+        # and toolchain; cache_fetch() can only fix up the build
+        # directory, so entries are only shared between trees checked
+        # out at the same place.
+        for name, path in (('zmp_root', find_zmp_root()),
+                           ('zephyr_base', self.command_env['ZEPHYR_BASE']),
+                           ('app_root', app_root)):
+            fingerprint.add(name, os.path.realpath(path))
+
+        if output == 'app':
+            # The app's name is part of the signed image file names.
+            fingerprint.add('app_name', os.path.basename(app))
+            fingerprint.add('app', self.tree_fingerprint(app_root))
+            conf_files = []
+            if self.arguments.conf_file:
+                conf_files.extend(self.arguments.conf_file.split())
+            conf_files.extend(self.app_overlay_config())
+            for conf in conf_files:
+                fingerprint.add_file('conf', os.path.join(app_root, conf))
+        else:
+            fingerprint.add_file('mcuboot.overlay',
+                                 os.path.join(app_root, 'mcuboot.overlay'))
+
+        if not self.arguments.no_bootloader:
+            fingerprint.add_file('signing_key', self.arguments.signing_key)
+            fingerprint.add('key_type', self.arguments.key_type)
+            fingerprint.add_file('imgtool', os.path.join(find_mcuboot_root(),
+                                                         MCUBOOT_IMGTOOL))
+            fingerprint.add('imgtool_version', self.arguments.imgtool_version)
+            fingerprint.add('imgtool_pad', str(self.arguments.imgtool_pad))
+
+        return fingerprint.hexdigest()
+
+    def configure_key(self, sourcedir, outdir, gen_options):
+        '''Compute the configure cache key for a CMake build directory.'''
+        if self.cmake_version is None:
+            self.cmake_version = self.check_output_enc(['cmake', '--version'])
+
+        fingerprint = artifact_cache.Fingerprint()
+        fingerprint.add('generator', self.arguments.generator)
+        fingerprint.add('cmake', self.cmake_version)
+        fingerprint.add('gen_options', '\n'.join(CMAKE_OPTIONS + gen_options))
+        for name, value in self.option_digests(gen_options,
+                                               relative_to=sourcedir):
+            fingerprint.add('option ' + name, value)
+        fingerprint.add('toolchain', self.toolchain_fingerprint())
+        fingerprint.add('source', os.path.realpath(sourcedir))
+        fingerprint.add('source_tree', self.tree_fingerprint(sourcedir))
+        zephyr_base = self.command_env['ZEPHYR_BASE']
+        fingerprint.add('zephyr', zephyr_base)
+        fingerprint.add('zephyr_tree', self.tree_fingerprint(zephyr_base))
+        fingerprint.add('mcuboot_tree',
+                        self.tree_fingerprint(find_mcuboot_root()))
+
+        # Configuration fragments generated into the build directory
+        # before configuring (like MCUboot's key file setting).
+        for name in sorted(os.listdir(outdir)):
+            if name.endswith('.conf'):
+                fingerprint.add_file(name, os.path.join(outdir, name))
+
+        return fingerprint.hexdigest()
+
+    def cache_fetch(self, app, board, output, outdir, gen_options):
+        '''Try to fetch a build's outputs from the cache into outdir.
+
+        Returns a (key, hit) tuple. The key is None if no cache is in
+        use; hit is True if the outputs were fetched.'''
+        if self.cache is None:
+            return None, False
+
+        key = self.cache_key(app, board, output, gen_options)
+        try:
+            files = artifact_cache.fetch(self.cache, key, outdir)
+        except (OSError, EOFError, tarfile.TarError) as e:
+            self.wrn('Warning: fetching {} from {} failed: {}'.format(
+                key, self.cache, e))
+            return key, False
+
+        if files is None:
+            self.dbg('Cache miss for {} {} ({}): {}'.format(
+                app, output, board, key))
+            return key, False
+
+        # The cache entry's CMakeCache.txt points at the directory it
+        # was built in. Everything else in it is the same here, since
+        # the source roots are part of the key.
+        if 'CMakeCache.txt' in files:
+            old_dir = configure_cache.cmake_binary_dir(outdir)
+            new_dir = os.path.realpath(outdir)
+            if old_dir is not None and old_dir != new_dir:
+                cache_file = os.path.join(outdir, 'CMakeCache.txt')
+                copy_cmake_cache(cache_file, cache_file, old_dir, new_dir)
+
+        self.inf('Fetched {} {} ({}) from cache'.format(app, output, board))
+        return key, True
+
+    def cache_store(self, key, outdir):
+        '''Store the outputs in outdir as the cache entry for key.'''
+        if key is None or self.arguments.cache_read_only:
+            return
+
+        try:
+            artifact_cache.store(self.cache, key, outdir,
+                                 build_artifacts(outdir))
+        except OSError as e:
+            self.wrn('Warning: storing {} in {} failed: {}'.format(
+                key, self.cache, e))
+
 
 #
 # Clean, Pristine
@@ -642,12 +1918,20 @@ class CleanPristine:
                             action='append', help=HELP['--board'])
         parser.add_argument('-O', '--outdir', default=find_default_outdir(),
                             help=HELP['--outdir'])
-        parser.add_argument('app', nargs='+', help=HELP['app'])
+        parser.add_argument('app', nargs='*', help=HELP['app'])
+        parser.add_argument('--all-apps', action='store_true',
+                            help=HELP['--all-apps'].format(
+                                'Run {} for'.format(self.target),
+                                app_index.IGNORE_FILE))
         parser.add_argument('-o', '--outputs', choices=BUILD_OUTPUTS + ['all'],
                             default='all',
                             help=HELP['--outputs'].format('build'))
 
     def do_prep_for_run(self):
+        if not self.arguments.app and not self.arguments.all_apps:
+            raise ValueError('give apps or --all-apps')
+        self.arguments.app = find_apps(self.arguments.app,
+                                       self.arguments.all_apps)
         check_boards(self.arguments.boards)
         check_dependencies(['cmake'])
 
@@ -657,11 +1941,9 @@ class CleanPristine:
             app = app.rstrip(os.path.sep)
             for board in self.arguments.boards:
                 if 'mcuboot' in self.arguments.outputs:
-                    outdir = find_mcuboot_outdir(outdir, app, board)
-                    self.cmake_clean(outdir)
+                    self.cmake_clean(find_mcuboot_outdir(outdir, app, board))
                 if 'app' in self.arguments.outputs:
-                    outdir = find_app_outdir(self.arguments.outdir, app, board)
-                    self.cmake_clean(outdir)
+                    self.cmake_clean(find_app_outdir(outdir, app, board))
 
     def cmake_clean(self, outdir):
         if not os.path.isdir(outdir):
@@ -675,7 +1957,9 @@ class CleanPristine:
                       '--build', shlex.quote(outdir),
                       '--',
                       shlex.quote(self.target)])
-        self.check_call(cmd_clean, cwd=outdir)
+        with buildtree.TreeLock(outdir):
+            file_dedup.unshare(outdir)
+            self.check_call(cmd_clean, cwd=outdir)
 
 
 class Clean(CleanPristine, Command):
@@ -727,25 +2011,78 @@ class Configure(Command):
             choices=CONFIGURATORS,
             default=default,
             help='''Configure front-end (default: {})'''.format(default))
+        parser.add_argument('--set', dest='settings', default=[],
+                            action='append', metavar='CONFIG_X=VALUE',
+                            help='''Set a Kconfig symbol in the .config file
+                            of every selected build directory, instead of
+                            running the configure front-end. This may be
+                            given multiple times.''')
+        parser.add_argument('--unset', dest='unsettings', default=[],
+                            action='append', metavar='CONFIG_X',
+                            help='''Like --set, but turn a bool symbol
+                            off.''')
+
+    def do_prep_for_run(self):
+        self.config_changes = collections.OrderedDict()
+        for setting in self.arguments.settings:
+            name, value = dotconfig.parse_setting(setting)
+            self.config_changes[name] = value
+        for name in self.arguments.unsettings:
+            dotconfig.check_name(name)
+            if name in self.config_changes:
+                raise ValueError('{} is both set and unset'.format(name))
+            self.config_changes[name] = None
 
     def do_invoke(self):
-        mcuboot = find_mcuboot_root()
+        if self.config_changes:
+            self.edit_configs()
+            return
 
+        mcuboot = find_mcuboot_root()
         for board in self.arguments.boards:
             app = self.arguments.app
             source_dirs = {'app': find_app_root(app), 'mcuboot': mcuboot}
             for output in self.arguments.outputs:
                 self.do_configure(board, app, output, source_dirs[output])
 
-    def do_configure(self, board, app, output, source_dir):
+    def config_outdir(self, board, app, output):
         if output == 'app':
-            outdir = find_app_outdir(self.arguments.outdir, app, board)
-        else:
-            outdir = find_mcuboot_outdir(self.arguments.outdir, app, board)
+            return find_app_outdir(self.arguments.outdir, app, board)
+        return find_mcuboot_outdir(self.arguments.outdir, app, board)
+
+    def edit_configs(self):
+        outdirs = [self.config_outdir(board, self.arguments.app, output)
+                   for board in self.arguments.boards
+                   for output in self.arguments.outputs]
+        # Check them all first, so nothing is half done.
+        missing = [outdir for outdir in outdirs
+                   if not os.path.isfile(os.path.join(outdir, 'zephyr',
+                                                      '.config'))]
+        if missing:
+            raise RuntimeError('no .config in {}; build first'.format(
+                ', '.join(missing)))
+
+        for outdir in outdirs:
+            with buildtree.TreeLock(outdir):
+                file_dedup.unshare(outdir)
+                changed, unknown = dotconfig.edit(
+                    os.path.join(outdir, 'zephyr', '.config'),
+                    self.config_changes)
+            if unknown:
+                self.wrn('Warning: {}: {} not in .config; it may not exist '
+                         'or have unmet dependencies'.format(
+                             outdir, ', '.join(unknown)))
+            self.inf('{}: {}'.format(outdir, 'updated' if changed
+                                     else 'already up to date'))
+
+    def do_configure(self, board, app, output, source_dir):
+        outdir = self.config_outdir(board, app, output)
         cmd_configure = ['cmake',
                          '--build', shlex.quote(outdir),
                          '--target', self.arguments.configurator]
-        self.check_call(cmd_configure)
+        with buildtree.TreeLock(outdir):
+            file_dedup.unshare(outdir)
+            self.check_call(cmd_configure)
 
 
 #
@@ -756,7 +2093,15 @@ class Configure(Command):
 class Flash(Command):
 
     def __init__(self, *args, **kwargs):
+        # west_runner is called with west's arguments to flash; it
+        # defaults to check_west_call(). broker is the
+        # flash_broker.FlashBroker which queues flashes by board ID.
+        west_runner = kwargs.pop('west_runner', None)
+        broker = kwargs.pop('broker', None)
         super(Flash, self).__init__(*args, **kwargs)
+        self.west_runner = west_runner or self.check_west_call
+        self.broker = broker or flash_broker.FlashBroker(
+            on_wait=self.waiting_for_board)
 
     @property
     def command_name(self):
@@ -781,11 +2126,27 @@ class Flash(Command):
                             default=[], action='append',
                             help='''If given, specifies a --board-id
                             argument to the underlying flash runner''')
+        parser.add_argument('--merged', action='store_true',
+                            help='''Merge MCUboot and the signed
+                            application into one hex file, and flash it
+                            with a single runner call instead of one
+                            call for each. Requires "-o all".''')
+        parser.add_argument('--history', metavar='FILE',
+                            default=flash_history.default_path(),
+                            help='''File to record flash times and image
+                            sizes in, for 'zmp flash-stats' (default: the
+                            ZMP_FLASH_HISTORY environment variable if set,
+                            or {}). An empty value disables it.'''.format(
+                                flash_history.default_path()))
 
     def do_prep_for_run(self):
         if self.arguments.board_ids and len(self.arguments.boards) > 1:
             raise ValueError('only one board target may be used when '
                              'specifying --board-id')
+        if self.arguments.merged and self.arguments.outputs != 'all':
+            raise ValueError('--merged flashes both MCUboot and the app; '
+                             'it cannot be used with -o {}'.format(
+                                 self.arguments.outputs))
 
         self.arguments.app = self.arguments.app.strip(os.path.sep)
 
@@ -794,26 +2155,70 @@ class Flash(Command):
         app = self.arguments.app
 
         for board in self.arguments.boards:
-            if self.arguments.board_ids:
-                for board_id in self.arguments.board_ids:
-                    self.west_flash(outdir, app, board, board_id=board_id)
+            if len(self.arguments.board_ids) > 1:
+                # Each board ID is a different probe, so they can all
+                # be flashed at once.
+                with concurrent.futures.ThreadPoolExecutor(
+                        max_workers=len(self.arguments.board_ids)) as ex:
+                    futures = [ex.submit(self.west_flash, outdir, app, board,
+                                         board_id=board_id)
+                               for board_id in self.arguments.board_ids]
+                    for future in futures:
+                        future.result()
+            elif self.arguments.board_ids:
+                self.west_flash(outdir, app, board,
+                                board_id=self.arguments.board_ids[0])
             else:
                 self.west_flash(outdir, app, board)
 
     def west_flash(self, outdir, app, board, board_id=None):
+        # Without a board ID, the runner uses whichever probe for the
+        # board it finds, so queue by board name instead.
+        queue = board_id if board_id is not None else 'board-' + board
+        self.broker.submit(queue, self.west_flash_tree, outdir, app, board,
+                           board_id)
+
+    def west_flash_tree(self, outdir, app, board, board_id):
+        # Flashing only reads the build directory, so other probes can
+        # be flashed from it at the same time.
         app_outdir = find_app_outdir(outdir, app, board)
+        with buildtree.TreeLock(app_outdir, shared=True):
+            self.west_flash_locked(outdir, app, board, app_outdir, board_id)
+
+    def waiting_for_board(self, queue, ahead):
+        self.inf('Waiting for {}: {} flash request{} ahead'.format(
+            queue, ahead, 's' if ahead > 1 else ''), flush=True)
+
+    def west_flash_locked(self, outdir, app, board, app_outdir, board_id):
         bcfg = BuildConfiguration(app_outdir)
 
-        west_args = ['flash']
+        # Only flash what was built: the build directory is only
+        # locked for reading, and may share files with other trees
+        # (see 'zmp dedup'), so a rebuild mustn't write to it.
+        west_args = ['flash', '--skip-rebuild']
         if board_id is not None:
             west_args.extend(['--board-id', board_id])
 
         bootloader_mcuboot = bool(bcfg.get('CONFIG_BOOTLOADER_MCUBOOT'))
+        if self.arguments.merged and bootloader_mcuboot:
+            mcuboot_outdir = find_mcuboot_outdir(outdir, app, board)
+            with buildtree.TreeLock(mcuboot_outdir, shared=True):
+                merged_hex = self.merge_images(app, board, app_outdir,
+                                               mcuboot_outdir, bcfg)
+            args_extra = ['--build-dir', app_outdir,
+                          '--kernel-hex', merged_hex]
+            self.timed_flash(west_args + args_extra, board, board_id,
+                             'merged', app_outdir, merged_hex)
+            return
+
         if 'mcuboot' in self.arguments.outputs:
             if bootloader_mcuboot:
                 mcuboot_outdir = find_mcuboot_outdir(outdir, app, board)
                 args_extra = ['--build-dir', mcuboot_outdir]
-                self.check_west_call(west_args + args_extra)
+                with buildtree.TreeLock(mcuboot_outdir, shared=True):
+                    self.timed_flash(west_args + args_extra, board,
+                                     board_id, 'mcuboot', mcuboot_outdir,
+                                     zephyr_image(mcuboot_outdir))
             else:
                 msg = (
                     'Warning:\n'
@@ -824,14 +2229,1207 @@ class Flash(Command):
 
         if 'app' in self.arguments.outputs:
             args_extra = ['--build-dir', app_outdir]
+            image = zephyr_image(app_outdir)
             if bootloader_mcuboot:
                 signed_bin = signed_app_name(app, board, app_outdir, 'bin')
                 signed_hex = signed_app_name(app, board, app_outdir, 'hex')
+                # The hex (if any) is signed along with the bin, so
+                # checking the bin is enough to catch a bad image
+                # before touching the device.
+                if os.path.isfile(signed_bin):
+                    mcuboot_image.check(
+                        signed_bin,
+                        slot_size=bcfg.get('FLASH_AREA_IMAGE_0_SIZE'))
                 # Prefer hex to bin. (Some of the runners that take a hex don't
                 # understand --dt-flash for a bin yet).
                 if os.path.isfile(signed_hex):
                     args_extra.extend(['--kernel-hex', signed_hex])
+                    image = signed_hex
                 elif os.path.isfile(signed_bin):
                     args_extra.extend(['--dt-flash=y',
                                       '--kernel-bin', signed_bin])
-            self.check_west_call(west_args + args_extra)
+                    image = signed_bin
+            self.timed_flash(west_args + args_extra, board, board_id, 'app',
+                             app_outdir, image)
+
+    def timed_flash(self, west_args, board, board_id, output, build_dir,
+                    image):
+        # Run west, recording how long flashing image took.
+        size = flash_history.image_size(image)
+        runner = cmake_cache_value(build_dir, 'ZEPHYR_BOARD_FLASH_RUNNER')
+        start = time.monotonic()
+        ok = False
+        try:
+            self.west_runner(west_args)
+            ok = True
+        finally:
+            seconds = time.monotonic() - start
+            if self.arguments.history:
+                try:
+                    flash_history.record(self.arguments.history, board,
+                                         board_id, output, runner or None,
+                                         size, seconds, ok)
+                except OSError as e:
+                    self.wrn('Warning: recording flash time in {} failed: '
+                             '{}'.format(self.arguments.history, e))
+        if size and seconds:
+            self.dbg('Flashed {} ({}) to {} in {:.1f} s, {}/s'.format(
+                output, buildtree.format_size(size), board_id or board,
+                seconds, buildtree.format_size(int(size / seconds))))
+
+    def merge_images(self, app, board, app_outdir, mcuboot_outdir, bcfg):
+        # Returns a hex file with both MCUboot and the signed app,
+        # regenerating it if it's older than either of them.
+        mcuboot_hex = os.path.join(mcuboot_outdir, 'zephyr', 'zephyr.hex')
+        signed_bin = signed_app_name(app, board, app_outdir, 'bin')
+        signed_hex = signed_app_name(app, board, app_outdir, 'hex')
+        merged_hex = merged_app_name(app, board, app_outdir)
+
+        if os.path.isfile(signed_bin):
+            mcuboot_image.check(signed_bin,
+                                slot_size=bcfg.get('FLASH_AREA_IMAGE_0_SIZE'))
+        signed = signed_hex if os.path.isfile(signed_hex) else signed_bin
+        for path in (mcuboot_hex, signed):
+            if not os.path.isfile(path):
+                raise FileNotFoundError(
+                    'cannot merge images: {} is missing'.format(path))
+
+        if os.path.isfile(merged_hex):
+            merged_mtime = os.path.getmtime(merged_hex)
+            if all(os.path.getmtime(path) <= merged_mtime
+                   for path in (mcuboot_hex, signed)):
+                return merged_hex
+
+        image = intel_hex.read(mcuboot_hex)
+        if signed == signed_hex:
+            app_image = intel_hex.read(signed_hex)
+        else:
+            # Without a signed hex, the bin goes at the start of slot 0.
+            address = (int(bcfg.get('CONFIG_FLASH_BASE_ADDRESS', 0)) +
+                       int(bcfg['FLASH_AREA_IMAGE_0_OFFSET']))
+            app_image = intel_hex.read_bin(signed_bin, address)
+        # Boot through MCUboot, not straight into the app.
+        app_image.start = None
+        image.merge(app_image, what=signed)
+
+        # Other probes may be flashing from this build directory at the
+        # same time, so never leave a partly written file in place.
+        tmp = '{}.{}.{}'.format(merged_hex, os.getpid(),
+                                threading.get_ident())
+        try:
+            intel_hex.write(image, tmp)
+            os.replace(tmp, merged_hex)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        self.dbg('Merged {} and {} into {}'.format(mcuboot_hex, signed,
+                                                   merged_hex))
+        return merged_hex
+
+
+class FlashStats(Command):
+
+    def __init__(self, *args, **kwargs):
+        super(FlashStats, self).__init__(*args, **kwargs)
+
+    @property
+    def command_name(self):
+        return 'flash-stats'
+
+    @property
+    def command_help(self):
+        return 'show flash rates by board ID, from the flash history'
+
+    def do_register(self, parser):
+        parser.add_argument('--history', metavar='FILE',
+                            default=flash_history.default_path(),
+                            help='''Flash history file (default: {}).'''.
+                            format(flash_history.default_path()))
+        parser.add_argument('--board-id', dest='board_ids', default=[],
+                            action='append',
+                            help='''Only show this board ID (or board name,
+                            for flashes without a board ID). This may be
+                            given multiple times.''')
+        parser.add_argument('--recent', type=int,
+                            default=flash_history.RECENT_RUNS, metavar='N',
+                            help='''Compare the N most recent flashes with
+                            the older ones (default: {}).'''.format(
+                                flash_history.RECENT_RUNS))
+        parser.add_argument('--json', action='store_true',
+                            help='''Print the results as JSON.''')
+
+    def do_prep_for_run(self):
+        if self.arguments.recent < 1:
+            raise ValueError('--recent must be at least 1')
+
+    def do_invoke(self):
+        entries = flash_history.read(self.arguments.history)
+        rows = flash_history.summarize(entries, recent=self.arguments.recent)
+        if self.arguments.board_ids:
+            rows = [row for row in rows
+                    if row['probe'] in self.arguments.board_ids]
+
+        if self.arguments.json:
+            self.inf(json.dumps(rows, indent=2, sort_keys=True))
+            return
+        if not rows:
+            self.inf('No flashes recorded in {}'.format(
+                self.arguments.history))
+            return
+
+        def rate(value):
+            if value is None:
+                return '-'
+            return '{}/s'.format(buildtree.format_size(int(value)))
+
+        table = [('PROBE', 'OUTPUT', 'RUNNER', 'RUNS', 'FAILED', 'TIME',
+                  'RATE', 'LAST', 'TREND')]
+        for row in rows:
+            trend = ('-' if row['trend'] is None else
+                     '{:+.0f}%'.format(row['trend'] * 100))
+            table.append((
+                row['probe'] or '-', row['output'] or '-',
+                row['runner'] or '-', str(row['runs']),
+                str(row['failures']),
+                '-' if row['seconds'] is None else
+                '{:.1f} s'.format(row['seconds']),
+                rate(row['rate']), rate(row['last_rate']), trend))
+        widths = [max(len(row[i]) for row in table)
+                  for i in range(len(table[0]))]
+        for row in table:
+            self.inf('  '.join(col.ljust(width)
+                               for col, width in zip(row, widths)).rstrip())
+
+
+#
+# Deduplication
+#
+
+class Dedup(Command):
+
+    def __init__(self, *args, **kwargs):
+        super(Dedup, self).__init__(*args, **kwargs)
+
+    @property
+    def command_name(self):
+        return 'dedup'
+
+    @property
+    def command_help(self):
+        return 'share identical files between build directories'
+
+    def do_register(self, parser):
+        parser.add_argument('-O', '--outdir', default=find_default_outdir(),
+                            help=HELP['--outdir'])
+        parser.add_argument('--min-size', default='4K', metavar='SIZE',
+                            help='''Leave files smaller than SIZE alone
+                            (default: 4K).''')
+        parser.add_argument('--hardlink', action='store_true',
+                            help='''Where the file system can't make
+                            reflinks (copy-on-write clones), replace
+                            identical files with read-only hardlinks
+                            instead. zmp gives a build directory its own
+                            copies again before building in it.''')
+        parser.add_argument('-n', '--dry-run', action='store_true',
+                            help='''Only print how much space could be
+                            reclaimed.''')
+
+    def do_prep_for_run(self):
+        self.min_size = buildtree.parse_size(self.arguments.min_size)
+        if not os.path.isdir(self.arguments.outdir):
+            raise RuntimeError('build directory {} does not exist'.format(
+                self.arguments.outdir))
+
+    def do_invoke(self):
+        with contextlib.ExitStack() as stack:
+            trees = []
+            for tree in buildtree.find_trees(self.arguments.outdir):
+                lock = buildtree.TreeLock(tree, blocking=False, touch=False)
+                if not lock.acquire():
+                    self.inf('Skipping {}: in use'.format(
+                        os.path.relpath(tree, self.arguments.outdir)))
+                    continue
+                stack.callback(lock.release)
+                trees.append(tree)
+
+            result = file_dedup.dedup(trees, min_size=self.min_size,
+                                      hardlink=self.arguments.hardlink,
+                                      dry_run=self.arguments.dry_run)
+
+        for path, error in result.errors:
+            self.wrn('Warning: could not share {}: {}'.format(path, error))
+        if self.arguments.dry_run:
+            self.inf('Would share {} files in {} build directories, '
+                     'reclaiming {}'.format(
+                         result.files, len(trees),
+                         buildtree.format_size(result.reclaimed)))
+            return
+        self.inf('Shared {} files in {} build directories ({} reflinked, '
+                 '{} hardlinked), reclaiming {}'.format(
+                     result.files, len(trees), result.reflinked,
+                     result.hardlinked,
+                     buildtree.format_size(result.reclaimed)))
+        if result.unsupported:
+            self.wrn('Warning: {} identical files were left alone, as the '
+                     'file system does not support reflinks; see '
+                     '--hardlink'.format(result.unsupported))
+
+
+#
+# Garbage collection
+#
+
+class Gc(Command):
+
+    def __init__(self, *args, **kwargs):
+        super(Gc, self).__init__(*args, **kwargs)
+
+    @property
+    def command_name(self):
+        return 'gc'
+
+    @property
+    def command_help(self):
+        return 'delete least recently used build directories'
+
+    def do_register(self, parser):
+        parser.add_argument('-O', '--outdir', default=find_default_outdir(),
+                            help=HELP['--outdir'])
+        parser.add_argument('--max-size', required=True,
+                            help=HELP['--max-size'])
+        parser.add_argument('-n', '--dry-run', action='store_true',
+                            help='''Only print what would be deleted.''')
+
+    def do_prep_for_run(self):
+        self.max_size = buildtree.parse_size(self.arguments.max_size)
+        if not os.path.isdir(self.arguments.outdir):
+            raise RuntimeError('build directory {} does not exist'.format(
+                self.arguments.outdir))
+
+    def do_invoke(self):
+        evicted, total = buildtree.collect(self.arguments.outdir,
+                                           self.max_size,
+                                           dry_run=self.arguments.dry_run)
+        verb = 'Would delete' if self.arguments.dry_run else 'Deleted'
+        for tree, size, used in evicted:
+            self.inf('{} {} ({}, last used {})'.format(
+                verb, os.path.relpath(tree, self.arguments.outdir),
+                buildtree.format_size(size), buildtree.format_time(used)))
+
+        freed = sum(size for _, size, _ in evicted)
+        self.inf('{} {}; {} remaining'.format(
+            'Would free' if self.arguments.dry_run else 'Freed',
+            buildtree.format_size(freed), buildtree.format_size(total)))
+        if total > self.max_size:
+            self.wrn('Warning: {} is still over budget; the remaining '
+                     'build directories are in use'.format(
+                         self.arguments.outdir))
+
+
+#
+# Status
+#
+
+class Status(Command):
+
+    def __init__(self, *args, **kwargs):
+        super(Status, self).__init__(*args, **kwargs)
+
+    @property
+    def command_name(self):
+        return 'status'
+
+    @property
+    def command_help(self):
+        return 'show which build directories are out of date'
+
+    def do_register(self, parser):
+        parser.add_argument('-b', '--board', dest='boards', default=[],
+                            action='append',
+                            help='''Zephyr board to report on (default: all
+                            boards). This may be given multiple times.''')
+        parser.add_argument('-O', '--outdir', default=find_default_outdir(),
+                            help=HELP['--outdir'])
+        parser.add_argument('-o', '--outputs', choices=BUILD_OUTPUTS + ['all'],
+                            default='all',
+                            help=HELP['--outputs'].format('report on'))
+        parser.add_argument('app', nargs='*',
+                            help='''application(s) to report on, which may
+                            contain wildcards (default: every build
+                            directory in the output directory)''')
+        parser.add_argument('--all-apps', action='store_true',
+                            help=HELP['--all-apps'].format(
+                                'Report on the build directories of',
+                                app_index.IGNORE_FILE))
+
+    def do_prep_for_run(self):
+        # Remember whether boards were given before they're defaulted.
+        self.board_filter = list(self.arguments.boards)
+        if self.arguments.all_apps:
+            # Only report on the build directories that exist.
+            self.app_filter = set(find_apps(self.arguments.app, True))
+        else:
+            self.app_filter = None
+            self.arguments.app = find_apps(self.arguments.app)
+
+    def do_invoke(self):
+        stat_cache = ninja_files.StatCache()
+        rows = []
+        for app, board, output, tree in self.status_trees():
+            if os.path.isdir(tree):
+                status = ninja_files.tree_status(tree, stat_cache=stat_cache)
+            else:
+                status = ninja_files.TreeStatus(ninja_files.UNCONFIGURED,
+                                                'no build directory')
+            rows.append((status.state, app, board, output, status.reason))
+
+        if not rows:
+            self.inf('No build directories in {}'.format(
+                self.arguments.outdir))
+            return
+
+        widths = [max(len(row[i]) for row in rows) for i in range(4)]
+        for row in rows:
+            cols = [col.ljust(width) for col, width in zip(row, widths)]
+            self.inf('  '.join(cols + [row[4]]).rstrip())
+
+    def status_trees(self):
+        '''Get (app, board, output, build directory) tuples to check.'''
+        outdir = self.arguments.outdir
+        outputs = self.arguments.outputs
+
+        if self.arguments.app and self.board_filter:
+            ret = []
+            for app in self.arguments.app:
+                app = app.rstrip(os.path.sep)
+                for board in self.board_filter:
+                    if 'mcuboot' in outputs:
+                        ret.append((app, board, 'mcuboot',
+                                    find_mcuboot_outdir(outdir, app, board)))
+                    if 'app' in outputs:
+                        ret.append((app, board, 'app',
+                                    find_app_outdir(outdir, app, board)))
+            return ret
+        elif self.arguments.app:
+            # Every board the apps have build directories for.
+            ret = []
+            for app in self.arguments.app:
+                app = app.rstrip(os.path.sep)
+                for tree in buildtree.find_trees(os.path.join(outdir, app)):
+                    parsed = parse_outdir(outdir, tree)
+                    # Skip the trees of apps under this one.
+                    if parsed is None or parsed[0] != app:
+                        continue
+                    if parsed[2] in outputs:
+                        ret.append(parsed + (tree,))
+            return ret
+
+        # Build directories are laid out as <app>/<board>/<output>,
+        # where the app may contain slashes.
+        ret = []
+        for tree in buildtree.find_trees(outdir):
+            parsed = parse_outdir(outdir, tree)
+            if parsed is None:
+                continue
+            app, board, output = parsed
+            if self.board_filter and board not in self.board_filter:
+                continue
+            if self.app_filter is not None and app not in self.app_filter:
+                continue
+            if output in outputs:
+                ret.append((app, board, output, tree))
+        return ret
+
+
+#
+# Image information
+#
+
+class ImageInfo(Command):
+
+    def __init__(self, *args, **kwargs):
+        super(ImageInfo, self).__init__(*args, **kwargs)
+
+    @property
+    def command_name(self):
+        return 'image-info'
+
+    @property
+    def command_help(self):
+        return 'show information about signed images'
+
+    def do_register(self, parser):
+        parser.add_argument('--slot-size', type=lambda s: int(s, 0),
+                            help='''Image slot size to check the images
+                            against. By default, this is read from each
+                            image's build directory, if it has one.''')
+        parser.add_argument('--verify', action='store_true',
+                            help='''Also check each image's hash.''')
+        parser.add_argument('--json', action='store_true',
+                            help='''Print the results as JSON.''')
+        parser.add_argument('paths', nargs='+', metavar='path',
+                            help='''signed image, or directory to search
+                            for *-signed.bin images''')
+
+    def do_invoke(self):
+        self.slot_sizes = {}
+        results = []
+        bad = []
+        for path in self.image_paths():
+            try:
+                info = mcuboot_image.read(path, verify=self.arguments.verify)
+            except (OSError, mcuboot_image.ImageError) as e:
+                bad.append(path)
+                results.append({'path': path, 'error': str(e)})
+                continue
+            result = info.as_dict()
+            slot_size = self.slot_size(path)
+            result['slot_size'] = slot_size
+            result['slot_free'] = (info.slot_free(slot_size)
+                                   if slot_size is not None else None)
+            if (result['slot_free'] is not None and
+                    result['slot_free'] < 0) or info.hash_ok is False:
+                bad.append(path)
+            results.append(result)
+
+        if self.arguments.json:
+            self.inf(json.dumps(results, indent=2, sort_keys=True))
+        else:
+            for result in results:
+                self.inf(self.format_result(result))
+
+        if bad:
+            raise mcuboot_image.ImageError(
+                '{} of {} images are invalid or do not fit'.format(
+                    len(bad), len(results)))
+
+    def image_paths(self):
+        ret = []
+        for path in self.arguments.paths:
+            if os.path.isdir(path):
+                ret.extend(sorted(glob.glob(os.path.join(path, '**',
+                                                         '*-signed.bin'),
+                                            recursive=True)))
+            else:
+                ret.append(path)
+        return ret
+
+    def slot_size(self, path):
+        if self.arguments.slot_size is not None:
+            return self.arguments.slot_size
+
+        # Images made by 'zmp build' are in <build directory>/zephyr.
+        tree = os.path.dirname(os.path.dirname(os.path.abspath(path)))
+        if tree not in self.slot_sizes:
+            size = None
+            if os.path.isfile(os.path.join(tree, 'CMakeCache.txt')):
+                size = BuildConfiguration(tree).get('FLASH_AREA_IMAGE_0_SIZE')
+            self.slot_sizes[tree] = size
+        return self.slot_sizes[tree]
+
+    def format_result(self, result):
+        if 'error' in result:
+            return '{}: ERROR: {}'.format(result['path'], result['error'])
+
+        if result['slot_free'] is None:
+            fit = 'slot size unknown'
+        elif result['slot_free'] < 0:
+            fit = 'DOES NOT FIT slot ({} B over)'.format(-result['slot_free'])
+        else:
+            fit = '{} B free in slot'.format(result['slot_free'])
+        hash_desc = '{} {}'.format(result['hash_type'],
+                                   (result['hash'] or '')[:16])
+        if result['hash_ok'] is not None:
+            hash_desc += ' (OK)' if result['hash_ok'] else ' (MISMATCH)'
+
+        return '{}: version {}, header {} B, {} B total, {}, {}, {}'.format(
+            result['path'], result['version'], result['hdr_size'],
+            result['total_size'], fit, hash_desc,
+            result['signature_type'] or 'unsigned')
+
+
+#
+# Delta images
+#
+
+class Delta(Command):
+
+    def __init__(self, *args, **kwargs):
+        super(Delta, self).__init__(*args, **kwargs)
+
+    @property
+    def command_name(self):
+        return 'delta'
+
+    @property
+    def command_help(self):
+        return 'make binary delta images for over-the-air updates'
+
+    def do_register(self, parser):
+        parser.add_argument('--from', dest='from_image', metavar='OLD',
+                            help='''Signed image devices are running now.''')
+        parser.add_argument('--to', dest='to_image', metavar='NEW',
+                            help='''Signed image to update them to.''')
+        parser.add_argument('--output', metavar='FILE',
+                            help='''Where to write the delta made with --from
+                            and --to (default: NEW, with .bin replaced by
+                            .delta).''')
+        parser.add_argument('--from-bundle', metavar='DIR',
+                            help='''Directory holding the signed images of a
+                            previous release, as named by 'zmp build'
+                            (<app>-<board>-signed.bin). A delta is made
+                            from each one to the image of the same name in
+                            the output directory, and written next to the
+                            new image.''')
+        parser.add_argument('-b', '--board', dest='boards', default=[],
+                            action='append',
+                            help='''With --from-bundle, Zephyr board to make
+                            deltas for (default: all boards). This may be
+                            given multiple times.''')
+        parser.add_argument('-O', '--outdir', default=find_default_outdir(),
+                            help=HELP['--outdir'])
+        parser.add_argument('--block-size', type=int,
+                            default=delta_image.BLOCK_SIZE_DEFAULT,
+                            help='''Size of the blocks matched between the
+                            images (default: {}). Smaller blocks find more
+                            matches, at the cost of a larger index.'''.format(
+                                delta_image.BLOCK_SIZE_DEFAULT))
+        parser.add_argument('--verify', action='store_true',
+                            help='''Apply each delta after making it, and
+                            check the result is the new image.''')
+        parser.add_argument('app', nargs='*',
+                            help='''with --from-bundle, application(s) to
+                            make deltas for (default: every application
+                            in the output directory)''')
+
+    def do_prep_for_run(self):
+        single = self.arguments.from_image or self.arguments.to_image
+        if bool(single) == bool(self.arguments.from_bundle):
+            raise ValueError('give either --from and --to, or --from-bundle')
+        if single and not (self.arguments.from_image and
+                           self.arguments.to_image):
+            raise ValueError('--from and --to must be given together')
+        if self.arguments.app and not self.arguments.from_bundle:
+            raise ValueError('applications can only be given with '
+                             '--from-bundle')
+        if self.arguments.block_size < 4:
+            raise ValueError('--block-size must be at least 4')
+        # Remember whether boards were given before they're defaulted.
+        self.board_filter = list(self.arguments.boards)
+
+    def do_invoke(self):
+        if self.arguments.from_bundle:
+            pairs = self.bundle_pairs()
+            if not pairs:
+                raise RuntimeError('no signed images in {} match {}'.format(
+                    self.arguments.outdir, self.arguments.from_bundle))
+        else:
+            output = self.arguments.output
+            if output is None:
+                output = self.delta_name(self.arguments.to_image)
+            pairs = [(self.arguments.from_image, self.arguments.to_image,
+                      output)]
+
+        for old, new, delta in pairs:
+            self.make_delta(old, new, delta)
+
+    def bundle_pairs(self):
+        '''Get (old image, new image, delta) paths for --from-bundle.'''
+        outdir = self.arguments.outdir
+        if self.arguments.app and self.board_filter:
+            trees = []
+            for app in self.arguments.app:
+                app = app.rstrip(os.path.sep)
+                for board in self.board_filter:
+                    trees.append((app, board,
+                                  find_app_outdir(outdir, app, board)))
+        elif self.arguments.app:
+            # Every board the apps have build directories for.
+            trees = []
+            for app in self.arguments.app:
+                app = app.rstrip(os.path.sep)
+                for tree in buildtree.find_trees(os.path.join(outdir, app)):
+                    parsed = parse_outdir(outdir, tree)
+                    # Skip the trees of apps under this one.
+                    if parsed is None or parsed[0] != app or \
+                       parsed[2] != 'app':
+                        continue
+                    trees.append((app, parsed[1], tree))
+        else:
+            trees = []
+            for tree in buildtree.find_trees(outdir):
+                parsed = parse_outdir(outdir, tree)
+                if parsed is None or parsed[2] != 'app':
+                    continue
+                app, board, _ = parsed
+                if self.board_filter and board not in self.board_filter:
+                    continue
+                trees.append((app, board, tree))
+
+        ret = []
+        for app, board, tree in trees:
+            new = signed_app_name(app, board, tree, 'bin')
+            old = os.path.join(self.arguments.from_bundle,
+                               os.path.basename(new))
+            if not os.path.isfile(new):
+                self.wrn('Warning: no signed image for {} ({}); skipping'.
+                         format(app, board))
+            elif not os.path.isfile(old):
+                self.wrn('Warning: {} not in {}; skipping'.format(
+                    os.path.basename(new), self.arguments.from_bundle))
+            else:
+                ret.append((old, new, self.delta_name(new)))
+        return ret
+
+    def delta_name(self, image):
+        base = image[:-len('.bin')] if image.endswith('.bin') else image
+        return base + '.delta'
+
+    def image_version(self, path):
+        try:
+            return mcuboot_image.read(path).version
+        except mcuboot_image.ImageError:
+            return None
+
+    def make_delta(self, old, new, delta):
+        metadata = delta_image.generate(old, new, delta,
+                                        block_size=self.arguments.block_size)
+        metadata['from']['version'] = self.image_version(old)
+        metadata['to']['version'] = self.image_version(new)
+
+        if self.arguments.verify:
+            check = delta + '.check'
+            try:
+                delta_image.apply(old, delta, check)
+            finally:
+                if os.path.exists(check):
+                    os.remove(check)
+            metadata['verified'] = True
+
+        with open(delta + '.json', 'w') as f:
+            json.dump(metadata, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+        self.inf('{}: {} -> {}, {} ({:.1%} of {})'.format(
+            delta, metadata['from']['version'] or os.path.basename(old),
+            metadata['to']['version'] or os.path.basename(new),
+            buildtree.format_size(metadata['delta_size']),
+            metadata['ratio'],
+            buildtree.format_size(metadata['to']['size'])))
+
+
+#
+# Benchmarks
+#
+
+# Printed by Zephyr when the kernel starts the application.
+BENCH_BOOT_MARKER = r'\*\*\* Booting Zephyr OS'
+
+# Timestamp at the start of Zephyr log messages: [hh:mm:ss.mmm,uuu].
+BENCH_LOG_TIMESTAMP = re.compile(
+    r'\[(\d+):(\d+):(\d+)\.(\d+),(\d+)\]')
+
+
+class Bench(Command):
+
+    def __init__(self, *args, **kwargs):
+        super(Bench, self).__init__(*args, **kwargs)
+
+    @property
+    def command_name(self):
+        return 'bench'
+
+    @property
+    def command_help(self):
+        return 'measure boot time and latencies of an app in QEMU'
+
+    def do_register(self, parser):
+        parser.add_argument('-b', '--board', dest='boards', default=[],
+                            action='append',
+                            help='''QEMU board to run on (default:
+                            qemu_x86). This may be given multiple
+                            times.''')
+        parser.add_argument('-O', '--outdir', default=find_default_outdir(),
+                            help=HELP['--outdir'])
+        parser.add_argument('-n', '--runs', type=int, default=5,
+                            help='''Number of times to run the image
+                            (default: 5).''')
+        parser.add_argument('-t', '--timeout', type=float, default=30,
+                            help='''Seconds to wait for each run to reach
+                            the --done marker (default: 30).''')
+        parser.add_argument('-m', '--marker', dest='markers', default=[],
+                            action='append', metavar='REGEX',
+                            help='''Regular expression matching a console
+                            line to time. This may be given multiple
+                            times. If the matching line starts with a
+                            Zephyr log timestamp, its latency is taken
+                            from the target's clock; otherwise, from the
+                            time the line was printed.''')
+        parser.add_argument('--done', metavar='REGEX',
+                            help='''Regular expression matching the console
+                            line which ends a run (default: the last
+                            --marker, or the boot banner).''')
+        parser.add_argument('--no-build', action='store_true',
+                            help='''Run the existing images without
+                            building them first.''')
+        parser.add_argument('--build-arg', dest='build_args', default=[],
+                            action='append', metavar='ARG',
+                            help='''Extra argument for 'zmp build', like
+                            --build-arg=--overlay-config=bench.conf. This
+                            may be given multiple times.''')
+        parser.add_argument('--json', metavar='FILE',
+                            help='''Also write every run's timings to FILE,
+                            as JSON.''')
+        parser.add_argument('app', help='application to benchmark')
+
+    def do_prep_for_run(self):
+        if not self.arguments.boards:
+            self.arguments.boards = ['qemu_x86']
+        not_qemu = [b for b in self.arguments.boards
+                    if not b.startswith('qemu_')]
+        if not_qemu:
+            raise ValueError('not QEMU boards: {}'.format(', '.join(not_qemu)))
+        if self.arguments.runs < 1:
+            raise ValueError('--runs must be at least 1')
+
+        self.arguments.app = self.arguments.app.rstrip(os.path.sep)
+        self.markers = [(BENCH_BOOT_MARKER, re.compile(BENCH_BOOT_MARKER))]
+        self.markers.extend((m, re.compile(m)) for m in self.arguments.markers)
+        done = self.arguments.done or self.markers[-1][0]
+        self.done = re.compile(done)
+
+    def do_invoke(self):
+        if not self.arguments.no_build:
+            argv = ['-O', self.arguments.outdir, '--no-bootloader']
+            for board in self.arguments.boards:
+                argv.extend(['-b', board])
+            argv.extend(self.arguments.build_args)
+            argv.append(self.arguments.app)
+            self.run_command(Build, argv)
+
+        results = {}
+        for board in self.arguments.boards:
+            outdir = find_app_outdir(self.arguments.outdir,
+                                     self.arguments.app, board)
+            runs = []
+            # The run target rebuilds the image if it's out of date,
+            # which mustn't write through files 'zmp dedup' shared.
+            with buildtree.TreeLock(outdir):
+                file_dedup.unshare(outdir)
+                for i in range(self.arguments.runs):
+                    self.dbg('{}: run {} of {}'.format(
+                        board, i + 1, self.arguments.runs))
+                    runs.append(self.bench_run(board, outdir))
+            results[board] = runs
+            self.print_stats(board, runs)
+
+        if self.arguments.json:
+            data = {
+                'app': self.arguments.app,
+                'markers': [pattern for pattern, _ in self.markers],
+                'runs': results,
+            }
+            with open(self.arguments.json, 'w') as f:
+                json.dump(data, f, indent=2, sort_keys=True)
+                f.write('\n')
+
+        failed = [board for board, runs in results.items()
+                  if not any(run['completed'] for run in runs)]
+        if failed:
+            raise RuntimeError('no run reached the done marker on: {}'.format(
+                ', '.join(failed)))
+
+    def bench_run(self, board, outdir):
+        '''Run the image once, returning its timings.
+
+        Timings are seconds from the start of the run ('host'), and,
+        for lines with log timestamps, from target boot ('target').'''
+        timings = {}
+        start = time.monotonic()
+
+        def on_line(line):
+            now = time.monotonic() - start
+            for pattern, regex in self.markers:
+                if pattern not in timings and regex.search(line):
+                    timings[pattern] = {'host': now,
+                                        'target': self.target_time(line)}
+            return self.done.search(line) is not None
+
+        prefix = '[{}] '.format(board) if self.arguments.debug else None
+        job = jobrunner.Job(['cmake', '--build', outdir, '--target', 'run'],
+                            cwd=outdir, timeout=self.arguments.timeout,
+                            prefix=prefix, on_line=on_line)
+        try:
+            self.run_jobs([job])
+        except subprocess.TimeoutExpired:
+            self.wrn('Warning: {} run timed out after {}s'.format(
+                board, self.arguments.timeout))
+        return {'completed': job.stopped, 'markers': timings}
+
+    def target_time(self, line):
+        match = BENCH_LOG_TIMESTAMP.search(line)
+        if match is None:
+            return None
+        hours, minutes, seconds, ms, us = (int(g) for g in match.groups())
+        return hours * 3600 + minutes * 60 + seconds + ms / 1e3 + us / 1e6
+
+    def latencies(self, runs, pattern):
+        # Boot time is measured from the start of the run; every other
+        # marker from the boot banner, on the target's clock if possible.
+        ret = []
+        for run in runs:
+            marker = run['markers'].get(pattern)
+            if marker is None:
+                continue
+            if pattern == BENCH_BOOT_MARKER:
+                ret.append(marker['host'])
+                continue
+            boot = run['markers'].get(BENCH_BOOT_MARKER)
+            if marker['target'] is not None:
+                ret.append(marker['target'])
+            elif boot is not None:
+                ret.append(marker['host'] - boot['host'])
+        return ret
+
+    def print_stats(self, board, runs):
+        completed = sum(1 for run in runs if run['completed'])
+        self.inf('{}: {} of {} runs completed'.format(board, completed,
+                                                      len(runs)))
+        names = ['boot' if pattern == BENCH_BOOT_MARKER else pattern
+                 for pattern, _ in self.markers]
+        width = max(len(name) for name in names)
+        for (pattern, _), name in zip(self.markers, names):
+            samples = self.latencies(runs, pattern)
+            if not samples:
+                self.inf('  {}  never seen'.format(name.ljust(width)))
+                continue
+            stdev = statistics.stdev(samples) if len(samples) > 1 else 0.0
+            self.inf('  {}  n={} min {:.3f} s, median {:.3f} s, mean {:.3f} s,'
+                     ' max {:.3f} s, stdev {:.3f} s'.format(
+                         name.ljust(width), len(samples), min(samples),
+                         statistics.median(samples), statistics.mean(samples),
+                         max(samples), stdev))
+
+
+#
+# Bisect
+#
+
+# Test command exit status meaning "can't tell; skip this commit",
+# as for 'git bisect run'.
+BISECT_SKIP = 125
+
+
+class Bisect(Command):
+
+    def __init__(self, *args, **kwargs):
+        super(Bisect, self).__init__(*args, **kwargs)
+
+    @property
+    def command_name(self):
+        return 'bisect'
+
+    @property
+    def command_help(self):
+        return 'find the Zephyr commit which broke an application'
+
+    def do_register(self, parser):
+        parser.add_argument('--good', required=True,
+                            help='''Zephyr commit known to work.''')
+        parser.add_argument('--bad', required=True,
+                            help='''Zephyr commit known to be broken.''')
+        parser.add_argument('--app', required=True,
+                            help='''application to build and test''')
+        parser.add_argument('-b', '--board', required=True,
+                            help='''Zephyr board to build for''')
+        parser.add_argument('--test', required=True, metavar='CMD',
+                            help='''Shell command which tests a build. It
+                            should exit with 0 if the commit is good, {} if
+                            it can't be tested, and anything else if it's
+                            bad. It runs with ZMP_BISECT_COMMIT set to the
+                            commit, ZMP_BISECT_OUTDIR to the output
+                            directory to give other zmp commands with -O,
+                            and ZEPHYR_BASE to the commit's tree.'''.format(
+                                BISECT_SKIP))
+        parser.add_argument('-O', '--outdir', default=find_default_outdir(),
+                            help='''Output directory; candidates are built
+                            in its bisect subdirectory (default: '{}').'''.
+                            format(find_default_outdir()))
+        parser.add_argument('-p', '--parallel', type=int, default=3,
+                            metavar='N',
+                            help='''Number of commits to build at once in
+                            each round (default: 3). Each round narrows
+                            the range to about 1/(N+1) of its size.''')
+        parser.add_argument('--build-arg', dest='build_args', default=[],
+                            action='append', metavar='ARG',
+                            help='''Extra argument for 'zmp build', like
+                            --build-arg=--cache=/path/to/cache. This may
+                            be given multiple times.''')
+        parser.add_argument('--keep-worktrees', action='store_true',
+                            help='''Don't remove the Git worktrees used for
+                            building candidates when done, so a later
+                            bisect can build incrementally.''')
+
+    def do_prep_for_run(self):
+        if self.arguments.parallel < 1:
+            raise ValueError('--parallel must be at least 1')
+        self.arguments.app = self.arguments.app.rstrip(os.path.sep)
+        check_dependencies(['git'])
+
+    def do_invoke(self):
+        # Only needed here, so the other commands work without pygit2.
+        from pygit2_helpers import repo_commits, commit_shortlog, \
+            commit_shortsha
+
+        repo = find_zephyr_base()
+        walked = repo_commits(repo, self.arguments.good, self.arguments.bad)
+        by_sha = {str(c.oid): c for c in walked}
+        # Oldest first; the last commit is the known bad one.
+        commits = [str(c.oid) for c in reversed(walked)]
+        if not commits:
+            raise ValueError('{} is not an ancestor of {}'.format(
+                self.arguments.good, self.arguments.bad))
+
+        self.worktrees = {}
+        try:
+            lo, hi = self.bisect(commits)
+        finally:
+            if not self.arguments.keep_worktrees:
+                self.remove_worktrees(repo)
+
+        if hi - lo == 1:
+            first_bad = by_sha[commits[hi]]
+            self.inf('First bad commit: {} {}'.format(
+                commit_shortsha(first_bad), commit_shortlog(first_bad)))
+        else:
+            self.inf('Could not narrow the range further; the first bad '
+                     'commit is one of:')
+            for sha in commits[lo + 1:hi + 1]:
+                self.inf('  {} {}'.format(commit_shortsha(by_sha[sha]),
+                                          commit_shortlog(by_sha[sha])))
+
+    def bisect(self, commits):
+        '''Narrow down the first bad commit.
+
+        Index -1 is the good commit. Returns (lo, hi), where lo is the
+        index of the last known good commit, and hi of the first known
+        bad one.'''
+        lo, hi = -1, len(commits) - 1
+        skipped = set()
+        rnd = 0
+        while hi - lo > 1:
+            candidates = self.pick_candidates(lo, hi, skipped)
+            if not candidates:
+                break
+            rnd += 1
+            self.inf('Round {}: {} commits left, testing {}'.format(
+                rnd, hi - lo - 1,
+                ', '.join(commits[i][:8] for i in candidates)))
+
+            results = self.test_candidates([(slot, commits[i]) for slot, i
+                                            in enumerate(candidates)])
+            for i, result in zip(candidates, results):
+                self.inf('  {}: {}'.format(commits[i][:8], result))
+                if result == 'skip':
+                    skipped.add(i)
+            bad = [i for i, r in zip(candidates, results) if r == 'bad']
+            if bad:
+                hi = min(bad)
+            good = [i for i, r in zip(candidates, results)
+                    if r == 'good' and i < hi]
+            if good:
+                lo = max(good + [lo])
+        return lo, hi
+
+    def pick_candidates(self, lo, hi, skipped):
+        # Split (lo, hi) into parallel + 1 roughly equal parts, moving
+        # any point which was skipped to its nearest untested neighbor.
+        untested = [i for i in range(lo + 1, hi) if i not in skipped]
+        count = min(self.arguments.parallel, len(untested))
+        ret = []
+        for j in range(count):
+            target = lo + (j + 1) * (hi - lo) / (count + 1)
+            choices = [i for i in untested if i not in ret]
+            if choices:
+                ret.append(min(choices, key=lambda i: abs(i - target)))
+        return sorted(ret)
+
+    def test_candidates(self, candidates):
+        '''Build (slot, commit) pairs in parallel, then test each.
+
+        Returns a list of 'good', 'bad' or 'skip', in order.'''
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=len(candidates)) as executor:
+            futures = [executor.submit(self.build_candidate, slot, sha)
+                       for slot, sha in candidates]
+            built = [future.result() for future in futures]
+
+        # Tests run one at a time, as they may need shared hardware.
+        return [self.test_candidate(slot, sha) if ok else 'skip'
+                for (slot, sha), ok in zip(candidates, built)]
+
+    def slot_outdir(self, slot):
+        return os.path.join(self.arguments.outdir, 'bisect', str(slot))
+
+    def build_candidate(self, slot, sha):
+        worktree = self.checkout(slot, sha)
+        argv = (['-O', self.slot_outdir(slot), '-b', self.arguments.board] +
+                self.arguments.build_args + [self.arguments.app])
+        try:
+            self.run_command(Build, argv, zephyr_base=worktree)
+        except subprocess.CalledProcessError:
+            self.wrn('Warning: {} failed to build; skipping it'.format(
+                sha[:8]))
+            return False
+        return True
+
+    def test_candidate(self, slot, sha):
+        env = dict(self.command_env)
+        env['ZEPHYR_BASE'] = self.worktrees[slot]
+        env['ZMP_BISECT_COMMIT'] = sha
+        env['ZMP_BISECT_OUTDIR'] = os.path.abspath(self.slot_outdir(slot))
+        try:
+            self.check_call(['sh', '-c', self.arguments.test], env=env)
+        except subprocess.CalledProcessError as e:
+            return 'skip' if e.returncode == BISECT_SKIP else 'bad'
+        return 'good'
+
+    def checkout(self, slot, sha):
+        '''Check out sha in the worktree for slot, creating it if needed.'''
+        worktree = os.path.abspath(os.path.join(
+            self.arguments.outdir, '.bisect-worktrees', str(slot)))
+        if os.path.isdir(worktree):
+            self.check_call(['git', '-C', worktree, 'checkout', '-q',
+                             '--detach', sha])
+        else:
+            os.makedirs(os.path.dirname(worktree), exist_ok=True)
+            self.check_call(['git', '-C', find_zephyr_base(), 'worktree',
+                             'add', '-q', '--detach', worktree, sha])
+        self.worktrees[slot] = worktree
+        return worktree
+
+    def remove_worktrees(self, repo):
+        for worktree in self.worktrees.values():
+            try:
+                self.check_call(['git', '-C', repo, 'worktree', 'remove',
+                                 '--force', worktree])
+            except subprocess.CalledProcessError:
+                self.wrn('Warning: could not remove worktree {}'.format(
+                    worktree))
+
+
+#
+# Deploy
+#
+
+class Deploy(Command):
+
+    def __init__(self, *args, **kwargs):
+        super(Deploy, self).__init__(*args, **kwargs)
+
+    @property
+    def command_name(self):
+        return 'deploy'
+
+    @property
+    def command_help(self):
+        return 'build, sign and flash, flashing each board once it is built'
+
+    def do_register(self, parser):
+        parser.add_argument('-b', '--board', dest='boards', default=[],
+                            action='append', help=HELP['--board'])
+        parser.add_argument('-O', '--outdir', default=find_default_outdir(),
+                            help=HELP['--outdir'])
+        parser.add_argument('-o', '--outputs', choices=BUILD_OUTPUTS + ['all'],
+                            default='all',
+                            help=HELP['--outputs'].format('build and flash'))
+        parser.add_argument('--board-id', dest='board_ids', default=[],
+                            action='append', metavar='[BOARD=]ID',
+                            help='''Flash the given board's images to the
+                            device with this board ID. This may be given
+                            multiple times, including for the same board.
+                            BOARD= may be left out if only one board is
+                            given.''')
+        parser.add_argument('-p', '--parallel', type=int, metavar='N',
+                            help='''Build at most N boards at once (default:
+                            all of them). Compiler jobs are shared among
+                            them either way.''')
+        parser.add_argument('--build-arg', dest='build_args', default=[],
+                            action='append', metavar='ARG',
+                            help='''Extra argument for 'zmp build', like
+                            --build-arg=--signing-key=key.pem. This may be
+                            given multiple times.''')
+        parser.add_argument('--merged', action='store_true',
+                            help='''Flash MCUboot and the application as
+                            one merged image; see 'zmp flash --merged'.''')
+        parser.add_argument('app', help='application to deploy')
+
+    def do_prep_for_run(self):
+        if self.arguments.parallel is not None and self.arguments.parallel < 1:
+            raise ValueError('--parallel must be at least 1')
+        self.arguments.app = self.arguments.app.rstrip(os.path.sep)
+        # prep_for_run() turns outputs into a list after this; the
+        # build and flash commands get the option as it was given.
+        self.outputs_arg = self.arguments.outputs
+
+        boards = self.arguments.boards or [BOARD_DEFAULT]
+        self.board_ids = collections.OrderedDict((b, []) for b in boards)
+        for spec in self.arguments.board_ids:
+            board, sep, board_id = spec.rpartition('=')
+            if not sep:
+                if len(boards) > 1:
+                    raise ValueError('--board-id {}: give it as BOARD={} '
+                                     'when deploying to several boards'.
+                                     format(spec, spec))
+                board = boards[0]
+            if board not in self.board_ids:
+                raise ValueError('--board-id {}: {} is not a target board'.
+                                 format(spec, board))
+            self.board_ids[board].append(board_id)
+
+    def do_invoke(self):
+        boards = list(self.board_ids)
+        workers = self.arguments.parallel or len(boards)
+        failed = []
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers) as executor:
+            futures = collections.OrderedDict(
+                (executor.submit(self.deploy_board, board), board)
+                for board in boards)
+            for future in concurrent.futures.as_completed(futures):
+                board = futures[future]
+                try:
+                    future.result()
+                except (subprocess.CalledProcessError,
+                        subprocess.TimeoutExpired, buildtree.TreeBusyError,
+                        mcuboot_image.ImageError, SystemExit) as e:
+                    # SystemExit is from a --build-arg the build
+                    # command's parser rejected.
+                    self.wrn('{}: deploy failed: {}'.format(board, e))
+                    failed.append(board)
+
+        if failed:
+            raise RuntimeError('deploy failed for: {}'.format(
+                ', '.join(b for b in boards if b in failed)))
+
+    def deploy_board(self, board):
+        '''Build and sign the images for one board, then flash them.'''
+        common = ['-O', self.arguments.outdir, '-b', board,
+                  '-o', self.outputs_arg]
+
+        start = time.monotonic()
+        self.run_command(Build, common + self.arguments.build_args +
+                         [self.arguments.app])
+        built = time.monotonic()
+        self.inf('{}: built in {:.1f} s; flashing'.format(board,
+                                                          built - start),
+                 flush=True)
+
+        flash_argv = list(common)
+        for board_id in self.board_ids[board]:
+            flash_argv.extend(['--board-id', board_id])
+        if self.arguments.merged:
+            flash_argv.append('--merged')
+        self.run_command(Flash, flash_argv + [self.arguments.app])
+        self.inf('{}: flashed in {:.1f} s'.format(
+            board, time.monotonic() - built), flush=True)
@@ -0,0 +1,118 @@
+# Copyright (c) 2018 Foundries.io Limited.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+'''Cache of freshly configured build directories.
+
+Running CMake's generate step for a Zephyr build (Kconfig, devicetree,
+generated headers) takes a while, and gives the same results for the
+same inputs. This keeps a copy of each build directory as it is right
+after configuring, keyed by a fingerprint of those inputs, so a new
+build directory with the same inputs can be cloned from it instead.
+
+CMake writes absolute paths to the build directory all over the tree,
+so they are rewritten when cloning. Modification times are preserved,
+so Ninja doesn't think the cloned build system is out of date.'''
+
+import os
+import shutil
+import tempfile
+
+# Files in a build directory which aren't part of its configuration.
+_SKIP_FILES = {'.zmp-lock', '.zmp-last-used'}
+
+
+def cmake_binary_dir(outdir):
+    '''Get the build directory recorded in outdir's CMakeCache.txt.'''
+    with open(os.path.join(outdir, 'CMakeCache.txt'), 'r') as f:
+        for line in f:
+            if line.startswith('CMAKE_CACHEFILE_DIR:INTERNAL='):
+                return line.split('=', 1)[1].strip()
+    return None
+
+
+def _copy_tree(src, dst, old_path, new_path):
+    # Copy src to dst, replacing old_path with new_path in text files
+    # (unless old_path is None).
+    old_bytes = old_path.encode('utf-8') if old_path is not None else None
+    new_bytes = new_path.encode('utf-8') if new_path is not None else None
+    copied_dirs = []
+    for root, dirs, files in os.walk(src):
+        rel = os.path.relpath(root, src)
+        dst_root = os.path.normpath(os.path.join(dst, rel))
+        os.makedirs(dst_root, exist_ok=True)
+        copied_dirs.append((root, dst_root))
+        for name in files:
+            if name in _SKIP_FILES:
+                continue
+            src_file = os.path.join(root, name)
+            dst_file = os.path.join(dst_root, name)
+            if os.path.islink(src_file):
+                if os.path.lexists(dst_file):
+                    os.unlink(dst_file)
+                os.symlink(os.readlink(src_file), dst_file)
+                continue
+            with open(src_file, 'rb') as f:
+                data = f.read()
+            if old_bytes is not None and old_bytes in data and \
+               b'\0' not in data:
+                with open(dst_file, 'wb') as f:
+                    f.write(data.replace(old_bytes, new_bytes))
+                shutil.copystat(src_file, dst_file)
+            else:
+                shutil.copy2(src_file, dst_file)
+
+    # Directory modification times change as files are added to
+    # them, so copy them last, deepest first.
+    for src_dir, dst_dir in reversed(copied_dirs):
+        shutil.copystat(src_dir, dst_dir)
+
+
+class ConfigureCache:
+    '''A directory of configured build directories, by key.'''
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+
+    def __str__(self):
+        return self.path
+
+    def entry(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def restore(self, key, outdir):
+        '''Clone the entry for key into outdir, if there is one.
+
+        Returns True if it was cloned, and False on a cache miss.'''
+        entry = self.entry(key)
+        if not os.path.isdir(entry):
+            return False
+        old_path = cmake_binary_dir(entry)
+        if old_path is None:
+            return False
+        _copy_tree(entry, outdir, old_path, os.path.realpath(outdir))
+        return True
+
+    def save(self, key, outdir):
+        '''Save a freshly configured outdir as the entry for key.
+
+        Entries are written to a temporary directory and renamed into
+        place, so concurrent builds never see a partial entry. If
+        another build got there first, its entry is kept.'''
+        entry = self.entry(key)
+        if os.path.isdir(entry):
+            return
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=os.path.dirname(entry),
+                               prefix='.' + key[:8])
+        try:
+            # Copied verbatim: the recorded build directory is still
+            # outdir, which is what restore() replaces.
+            _copy_tree(outdir, tmp, None, None)
+            os.rename(tmp, entry)
+        except OSError:
+            if not os.path.isdir(entry):
+                raise
+        finally:
+            if os.path.isdir(tmp):
+                shutil.rmtree(tmp)
@@ -0,0 +1,306 @@
+# Copyright (c) 2018 Foundries.io Limited.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+'''Binary delta images.
+
+A delta describes how to make a new image from an old one, so devices
+which already have the old image only need to download the delta. It
+is a header followed by a zlib stream of operations:
+
+- COPY: b'C', then offset and length (both uint32 little endian):
+  append length bytes from the old image, starting at offset
+- ADD: b'A', then a uint32 length, then that many bytes: append them
+
+Deltas are generated rsync-style: each block of the old image is
+indexed by a weak rolling checksum, and the new image is scanned for
+blocks which match one. Both images are memory mapped and the output
+is written as it is produced, so memory use is bounded by the block
+index (a few entries per block of the old image) and the size of one
+ADD operation.'''
+
+import hashlib
+import mmap
+import os
+import struct
+import zlib
+
+MAGIC = b'ZMPD'
+FORMAT_VERSION = 1
+
+# magic, version, flags, reserved, block size, old size, new size,
+# old SHA-256, new SHA-256
+HEADER_FORMAT = '<4sBBHIII32s32s'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+BLOCK_SIZE_DEFAULT = 64
+
+# Largest ADD operation emitted, which bounds the literal data buffered.
+MAX_ADD = 1 << 16
+
+_COPY = b'C'
+_ADD = b'A'
+_MOD = 1 << 16
+
+
+class DeltaError(ValueError):
+    '''A delta is invalid, or doesn't apply to the given old image.'''
+
+
+def _weak_sum(data):
+    a = sum(data) % _MOD
+    b = sum((len(data) - i) * x for i, x in enumerate(data)) % _MOD
+    return a, b
+
+
+def _map(f):
+    if os.fstat(f.fileno()).st_size == 0:
+        return b''
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _sha256(buf):
+    return hashlib.sha256(buf).digest()
+
+
+class _OpWriter:
+    # Writes operations through a zlib compressor into a file,
+    # merging adjacent COPYs and buffering up to MAX_ADD literal bytes.
+
+    def __init__(self, f):
+        self.f = f
+        self.compressor = zlib.compressobj(9)
+        self.copy = None
+        self.literal = bytearray()
+        self.copied = 0
+        self.added = 0
+
+    def _write(self, data):
+        self.f.write(self.compressor.compress(data))
+
+    def _flush_copy(self):
+        if self.copy is not None:
+            self._write(_COPY + struct.pack('<II', *self.copy))
+            self.copied += self.copy[1]
+            self.copy = None
+
+    def _flush_literal(self):
+        if self.literal:
+            self._write(_ADD + struct.pack('<I', len(self.literal)))
+            self._write(bytes(self.literal))
+            self.added += len(self.literal)
+            self.literal = bytearray()
+
+    def copy_block(self, offset, length):
+        self._flush_literal()
+        if self.copy is not None and \
+           self.copy[0] + self.copy[1] == offset:
+            self.copy = (self.copy[0], self.copy[1] + length)
+        else:
+            self._flush_copy()
+            self.copy = (offset, length)
+
+    def add(self, data):
+        self._flush_copy()
+        self.literal.extend(data)
+        if len(self.literal) >= MAX_ADD:
+            self._flush_literal()
+
+    def close(self):
+        self._flush_copy()
+        self._flush_literal()
+        self.f.write(self.compressor.flush())
+
+
+def _index(old, block_size):
+    # Map weak checksums of each aligned old block to their offsets.
+    index = {}
+    for offset in range(0, len(old) - block_size + 1, block_size):
+        key = _weak_sum(old[offset:offset + block_size])
+        index.setdefault(key, []).append(offset)
+    return index
+
+
+def _diff(old, new, block_size, writer):
+    index = _index(old, block_size)
+    n = len(new)
+    pos = 0
+    literal_start = 0
+    a = b = None
+
+    while pos + block_size <= n:
+        if a is None:
+            a, b = _weak_sum(new[pos:pos + block_size])
+
+        match = None
+        for offset in index.get((a, b), ()):
+            if old[offset:offset + block_size] == \
+               new[pos:pos + block_size]:
+                match = offset
+                break
+
+        if match is not None:
+            if literal_start < pos:
+                writer.add(new[literal_start:pos])
+            # Extend the match as far as it goes.
+            length = block_size
+            while (pos + length < n and match + length < len(old) and
+                   new[pos + length] == old[match + length]):
+                length += 1
+            writer.copy_block(match, length)
+            pos += length
+            literal_start = pos
+            a = None
+            continue
+
+        # Roll the checksum forward one byte.
+        if pos + block_size < n:
+            out_byte = new[pos]
+            in_byte = new[pos + block_size]
+            a = (a - out_byte + in_byte) % _MOD
+            b = (b - block_size * out_byte + a) % _MOD
+        pos += 1
+        if pos - literal_start >= MAX_ADD:
+            writer.add(new[literal_start:pos])
+            literal_start = pos
+
+    if literal_start < n:
+        writer.add(new[literal_start:n])
+
+
+def generate(old_path, new_path, delta_path, block_size=BLOCK_SIZE_DEFAULT):
+    '''Write a delta from old_path to new_path into delta_path.
+
+    Returns a dict of metadata about the delta.'''
+    with open(old_path, 'rb') as old_f, open(new_path, 'rb') as new_f:
+        old = _map(old_f)
+        new = _map(new_f)
+        try:
+            old_size, new_size = len(old), len(new)
+            old_sha = _sha256(old)
+            new_sha = _sha256(new)
+            tmp = delta_path + '.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(struct.pack(HEADER_FORMAT, MAGIC, FORMAT_VERSION, 0,
+                                    0, block_size, old_size, new_size,
+                                    old_sha, new_sha))
+                writer = _OpWriter(f)
+                _diff(old, new, block_size, writer)
+                writer.close()
+            os.replace(tmp, delta_path)
+        finally:
+            if isinstance(old, mmap.mmap):
+                old.close()
+            if isinstance(new, mmap.mmap):
+                new.close()
+
+    delta_size = os.path.getsize(delta_path)
+    return {
+        'format': FORMAT_VERSION,
+        'block_size': block_size,
+        'from': {'path': os.path.abspath(old_path), 'size': old_size,
+                 'sha256': old_sha.hex()},
+        'to': {'path': os.path.abspath(new_path), 'size': new_size,
+               'sha256': new_sha.hex()},
+        'delta_size': delta_size,
+        'copied': writer.copied,
+        'added': writer.added,
+        'ratio': delta_size / new_size if new_size else 0.0,
+    }
+
+
+def read_header(f):
+    '''Read and check a delta header from a file object.
+
+    Returns (block_size, old_size, new_size, old_sha256, new_sha256).'''
+    header = f.read(HEADER_SIZE)
+    if len(header) != HEADER_SIZE:
+        raise DeltaError('truncated delta header')
+    (magic, version, _, _, block_size, old_size, new_size, old_sha,
+     new_sha) = struct.unpack(HEADER_FORMAT, header)
+    if magic != MAGIC:
+        raise DeltaError('not a delta image')
+    if version != FORMAT_VERSION:
+        raise DeltaError('unsupported delta version {}'.format(version))
+    return block_size, old_size, new_size, old_sha, new_sha
+
+
+def _decompressed(f, chunk_size=1 << 16):
+    decompressor = zlib.decompressobj()
+    buf = bytearray()
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            buf.extend(decompressor.flush())
+            break
+        buf.extend(decompressor.decompress(chunk))
+        yield buf
+    yield buf
+
+
+def apply(old_path, delta_path, out_path):
+    '''Apply a delta to old_path, writing the result to out_path.
+
+    Raises DeltaError if the delta doesn't apply, or if the result
+    isn't the image the delta was made for; out_path is left alone
+    in that case.'''
+    tmp = out_path + '.tmp'
+    try:
+        _apply(old_path, delta_path, tmp)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    os.replace(tmp, out_path)
+
+
+def _apply(old_path, delta_path, out_path):
+    with open(old_path, 'rb') as old_f, open(delta_path, 'rb') as delta_f, \
+            open(out_path, 'wb') as out:
+        _, old_size, new_size, old_sha, new_sha = read_header(delta_f)
+        old = _map(old_f)
+        try:
+            if len(old) != old_size or _sha256(old) != old_sha:
+                raise DeltaError('{} is not the image {} was made from'.
+                                 format(old_path, delta_path))
+            sha = hashlib.sha256()
+            written = 0
+            buf = None
+            pos = 0
+            for buf in _decompressed(delta_f):
+                # Consume whole operations from the buffer.
+                while True:
+                    if len(buf) - pos < 5:
+                        break
+                    op = bytes(buf[pos:pos + 1])
+                    if op == _COPY:
+                        if len(buf) - pos < 9:
+                            break
+                        offset, length = struct.unpack_from('<II', buf,
+                                                            pos + 1)
+                        if offset + length > len(old):
+                            raise DeltaError('COPY past end of old image')
+                        data = old[offset:offset + length]
+                        pos += 9
+                    elif op == _ADD:
+                        length, = struct.unpack_from('<I', buf, pos + 1)
+                        if len(buf) - pos < 5 + length:
+                            break
+                        data = bytes(buf[pos + 5:pos + 5 + length])
+                        pos += 5 + length
+                    else:
+                        raise DeltaError('bad operation {!r}'.format(op))
+                    out.write(data)
+                    sha.update(data)
+                    written += len(data)
+                del buf[:pos]
+                pos = 0
+            if buf:
+                raise DeltaError('trailing data in delta')
+        finally:
+            if isinstance(old, mmap.mmap):
+                old.close()
+
+    if written != new_size or sha.digest() != new_sha:
+        raise DeltaError('result of applying {} does not match'.format(
+            delta_path))
@@ -0,0 +1,89 @@
+# Copyright (c) 2018 Foundries.io Limited.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+'''Editing Kconfig .config files in place.
+
+A .config file has a line for each symbol, either an assignment:
+
+    CONFIG_FOO=y
+    CONFIG_BAR="some string"
+
+or, for a bool or tristate symbol which is off:
+
+    # CONFIG_BAZ is not set
+
+edit() changes those lines without running Kconfig. Dependencies
+aren't checked here: the next build runs Kconfig on the result, which
+drops settings whose dependencies aren't met.'''
+
+import os
+import re
+
+_ASSIGNMENT = re.compile(r'^(CONFIG_[A-Za-z0-9_]+)=(.*)$')
+_NOT_SET = re.compile(r'^# (CONFIG_[A-Za-z0-9_]+) is not set$')
+_NAME = re.compile(r'^CONFIG_[A-Za-z0-9_]+$')
+
+
+def parse_setting(setting):
+    '''Parse 'CONFIG_FOO=value' into ('CONFIG_FOO', 'value').
+
+    Raises ValueError if setting isn't like that.'''
+    name, sep, value = setting.partition('=')
+    if not sep or not _NAME.match(name):
+        raise ValueError('invalid setting {}: expected CONFIG_NAME=VALUE'.
+                         format(setting))
+    return name, value
+
+
+def check_name(name):
+    '''Raise ValueError unless name is a CONFIG_ symbol name.'''
+    if not _NAME.match(name):
+        raise ValueError('invalid symbol {}: expected CONFIG_NAME'.format(
+            name))
+
+
+def _symbol(line):
+    match = _ASSIGNMENT.match(line) or _NOT_SET.match(line)
+    return match.group(1) if match else None
+
+
+def _line(name, value):
+    if value is None:
+        return '# {} is not set'.format(name)
+    return '{}={}'.format(name, value)
+
+
+def edit(path, changes):
+    '''Apply changes to the .config file at path.
+
+    changes maps symbol names to values, or None to unset them. The
+    file is only rewritten if its contents change, so its
+    modification time (which build systems go by) is otherwise left
+    alone. Returns (changed, missing): whether the file was rewritten,
+    and the symbols set which weren't in it (their settings are
+    appended; a symbol that's missing may not exist, or have unmet
+    dependencies).'''
+    with open(path, 'r') as f:
+        lines = f.read().splitlines()
+
+    found = set()
+    new_lines = []
+    for line in lines:
+        name = _symbol(line)
+        if name in changes:
+            line = _line(name, changes[name])
+            found.add(name)
+        new_lines.append(line)
+    # A symbol which isn't there is already unset.
+    missing = sorted(name for name, value in changes.items()
+                     if name not in found and value is not None)
+    new_lines.extend(_line(name, changes[name]) for name in missing)
+
+    if new_lines == lines:
+        return False, missing
+    tmp = '{}.{}'.format(path, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write('\n'.join(new_lines) + '\n')
+    os.replace(tmp, path)
+    return True, missing
@@ -0,0 +1,281 @@
+# Copyright (c) 2018 Foundries.io Limited.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+'''Sharing identical files between build trees.
+
+Build trees for apps on the same board have many byte-identical files
+(generated headers, kernel object files, libraries). dedup() finds
+them by content and makes the copies share disk space, either as
+reflinks or as hardlinks.
+
+A reflink (FICLONE) shares the data blocks of two files until either
+is written to, so nothing else changes: the copies keep their own
+inodes, permissions and modification times. Only some file systems
+(like Btrfs and XFS) support them.
+
+Hardlinks work everywhere, but the copies become the same file, so
+writing to one would change them all. They are made read-only, and
+whatever zmp is about to write to a tree first calls unshare(), which
+turns its hardlinked files back into private copies with their
+original permissions and modification times.
+
+Each tree gets a record (DEDUP_FILE) of its deduplicated files and
+their content hashes, so files which are still shared don't have to
+be hashed or shared again.'''
+
+import collections
+import contextlib
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import stat
+
+# Linux FICLONE ioctl request: _IOW(0x94, 9, int).
+FICLONE = 0x40049409
+
+# Record of deduplicated files, in each tree.
+DEDUP_FILE = '.zmp-dedup.json'
+
+# Files never shared: they're rewritten in place, or are zmp's own.
+SKIP_FILES = {DEDUP_FILE, '.zmp-lock', '.zmp-last-used', 'CMakeCache.txt',
+              '.ninja_log', '.ninja_deps'}
+
+# Errors meaning a file system can't do reflinks.
+_NO_REFLINK_ERRNOS = {errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL,
+                      errno.ENOSYS, errno.EXDEV}
+
+_READ_ONLY = ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH)
+
+_HASH_BLOCK = 1 << 20
+
+# What dedup() did.
+#
+# - files: how many files now share another's data
+# - reclaimed: bytes of disk space freed
+# - reflinked, hardlinked: how many files were shared each way
+# - unsupported: how many files weren't shared because the file system
+#   can't do reflinks, and hardlinks weren't allowed
+# - errors: (path, OSError) tuples for files which couldn't be shared
+DedupResult = collections.namedtuple(
+    'DedupResult', 'files reclaimed reflinked hardlinked unsupported errors')
+
+
+def reflink(src, dst):
+    '''Make dst a reflink of src, keeping dst's permissions and
+    modification time. Raises OSError if that isn't possible.'''
+    tmp = dst + '.zmp-dedup'
+    with open(src, 'rb') as fsrc:
+        with open(tmp, 'wb') as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            except OSError:
+                fdst.close()
+                os.remove(tmp)
+                raise
+    shutil.copystat(dst, tmp)
+    os.replace(tmp, dst)
+
+
+def _hardlink(src, dst):
+    tmp = dst + '.zmp-dedup'
+    os.link(src, tmp)
+    os.replace(tmp, dst)
+
+
+def _file_hash(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(_HASH_BLOCK), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def _load_record(tree):
+    try:
+        with open(os.path.join(tree, DEDUP_FILE), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_record(tree, record):
+    path = os.path.join(tree, DEDUP_FILE)
+    if not record:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+        return
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(record, f, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def _record(records, f, method, digest, current_mtime_ns):
+    # mode and mtime_ns are what unshare() restores, so a file which
+    # was already hardlinked keeps its original ones. current_mtime_ns
+    # tells whether the file changed since.
+    old = records[f.tree].get(f.rel)
+    if old is not None and old['method'] == 'hardlink' and \
+       old['sha256'] == digest:
+        method, mode, mtime_ns = 'hardlink', old['mode'], old['mtime_ns']
+    else:
+        mode, mtime_ns = stat.S_IMODE(f.st.st_mode), f.st.st_mtime_ns
+    records[f.tree][f.rel] = {
+        'method': method,
+        'sha256': digest,
+        'size': f.st.st_size,
+        'mode': mode,
+        'mtime_ns': mtime_ns,
+        'current_mtime_ns': current_mtime_ns,
+    }
+
+
+class _File:
+
+    def __init__(self, tree, rel, st):
+        self.tree = tree
+        self.rel = rel
+        self.path = os.path.join(tree, rel)
+        self.st = st
+
+
+def _walk(tree, min_size):
+    for root, dirs, files in os.walk(tree):
+        for name in files:
+            if name in SKIP_FILES:
+                continue
+            path = os.path.join(root, name)
+            try:
+                st = os.lstat(path)
+            except FileNotFoundError:
+                continue
+            if stat.S_ISREG(st.st_mode) and st.st_size >= min_size:
+                yield _File(tree, os.path.relpath(path, tree), st)
+
+
+def dedup(trees, min_size=4096, hardlink=False, dry_run=False):
+    '''Share identical files among trees.
+
+    Files smaller than min_size are left alone. Reflinks are used
+    where possible; if hardlink is True, hardlinks are used where they
+    aren't. The caller must make sure nothing else uses the trees
+    meanwhile. Returns a DedupResult.'''
+    records = {tree: _load_record(tree) for tree in trees}
+
+    by_size = collections.defaultdict(list)
+    for tree in trees:
+        for f in _walk(tree, min_size):
+            by_size[f.st.st_size].append(f)
+
+    by_hash = collections.defaultdict(list)
+    for size, files in by_size.items():
+        if len(files) < 2:
+            continue
+        for f in files:
+            entry = records[f.tree].get(f.rel)
+            if entry is not None and entry['size'] == size and \
+               entry['current_mtime_ns'] == f.st.st_mtime_ns:
+                f.hash = entry['sha256']
+            else:
+                f.hash = _file_hash(f.path)
+            by_hash[(size, f.hash)].append(f)
+
+    no_reflink = set()
+    files = reclaimed = reflinked = hardlinked = unsupported = 0
+    errors = []
+    for (size, digest), group in sorted(by_hash.items(),
+                                        key=lambda item: item[0]):
+        if len(group) < 2:
+            continue
+        # Keep the file with the most links, so existing hardlinks
+        # don't get broken up.
+        group.sort(key=lambda f: (-f.st.st_nlink, f.path))
+        keep = group[0]
+        for f in group[1:]:
+            if (f.st.st_dev, f.st.st_ino) == (keep.st.st_dev,
+                                              keep.st.st_ino):
+                continue
+            entry = records[f.tree].get(f.rel)
+            keep_entry = records[keep.tree].get(keep.rel)
+            if entry is not None and keep_entry is not None and \
+               entry['method'] == 'reflink' and \
+               entry['current_mtime_ns'] == f.st.st_mtime_ns and \
+               entry['sha256'] == keep_entry['sha256']:
+                # Reflinked by an earlier run.
+                continue
+            freed = f.st.st_blocks * 512 if f.st.st_nlink == 1 else 0
+            if dry_run:
+                files += 1
+                reclaimed += freed
+                continue
+
+            method = None
+            if f.st.st_dev not in no_reflink:
+                try:
+                    reflink(keep.path, f.path)
+                    method = 'reflink'
+                except OSError as e:
+                    if e.errno not in _NO_REFLINK_ERRNOS:
+                        errors.append((f.path, e))
+                        continue
+                    no_reflink.add(f.st.st_dev)
+            if method is None and hardlink:
+                try:
+                    if keep.st.st_mode & ~_READ_ONLY:
+                        os.chmod(keep.path, keep.st.st_mode & _READ_ONLY)
+                    _hardlink(keep.path, f.path)
+                    method = 'hardlink'
+                except OSError as e:
+                    errors.append((f.path, e))
+                    continue
+            if method is None:
+                unsupported += 1
+                continue
+
+            _record(records, keep, 'hardlink' if method == 'hardlink'
+                    else 'reflink', digest, keep.st.st_mtime_ns)
+            _record(records, f, method, digest, keep.st.st_mtime_ns
+                    if method == 'hardlink' else f.st.st_mtime_ns)
+            files += 1
+            reclaimed += freed
+            if method == 'reflink':
+                reflinked += 1
+            else:
+                hardlinked += 1
+
+    if not dry_run:
+        for tree, record in records.items():
+            _save_record(tree, record)
+    return DedupResult(files, reclaimed, reflinked, hardlinked, unsupported,
+                       errors)
+
+
+def unshare(tree):
+    '''Give tree private, writable copies of its hardlinked files.
+
+    Call this before writing to a tree which dedup() may have used.
+    Reflinked files need nothing done, since writing to one doesn't
+    affect the others.'''
+    record = _load_record(tree)
+    if not any(entry['method'] == 'hardlink' for entry in record.values()):
+        return
+    for rel, entry in record.items():
+        if entry['method'] != 'hardlink':
+            continue
+        path = os.path.join(tree, rel)
+        try:
+            st = os.lstat(path)
+        except FileNotFoundError:
+            continue
+        if st.st_nlink > 1:
+            tmp = path + '.zmp-dedup'
+            shutil.copyfile(path, tmp)
+            os.replace(tmp, path)
+        os.chmod(path, entry['mode'])
+        os.utime(path, ns=(entry['mtime_ns'], entry['mtime_ns']))
+    _save_record(tree, {rel: entry for rel, entry in record.items()
+                        if entry['method'] != 'hardlink'})
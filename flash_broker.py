@@ -0,0 +1,138 @@
+# Copyright (c) 2018 Foundries.io Limited.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+'''First come, first served access to boards for flashing.
+
+Every board (by --board-id, i.e. debug probe) has a queue directory.
+A flash request takes a numbered ticket, waits until every ticket
+before it is gone, then flashes and throws its ticket away. Requests
+for different boards never wait for each other.
+
+Tickets are files held with flock() by the process that took them,
+so the tickets of processes that died are noticed and skipped. The
+queues live in a directory shared by every zmp process on the host
+(ZMP_FLASH_BROKER_DIR, or zmp-flash in the temporary directory).'''
+
+import contextlib
+import fcntl
+import os
+import re
+import tempfile
+import time
+
+_SEQ_FILE = 'seq'
+_LOCK_FILE = 'lock'
+_TICKET_PREFIX = 'ticket-'
+
+
+def default_directory():
+    return os.environ.get('ZMP_FLASH_BROKER_DIR',
+                          os.path.join(tempfile.gettempdir(), 'zmp-flash'))
+
+
+def _queue_name(board_id):
+    return re.sub(r'[^A-Za-z0-9._-]', '_', board_id)
+
+
+@contextlib.contextmanager
+def _flocked(path, flags=fcntl.LOCK_EX):
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+    try:
+        fcntl.flock(fd, flags)
+        yield fd
+    finally:
+        os.close(fd)
+
+
+class FlashBroker:
+    '''Queues flash requests by board ID.
+
+    - directory: where the queues are kept (default_directory() if None)
+    - poll_interval: seconds between checks of a queue while waiting
+    - on_wait: if given, called with (board_id, number of requests
+      ahead) when a request has to wait, and whenever that number
+      changes'''
+
+    def __init__(self, directory=None, poll_interval=0.2, on_wait=None):
+        self.directory = directory or default_directory()
+        self.poll_interval = poll_interval
+        self.on_wait = on_wait
+
+    def _queue(self, board_id):
+        queue = os.path.join(self.directory, _queue_name(board_id))
+        os.makedirs(queue, exist_ok=True)
+        return queue
+
+    def _take_ticket(self, queue):
+        # Numbering and creating (and locking) tickets happen under
+        # the sequence lock, so a queue listed under it is complete.
+        with _flocked(os.path.join(queue, _SEQ_FILE)) as seq_fd:
+            raw = os.pread(seq_fd, 32, 0)
+            seq = int(raw) + 1 if raw.strip() else 0
+            os.ftruncate(seq_fd, 0)
+            os.pwrite(seq_fd, str(seq).encode('ascii'), 0)
+
+            path = os.path.join(queue, '{}{:012d}'.format(_TICKET_PREFIX,
+                                                          seq))
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        return seq, path, fd
+
+    def _ahead(self, queue, seq):
+        # Count the live tickets before ours, removing dead ones.
+        ahead = 0
+        with _flocked(os.path.join(queue, _SEQ_FILE)):
+            for name in os.listdir(queue):
+                if not name.startswith(_TICKET_PREFIX):
+                    continue
+                if int(name[len(_TICKET_PREFIX):]) >= seq:
+                    continue
+                path = os.path.join(queue, name)
+                try:
+                    fd = os.open(path, os.O_RDWR)
+                except FileNotFoundError:
+                    continue
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    ahead += 1
+                else:
+                    # Nobody holds it, so its owner is gone (or is
+                    # just done with it).
+                    with contextlib.suppress(FileNotFoundError):
+                        os.unlink(path)
+                finally:
+                    os.close(fd)
+        return ahead
+
+    @contextlib.contextmanager
+    def turn(self, board_id):
+        '''Wait for board_id's turn, and hold it in the with block.'''
+        queue = self._queue(board_id)
+        seq, ticket, ticket_fd = self._take_ticket(queue)
+        try:
+            last = None
+            while True:
+                ahead = self._ahead(queue, seq)
+                if ahead == 0:
+                    break
+                if ahead != last and self.on_wait is not None:
+                    self.on_wait(board_id, ahead)
+                last = ahead
+                time.sleep(self.poll_interval)
+
+            # The queue already guarantees this; the lock also keeps
+            # out anything flashing the board without a ticket.
+            with _flocked(os.path.join(queue, _LOCK_FILE)):
+                yield
+        finally:
+            os.unlink(ticket)
+            os.close(ticket_fd)
+
+    def submit(self, board_id, flash, *args, **kwargs):
+        '''Call flash(*args, **kwargs) in board_id's turn.
+
+        Returns what flash returns.'''
+        with self.turn(board_id):
+            return flash(*args, **kwargs)
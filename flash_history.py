@@ -0,0 +1,142 @@
+# Copyright (c) 2018 Foundries.io Limited.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+'''History of flash times, for spotting slow probes.
+
+Every runner call made by 'zmp flash' is appended to a history file as
+one line of JSON, with the board, board ID (probe), what was flashed
+(mcuboot, app, or both merged), the image size, how long the call took
+and whether it succeeded. summarize() turns that into flash rates per
+probe and output, comparing recent runs with older ones: a probe or USB
+hub going bad shows up as a rate that dropped.
+
+The file is shared by every zmp process on the host (ZMP_FLASH_HISTORY,
+or flash-history.jsonl in the user's cache directory).'''
+
+import collections
+import fcntl
+import json
+import os
+import statistics
+import time
+
+import intel_hex
+
+# How many of the most recent runs are compared with the older ones.
+RECENT_RUNS = 10
+
+
+def default_path():
+    cache = os.environ.get('XDG_CACHE_HOME',
+                           os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.environ.get('ZMP_FLASH_HISTORY',
+                          os.path.join(cache, 'zmp', 'flash-history.jsonl'))
+
+
+def image_size(path):
+    '''Get the number of bytes a runner writes to flash for an image.
+
+    For a hex file, that's the data in it, not the file's size.'''
+    if path is None or not os.path.isfile(path):
+        return None
+    if path.endswith('.hex'):
+        try:
+            return intel_hex.read(path).size()
+        except intel_hex.HexError:
+            return None
+    return os.path.getsize(path)
+
+
+def record(path, board, board_id, output, runner, size, seconds, ok):
+    '''Append a flash to the history file at path.'''
+    entry = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'board': board,
+        'board_id': board_id,
+        'output': output,
+        'runner': runner,
+        'size': size,
+        'seconds': round(seconds, 3),
+        'ok': ok,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    line = json.dumps(entry, sort_keys=True) + '\n'
+    with open(path, 'a') as f:
+        # Keep lines from several processes from interleaving.
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        f.write(line)
+
+
+def read(path):
+    '''Read the entries in a history file, oldest first.'''
+    ret = []
+    try:
+        f = open(path, 'r')
+    except FileNotFoundError:
+        return ret
+    with f:
+        for line in f:
+            try:
+                ret.append(json.loads(line))
+            except ValueError:
+                # A line cut short by a crash.
+                continue
+    return ret
+
+
+def _rate(entry):
+    if not entry.get('size') or not entry.get('seconds'):
+        return None
+    return entry['size'] / entry['seconds']
+
+
+def _median(values):
+    values = [v for v in values if v is not None]
+    return statistics.median(values) if values else None
+
+
+def summarize(entries, recent=RECENT_RUNS):
+    '''Summarize history entries by probe and output.
+
+    Without a board ID, the board name stands in for the probe.
+    Returns a list of dicts, sorted by probe and output, with:
+
+    - probe, output, runner (the most recent one)
+    - runs, failures: counts
+    - last_time, last_seconds, last_rate: the most recent successful run
+    - seconds, rate: medians over the recent runs
+    - previous_rate: median over the older runs, or None
+    - trend: recent rate relative to previous_rate, like -0.3 for 30%
+      slower, or None
+
+    Rates are in bytes per second, and are None if sizes are
+    unknown.'''
+    groups = collections.OrderedDict()
+    for entry in entries:
+        probe = entry.get('board_id') or entry.get('board')
+        groups.setdefault((probe, entry.get('output')), []).append(entry)
+
+    ret = []
+    for (probe, output), group in sorted(groups.items(),
+                                         key=lambda item: str(item[0])):
+        ok = [e for e in group if e.get('ok')]
+        latest, older = ok[-recent:], ok[:-recent]
+        rate = _median(_rate(e) for e in latest)
+        previous = _median(_rate(e) for e in older)
+        ret.append({
+            'probe': probe,
+            'output': output,
+            'runner': group[-1].get('runner'),
+            'runs': len(group),
+            'failures': len(group) - len(ok),
+            'last_time': ok[-1]['time'] if ok else None,
+            'last_seconds': ok[-1]['seconds'] if ok else None,
+            'last_rate': _rate(ok[-1]) if ok else None,
+            'seconds': _median(e['seconds'] for e in latest),
+            'rate': rate,
+            'previous_rate': previous,
+            'trend': (rate / previous - 1 if rate is not None and previous
+                      else None),
+        })
+    return ret
@@ -0,0 +1,54 @@
+# Copyright (c) 2018 Foundries.io Limited.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+'''Image sizes by signing key type.
+
+'zmp build' records the size of every MCUboot and signed application
+image it produces, keyed by image name and then by key type, in a file
+at the top of the build directory. Building the same app and board
+with different key types (e.g. as build matrix variants with different
+key_type options) then shows what each signature type costs in
+bootloader and signed image size.
+
+Several processes may update the file at once.'''
+
+import fcntl
+import json
+import os
+
+
+def _read(path):
+    try:
+        with open(path, 'r') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+def record(path, image, key_type, size):
+    '''Record an image's size when built with a key type.
+
+    Returns the sizes recorded for the image before, as a dict from
+    key types to sizes in bytes.'''
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    fd = os.open(path + '.lock', os.O_RDWR | os.O_CREAT, 0o666)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        data = _read(path)
+        sizes = data.get(image)
+        if not isinstance(sizes, dict):
+            sizes = {}
+        previous = dict(sizes)
+        if sizes.get(key_type) != size:
+            sizes[key_type] = size
+            data[image] = sizes
+            tmp = '{}.{}'.format(path, os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump(data, f, indent=1, sort_keys=True)
+                f.write('\n')
+            os.replace(tmp, path)
+    finally:
+        os.close(fd)
+    return previous
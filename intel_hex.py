@@ -0,0 +1,182 @@
+# Copyright (c) 2018 Foundries.io Limited.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+'''Minimal Intel HEX reading, merging and writing.
+
+This is just enough to combine images meant for different parts of
+flash (like MCUboot and a signed application) into a single file, so
+they can be flashed together.'''
+
+import binascii
+import struct
+
+_DATA = 0x00
+_EOF = 0x01
+_EXT_SEGMENT_ADDR = 0x02
+_START_SEGMENT_ADDR = 0x03
+_EXT_LINEAR_ADDR = 0x04
+_START_LINEAR_ADDR = 0x05
+
+# Data bytes per record written.
+RECORD_SIZE = 16
+
+
+class HexError(ValueError):
+    '''A file isn't valid Intel HEX, or images can't be merged.'''
+
+
+class Image:
+    '''Data to load at absolute addresses.
+
+    segments maps start addresses to bytearrays of contiguous data.
+    start is the start (entry point) address record, as (type, value),
+    or None.'''
+
+    def __init__(self):
+        self.segments = {}
+        self.start = None
+
+    def add(self, address, data, what='image'):
+        '''Add data at address. Raises HexError if it overlaps data
+        already in the image with different contents.'''
+        end = address + len(data)
+        for seg_start, seg in self.segments.items():
+            seg_end = seg_start + len(seg)
+            lo, hi = max(address, seg_start), min(end, seg_end)
+            if lo < hi and seg[lo - seg_start:hi - seg_start] != \
+               data[lo - address:hi - address]:
+                raise HexError('{}: data at 0x{:08x} overlaps existing '
+                               'data'.format(what, lo))
+        self.segments[address] = bytearray(data)
+        self._coalesce()
+
+    def _coalesce(self):
+        merged = {}
+        cur_start = cur = None
+        for start in sorted(self.segments):
+            seg = self.segments[start]
+            if cur is not None and start <= cur_start + len(cur):
+                # Adjacent or overlapping (with equal contents).
+                overlap = cur_start + len(cur) - start
+                cur.extend(seg[overlap:])
+            else:
+                cur_start, cur = start, bytearray(seg)
+                merged[cur_start] = cur
+        self.segments = merged
+
+    def merge(self, other, what='image'):
+        for address, data in sorted(other.segments.items()):
+            self.add(address, data, what=what)
+        if other.start is not None:
+            if self.start is not None and self.start != other.start:
+                raise HexError('{}: conflicting start addresses'.format(what))
+            self.start = other.start
+
+    def size(self):
+        return sum(len(seg) for seg in self.segments.values())
+
+
+def read(path):
+    '''Read an Intel HEX file into an Image.'''
+    image = Image()
+    base = 0
+    chunks = []
+    with open(path, 'r') as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            where = '{}:{}'.format(path, lineno)
+            if not line.startswith(':'):
+                raise HexError('{}: missing start code'.format(where))
+            try:
+                record = binascii.unhexlify(line[1:])
+            except (binascii.Error, ValueError):
+                raise HexError('{}: bad hex digits'.format(where))
+            if len(record) < 5 or len(record) != record[0] + 5:
+                raise HexError('{}: bad record length'.format(where))
+            if sum(record) & 0xff:
+                raise HexError('{}: bad checksum'.format(where))
+
+            count, offset, rtype = record[0], (record[1] << 8) | record[2], \
+                record[3]
+            data = record[4:4 + count]
+            if rtype == _DATA:
+                chunks.append((base + offset, data))
+            elif rtype == _EOF:
+                break
+            elif rtype == _EXT_SEGMENT_ADDR:
+                base = struct.unpack('>H', data)[0] << 4
+            elif rtype == _EXT_LINEAR_ADDR:
+                base = struct.unpack('>H', data)[0] << 16
+            elif rtype in (_START_SEGMENT_ADDR, _START_LINEAR_ADDR):
+                image.start = (rtype, bytes(data))
+            else:
+                raise HexError('{}: unknown record type {}'.format(
+                    where, rtype))
+
+    # Group contiguous records before adding, which is much faster
+    # than adding them one by one.
+    run_start = run = None
+    for address, data in chunks:
+        if run is not None and address == run_start + len(run):
+            run.extend(data)
+            continue
+        if run is not None:
+            image.add(run_start, run, what=path)
+        run_start, run = address, bytearray(data)
+    if run is not None:
+        image.add(run_start, run, what=path)
+    return image
+
+
+def read_bin(path, address):
+    '''Read a binary file to be loaded at address into an Image.'''
+    image = Image()
+    with open(path, 'rb') as f:
+        image.add(address, f.read(), what=path)
+    return image
+
+
+def _record(rtype, offset, data):
+    record = bytes([len(data), (offset >> 8) & 0xff, offset & 0xff,
+                    rtype]) + bytes(data)
+    checksum = (-sum(record)) & 0xff
+    return ':' + binascii.hexlify(record + bytes([checksum])).decode(
+        'ascii').upper() + '\n'
+
+
+def write(image, path):
+    '''Write an Image to path as Intel HEX.'''
+    with open(path, 'w') as f:
+        upper = None
+        for start in sorted(image.segments):
+            seg = image.segments[start]
+            pos = 0
+            while pos < len(seg):
+                address = start + pos
+                if address >> 16 != upper:
+                    upper = address >> 16
+                    f.write(_record(_EXT_LINEAR_ADDR, 0,
+                                    struct.pack('>H', upper)))
+                # Don't let a record cross a 64 KiB boundary.
+                count = min(RECORD_SIZE, len(seg) - pos,
+                            0x10000 - (address & 0xffff))
+                f.write(_record(_DATA, address & 0xffff,
+                                seg[pos:pos + count]))
+                pos += count
+        if image.start is not None:
+            f.write(_record(image.start[0], 0, image.start[1]))
+        f.write(_record(_EOF, 0, b''))
+
+
+def merge_files(paths, out_path):
+    '''Merge Intel HEX files into one, raising HexError on overlaps.
+
+    Returns the merged Image.'''
+    merged = Image()
+    for path in paths:
+        merged.merge(read(path), what=path)
+    write(merged, out_path)
+    return merged
@@ -0,0 +1,72 @@
+# Copyright (c) 2018 Foundries.io Limited.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+'''Compressed per-job logs.
+
+A JobLog collects the output of every command run for one job (like
+building one app for one board) into its own gzip-compressed file,
+instead of the terminal. It remembers the last few lines, to show if
+the job fails, and follows Ninja's "[done/total]" status lines so a
+progress indicator can be shown instead of the raw output.'''
+
+import collections
+import gzip
+import os
+import re
+import threading
+
+# Ninja's status line prefix.
+NINJA_PROGRESS = re.compile(r'\[(\d+)/(\d+)\] ')
+
+
+class JobLog:
+    '''Log file for one job. Use as a context manager.
+
+    - name: what the job is, for humans
+    - path: the log file; parent directories are created as needed
+    - tail_lines: how many of the last lines to remember
+    - on_progress: if given, called with (log, done, total) for each
+      Ninja status line'''
+
+    def __init__(self, name, path, tail_lines=50, on_progress=None):
+        self.name = name
+        self.path = path
+        self.tail = collections.deque(maxlen=tail_lines)
+        self.on_progress = on_progress
+        self.lines = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._file = gzip.open(path, 'wt', encoding='utf-8',
+                               errors='replace')
+        self._lock = threading.Lock()
+
+    def _write(self, text):
+        with self._lock:
+            self._file.write(text + '\n')
+            self.tail.append(text)
+            self.lines += 1
+
+    def command(self, command):
+        '''Record the start of a command, as a string.'''
+        self._write('$ ' + command)
+
+    def line(self, text):
+        '''Record a line of output.
+
+        This can be used as a jobrunner.Job on_line callback; it never
+        asks for the job to be stopped.'''
+        self._write(text)
+        match = NINJA_PROGRESS.match(text)
+        if match is not None and self.on_progress is not None:
+            self.on_progress(self, int(match.group(1)), int(match.group(2)))
+        return False
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
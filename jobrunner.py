@@ -0,0 +1,240 @@
+# Copyright (c) 2018 Foundries.io Limited.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+'''asyncio-based child process runner.
+
+This runs child processes on an asyncio event loop, so several of
+them can run at once. Each job can have its own timeout, can have its
+output streamed line by line with a prefix, and is cancelled (its
+child killed) if a sibling job fails.
+
+The synchronous check_call() and check_output() wrappers behave like
+their subprocess module equivalents: they raise CalledProcessError if
+the child fails, and TimeoutExpired if it runs out of time.'''
+
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+
+# Maximum length of an output line read from a child.
+LINE_LIMIT = 2 ** 20
+
+# Seconds a child stopped by on_line gets to exit after SIGTERM,
+# before it's killed.
+STOP_GRACE = 5
+
+
+class Job:
+    '''A child process to run.
+
+    - command: argument list
+    - cwd, env: as for subprocess.Popen
+    - timeout: seconds after which the child is killed, or None
+    - prefix: if not None, each line of output is written to the
+      output stream, starting with this string
+    - capture: if True, stdout is collected and becomes the job's result
+    - on_line: if given, called with each line of output (without
+      the newline). If it returns a true value, the child is terminated
+      and the job is considered successful.
+
+    Without a prefix or on_line, the child inherits this process's
+    stdout and stderr, just like subprocess.check_call().'''
+
+    def __init__(self, command, cwd=None, env=None, timeout=None,
+                 prefix=None, capture=False, on_line=None):
+        self.command = command
+        self.cwd = cwd
+        self.env = env
+        self.timeout = timeout
+        self.prefix = prefix
+        self.capture = capture
+        self.on_line = on_line
+
+        self.returncode = None
+        '''the child's exit status, once it has finished'''
+
+        self.stopped = False
+        '''True if the child was terminated because on_line asked'''
+
+    @property
+    def streams_output(self):
+        return self.prefix is not None or self.on_line is not None
+
+    @property
+    def own_process_group(self):
+        # Children whose output we read don't need the terminal, so
+        # they get a process group of their own. That lets us kill any
+        # grandchildren along with them, which would otherwise keep
+        # the output pipe open after the child is gone.
+        return self.capture or self.streams_output
+
+
+def _signal(job, proc, signum):
+    if proc.returncode is not None:
+        return
+    try:
+        if job.own_process_group:
+            os.killpg(proc.pid, signum)
+        else:
+            proc.send_signal(signum)
+    except ProcessLookupError:
+        pass
+
+
+def _kill(job, proc):
+    _signal(job, proc, signal.SIGKILL)
+
+
+async def _read_all(reader):
+    return await reader.read()
+
+
+async def _pump_lines(job, proc, reader, stream):
+    while True:
+        line = await reader.readline()
+        if not line:
+            break
+        text = line.decode(sys.getdefaultencoding(), errors='replace')
+        if job.prefix is not None:
+            stream.write(job.prefix + text)
+            if not text.endswith('\n'):
+                stream.write('\n')
+            stream.flush()
+        if job.on_line is not None and job.on_line(text.rstrip('\r\n')):
+            job.stopped = True
+            _signal(job, proc, signal.SIGTERM)
+            killer = asyncio.get_event_loop().call_later(STOP_GRACE, _kill,
+                                                         job, proc)
+            try:
+                # Keep reading (and dropping) the output, or a child
+                # which is slow to exit could block on a full pipe.
+                while await reader.read(LINE_LIMIT):
+                    pass
+                await proc.wait()
+            finally:
+                killer.cancel()
+            break
+    return None
+
+
+async def _run_job(job, stream):
+    PIPE = asyncio.subprocess.PIPE
+    if job.capture:
+        stdout = PIPE
+        stderr = PIPE if job.streams_output else None
+    elif job.streams_output:
+        stdout = PIPE
+        stderr = asyncio.subprocess.STDOUT
+    else:
+        stdout = stderr = None
+
+    proc = await asyncio.create_subprocess_exec(
+        *job.command, cwd=job.cwd, env=job.env, stdout=stdout, stderr=stderr,
+        start_new_session=job.own_process_group, limit=LINE_LIMIT)
+
+    waiters = []
+    if job.capture:
+        waiters.append(_read_all(proc.stdout))
+    if job.streams_output:
+        reader = proc.stderr if job.capture else proc.stdout
+        waiters.append(_pump_lines(job, proc, reader, stream))
+    waiters.append(proc.wait())
+
+    try:
+        results = await asyncio.wait_for(asyncio.gather(*waiters),
+                                         job.timeout)
+    except asyncio.TimeoutError:
+        _kill(job, proc)
+        await proc.wait()
+        raise subprocess.TimeoutExpired(job.command, job.timeout)
+    except asyncio.CancelledError:
+        _kill(job, proc)
+        await proc.wait()
+        raise
+
+    job.returncode = proc.returncode
+    output = results[0] if job.capture else None
+    if job.returncode != 0 and not job.stopped:
+        raise subprocess.CalledProcessError(job.returncode, job.command,
+                                            output=output)
+    return output
+
+
+async def _run_all(jobs, stream, max_jobs):
+    semaphore = asyncio.Semaphore(max_jobs) if max_jobs else None
+
+    async def run_one(job):
+        if semaphore is None:
+            return await _run_job(job, stream)
+        async with semaphore:
+            return await _run_job(job, stream)
+
+    tasks = [asyncio.ensure_future(run_one(job)) for job in jobs]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+    finally:
+        # Whether a job failed or we were cancelled ourselves, make
+        # sure no children are left running behind our backs.
+        pending = [t for t in tasks if not t.done()]
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.wait(pending)
+
+    # Report the failure of the first job, in submission order,
+    # that didn't succeed on its own.
+    for task in tasks:
+        if not task.cancelled() and task.exception() is not None:
+            raise task.exception()
+    return [task.result() for task in tasks]
+
+
+def _run_until_complete(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    except KeyboardInterrupt:
+        # Children in their own process groups didn't see the
+        # interrupt; cancel everything so they get killed.
+        tasks = asyncio.all_tasks(loop)
+        for task in tasks:
+            task.cancel()
+        loop.run_until_complete(asyncio.gather(*tasks,
+                                               return_exceptions=True))
+        raise
+    finally:
+        loop.close()
+
+
+def run_jobs(jobs, stream=None, max_jobs=None):
+    '''Run Job instances concurrently and wait for them to finish.
+
+    At most max_jobs children run at a time (no limit if None). If
+    any job fails, all the others are cancelled, and the first
+    failure's exception is raised. Otherwise, returns a list of job
+    results, in the same order as the jobs argument. (A job's result
+    is its captured stdout as bytes, or None if it wasn't captured.)'''
+    if stream is None:
+        stream = sys.stdout
+    return _run_until_complete(_run_all(list(jobs), stream, max_jobs))
+
+
+def check_call(command, cwd=None, env=None, timeout=None, prefix=None,
+               on_line=None, stream=None):
+    '''Run a command and wait for it, like subprocess.check_call().'''
+    job = Job(command, cwd=cwd, env=env, timeout=timeout, prefix=prefix,
+              on_line=on_line)
+    run_jobs([job], stream=stream)
+    return job.returncode
+
+
+def check_output(command, cwd=None, env=None, timeout=None, prefix=None,
+                 on_line=None, stream=None):
+    '''Run a command and return its stdout as bytes, like
+    subprocess.check_output().'''
+    job = Job(command, cwd=cwd, env=env, timeout=timeout, prefix=prefix,
+              on_line=on_line, capture=True)
+    return run_jobs([job], stream=stream)[0]
@@ -0,0 +1,125 @@
+# Copyright (c) 2018 Foundries.io Limited.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+'''Job token pool, capping how many compilers run at once.
+
+Each build takes some tokens from a pool before starting, runs with
+one parallel job per token, and gives them back when it finishes. A
+pool's tokens are slot files in a directory, each held with flock()
+while taken, so a pool in a shared directory limits builds in every
+zmp process on the host, and the tokens of a process which dies are
+returned automatically. Without a directory, a private one is used,
+which limits builds in this process only.
+
+Ninja can't share tokens with a running build (it isn't a GNU make
+jobserver client), so a build keeps the tokens it started with until
+it finishes.'''
+
+import fcntl
+import os
+import random
+import tempfile
+import threading
+
+# How long to wait before looking for tokens released by other
+# processes. Releases within the process wake waiters up right away.
+POLL_INTERVAL = 0.2
+
+_SLOT_FORMAT = 'slot-{}'
+
+# Pools by directory (None for this process's private pool).
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class Tokens:
+    '''Tokens taken from a pool. Use as a context manager.'''
+
+    def __init__(self, pool, fds):
+        self.pool = pool
+        self.fds = fds
+
+    @property
+    def count(self):
+        return len(self.fds)
+
+    def release(self):
+        fds, self.fds = self.fds, []
+        self.pool._release(fds)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class TokenPool:
+    '''A pool of size job tokens, kept in directory.
+
+    If directory is None, a private temporary directory is used.'''
+
+    def __init__(self, size, directory=None):
+        if size < 1:
+            raise ValueError('a token pool needs at least one token')
+        self.size = size
+        if directory is None:
+            self._tmp = tempfile.TemporaryDirectory(prefix='zmp-tokens-')
+            directory = self._tmp.name
+        else:
+            self._tmp = None
+            os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self._cond = threading.Condition()
+
+    def _try_take(self, wanted):
+        fds = []
+        # Start at a random slot, so processes don't all contend for
+        # the first few.
+        start = random.randrange(self.size)
+        for i in range(self.size):
+            if len(fds) == wanted:
+                break
+            path = os.path.join(self.directory,
+                                _SLOT_FORMAT.format((start + i) % self.size))
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                continue
+            fds.append(fd)
+        return fds
+
+    def acquire(self, wanted):
+        '''Take between 1 and wanted tokens, waiting for at least one.
+
+        Returns a Tokens instance.'''
+        wanted = max(1, min(wanted, self.size))
+        with self._cond:
+            while True:
+                fds = self._try_take(wanted)
+                if fds:
+                    return Tokens(self, fds)
+                self._cond.wait(POLL_INTERVAL)
+
+    def _release(self, fds):
+        for fd in fds:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+        with self._cond:
+            self._cond.notify_all()
+
+
+def pool(size, directory=None):
+    '''Get the token pool for directory, creating it if needed.
+
+    Every caller in this process gets the same pool for the same
+    directory (or the same private pool, if directory is None). The
+    size is fixed by the first caller.'''
+    key = os.path.realpath(directory) if directory is not None else None
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = TokenPool(size, directory=directory)
+        return _pools[key]
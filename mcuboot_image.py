@@ -0,0 +1,237 @@
+# Copyright (c) 2018 Foundries.io Limited.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+'''Reader for MCUboot signed images.
+
+A signed image is an image header, followed by the binary, followed
+by an optional protected TLV (type-length-value) area and a TLV area
+holding the image hash and signature. Images padded to the slot size
+end with the image trailer magic.
+
+Images are memory mapped, and parsed in place.'''
+
+import binascii
+import hashlib
+import mmap
+import os
+import struct
+
+IMAGE_MAGIC = 0x96f3b83d
+IMAGE_MAGIC_V1 = 0x96f3b83c
+
+# struct image_header
+HEADER_FORMAT = '<IIHHIIBBHII'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+# struct image_tlv_info and struct image_tlv
+TLV_INFO_FORMAT = '<HH'
+TLV_FORMAT = '<BBH'
+TLV_INFO_MAGIC = 0x6907
+TLV_PROT_INFO_MAGIC = 0x6908
+
+# Image trailer magic, at the end of padded images.
+TRAILER_MAGIC = bytes([0x77, 0xc2, 0x95, 0xf3, 0x60, 0xd2, 0xef, 0x7f,
+                       0x35, 0x52, 0x50, 0x0f, 0x2c, 0xb6, 0x79, 0x80])
+
+TLV_KEYHASH = 0x01
+TLV_PUBKEY = 0x02
+
+# Hash TLVs, by type: (name, hashlib constructor).
+HASH_TLVS = {
+    0x10: ('SHA256', hashlib.sha256),
+    0x11: ('SHA384', hashlib.sha384),
+    0x12: ('SHA512', hashlib.sha512),
+}
+
+# Signature TLVs, by type.
+SIGNATURE_TLVS = {
+    0x20: 'RSA2048-PSS',
+    0x21: 'ECDSA224',
+    0x22: 'ECDSA256',
+    0x23: 'RSA3072-PSS',
+    0x24: 'ED25519',
+}
+
+# Image header flags.
+FLAGS = {
+    0x01: 'PIC',
+    0x04: 'ENCRYPTED_AES128',
+    0x08: 'ENCRYPTED_AES256',
+    0x10: 'NON_BOOTABLE',
+    0x20: 'RAM_LOAD',
+}
+
+
+class ImageError(ValueError):
+    '''A file isn't a valid MCUboot image, or doesn't fit its slot.'''
+
+
+class ImageInfo:
+    '''What was found in a signed image.
+
+    Sizes and offsets are in bytes. tlvs is a list of (type, offset,
+    length) tuples for each TLV's value, in file order.'''
+
+    def __init__(self, path):
+        self.path = path
+        self.file_size = 0
+        self.load_addr = 0
+        self.hdr_size = 0
+        self.protect_tlv_size = 0
+        self.img_size = 0
+        self.flags = 0
+        self.version = None
+        self.tlvs = []
+        self.tlv_size = 0
+        self.padded = False
+        self.hash_type = None
+        self.hash = None
+        self.hash_ok = None
+        self.signature_type = None
+        self.signature_size = 0
+        self.key_hash = None
+
+    @property
+    def total_size(self):
+        '''Size of the image proper: header, binary and TLVs.'''
+        return self.hdr_size + self.img_size + self.tlv_size
+
+    @property
+    def flag_names(self):
+        return [name for bit, name in sorted(FLAGS.items())
+                if self.flags & bit]
+
+    def slot_free(self, slot_size):
+        '''Bytes left in a slot of the given size, or negative if the
+        image doesn't fit.'''
+        return slot_size - self.total_size
+
+    def as_dict(self):
+        return {
+            'path': self.path,
+            'file_size': self.file_size,
+            'load_addr': self.load_addr,
+            'hdr_size': self.hdr_size,
+            'protect_tlv_size': self.protect_tlv_size,
+            'img_size': self.img_size,
+            'tlv_size': self.tlv_size,
+            'total_size': self.total_size,
+            'flags': self.flag_names,
+            'version': self.version,
+            'padded': self.padded,
+            'hash_type': self.hash_type,
+            'hash': self.hash,
+            'hash_ok': self.hash_ok,
+            'signature_type': self.signature_type,
+            'signature_size': self.signature_size,
+            'key_hash': self.key_hash,
+        }
+
+
+def _parse_tlv_area(info, buf, offset, magic):
+    # Returns the offset just past the TLV area at offset, which
+    # must start with a TLV info header with the given magic.
+    if offset + 4 > len(buf):
+        raise ImageError('{}: truncated before TLV area'.format(info.path))
+    found_magic, total = struct.unpack_from(TLV_INFO_FORMAT, buf, offset)
+    if found_magic != magic:
+        raise ImageError('{}: bad TLV magic 0x{:04x} at 0x{:x}'.format(
+            info.path, found_magic, offset))
+    end = offset + total
+    if end > len(buf):
+        raise ImageError('{}: TLV area runs past end of file'.format(
+            info.path))
+
+    pos = offset + 4
+    while pos < end:
+        typ, _, length = struct.unpack_from(TLV_FORMAT, buf, pos)
+        pos += 4
+        if pos + length > end:
+            raise ImageError('{}: TLV 0x{:02x} runs past end of area'.format(
+                info.path, typ))
+        info.tlvs.append((typ, pos, length))
+        pos += length
+    return end
+
+
+def _parse(path, buf, verify):
+    info = ImageInfo(path)
+    info.file_size = len(buf)
+    if len(buf) < HEADER_SIZE:
+        raise ImageError('{}: too small to be an image'.format(path))
+
+    (magic, info.load_addr, info.hdr_size, info.protect_tlv_size,
+     info.img_size, info.flags, major, minor, revision, build,
+     _) = struct.unpack_from(HEADER_FORMAT, buf, 0)
+    if magic not in (IMAGE_MAGIC, IMAGE_MAGIC_V1):
+        raise ImageError('{}: bad image magic 0x{:08x}'.format(path, magic))
+    if magic == IMAGE_MAGIC_V1:
+        # Version 1 headers have padding instead of protected TLVs.
+        info.protect_tlv_size = 0
+    if info.hdr_size < HEADER_SIZE:
+        raise ImageError('{}: header size {} is too small'.format(
+            path, info.hdr_size))
+    info.version = '{}.{}.{}+{}'.format(major, minor, revision, build)
+
+    tlv_start = info.hdr_size + info.img_size
+    pos = tlv_start
+    if info.protect_tlv_size:
+        pos = _parse_tlv_area(info, buf, pos, TLV_PROT_INFO_MAGIC)
+    protected_end = pos
+    pos = _parse_tlv_area(info, buf, pos, TLV_INFO_MAGIC)
+    info.tlv_size = pos - tlv_start
+    info.padded = (len(buf) >= len(TRAILER_MAGIC) and
+                   buf[len(buf) - len(TRAILER_MAGIC):] == TRAILER_MAGIC)
+
+    with memoryview(buf) as view:
+        for typ, offset, length in info.tlvs:
+            with view[offset:offset + length] as value:
+                if typ in HASH_TLVS:
+                    name, constructor = HASH_TLVS[typ]
+                    info.hash_type = name
+                    info.hash = binascii.hexlify(value).decode('ascii')
+                    if verify:
+                        # The hash covers everything up to the end of
+                        # the protected TLVs.
+                        with view[:protected_end] as covered:
+                            digest = constructor(covered).digest()
+                        info.hash_ok = digest == value
+                elif typ in SIGNATURE_TLVS:
+                    info.signature_type = SIGNATURE_TLVS[typ]
+                    info.signature_size = length
+                elif typ == TLV_KEYHASH:
+                    info.key_hash = binascii.hexlify(value).decode('ascii')
+
+    return info
+
+
+def read(path, verify=False):
+    '''Read a signed image's header and TLVs.
+
+    If verify is True, the image hash is also computed and checked
+    against the hash TLV, setting hash_ok. Raises ImageError if the
+    file isn't a valid image.'''
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            raise ImageError('{}: empty file'.format(path))
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            return _parse(path, buf, verify)
+
+
+def check(path, slot_size=None):
+    '''Cheap sanity check of a signed image before using it.
+
+    Raises ImageError if the image is invalid, has no hash or
+    signature, or (if slot_size is given) doesn't fit in the slot.
+    Returns the ImageInfo otherwise.'''
+    info = read(path)
+    if info.hash is None:
+        raise ImageError('{}: no image hash TLV'.format(path))
+    if info.signature_type is None:
+        raise ImageError('{}: image is not signed'.format(path))
+    if slot_size is not None and info.slot_free(slot_size) < 0:
+        raise ImageError('{}: {} bytes does not fit in {} byte slot'.format(
+            path, info.total_size, slot_size))
+    return info
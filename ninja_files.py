@@ -0,0 +1,375 @@
+# Copyright (c) 2018 Foundries.io Limited.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+'''Readers for the files Ninja keeps in a build directory.
+
+- .ninja_log: one line per output built, with start and end times
+- .ninja_deps: binary log of each output's discovered dependencies
+  (e.g. the headers a C file included)
+
+These are enough to tell whether a build directory is up to date
+without running Ninja, and to see where build time went.'''
+
+from collections import namedtuple
+import os
+import re
+import struct
+
+LOG_FILE = '.ninja_log'
+DEPS_FILE = '.ninja_deps'
+
+_LOG_SIGNATURE = '# ninja log v'
+_DEPS_SIGNATURE = b'# ninjadeps\n'
+
+# An entry in .ninja_log.
+#
+# - start, end: milliseconds since the start of the Ninja run
+# - mtime: the output's modification time when it was built, in
+#   Ninja's units (see mtime_to_seconds())
+# - output: output path, relative to the build directory
+# - command_hash: hash of the command line which built it
+LogEntry = namedtuple('LogEntry', 'start end mtime output command_hash')
+
+# Up to date status of a build directory, from tree_status().
+#
+# - state: 'up to date', 'stale', or 'unconfigured'
+# - reason: a short explanation for a stale or unconfigured state
+TreeStatus = namedtuple('TreeStatus', 'state reason')
+
+UP_TO_DATE = 'up to date'
+STALE = 'stale'
+UNCONFIGURED = 'unconfigured'
+
+
+def mtime_to_seconds(mtime):
+    '''Convert a modification time from a Ninja file into seconds.
+
+    Ninja 1.9 and later record nanoseconds; older versions record
+    seconds. Any plausible nanosecond value is far larger than any
+    plausible second value, so this just checks the magnitude.'''
+    if mtime > 10 ** 12:
+        return mtime / 1e9
+    return float(mtime)
+
+
+def read_log(path, offset=0):
+    '''Read entries from a .ninja_log file.
+
+    Returns (entries, end_offset). If offset is given, reading starts
+    there (it should be a previous end_offset), so only entries added
+    since then are returned. Entries are in file order; when an
+    output was built more than once, the last entry is the latest.'''
+    entries = []
+    with open(path, 'rb') as f:
+        if offset == 0:
+            header = f.readline()
+            if not header.decode('utf-8', errors='replace').startswith(
+                    _LOG_SIGNATURE):
+                raise ValueError('{} is not a Ninja log'.format(path))
+            offset = len(header)
+        else:
+            f.seek(offset)
+        for line in f:
+            if not line.endswith(b'\n'):
+                # Ninja is still writing this one.
+                break
+            offset += len(line)
+            fields = line.decode('utf-8', errors='replace').rstrip(
+                '\n').split('\t')
+            if len(fields) < 4:
+                continue
+            start, end, mtime = (int(x) for x in fields[:3])
+            command_hash = fields[4] if len(fields) > 4 else ''
+            entries.append(LogEntry(start, end, mtime, fields[3],
+                                    command_hash))
+    return entries, offset
+
+
+def _log_outputs(path):
+    # Get the outputs in a .ninja_log file, as bytes. This is much
+    # faster than read_log(), for when only they are needed.
+    with open(path, 'rb') as f:
+        lines = f.read().split(b'\n')
+    if not lines[0].startswith(_LOG_SIGNATURE.encode('utf-8')):
+        raise ValueError('{} is not a Ninja log'.format(path))
+    # The last line is empty, or still being written.
+    return set(fields[3] for fields in
+               (line.split(b'\t', 4) for line in lines[1:-1])
+               if len(fields) >= 4)
+
+
+def latest_entries(entries):
+    '''Map each output to its latest LogEntry.'''
+    return {entry.output: entry for entry in entries}
+
+
+def _read_deps_records(path):
+    # Returns (paths, records): the paths in a .ninja_deps file, as
+    # bytes (decoding them all is slow, and os.stat() takes bytes),
+    # and a dict mapping the ID of each output with recorded
+    # dependencies to (mtime, input IDs), where the input IDs are a
+    # sequence of ints. Later records for an output replace earlier
+    # ones, as in Ninja.
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    if not data.startswith(_DEPS_SIGNATURE):
+        raise ValueError('{} is not a Ninja deps log'.format(path))
+    pos = len(_DEPS_SIGNATURE)
+    version, = struct.unpack_from('<i', data, pos)
+    if version not in (3, 4):
+        raise ValueError('{}: unsupported deps log version {}'.format(
+            path, version))
+    pos += 4
+    # Version 4 has 64-bit modification times.
+    mtime_words = 2 if version == 4 else 1
+
+    # Records are all a multiple of 4 bytes long, so the file can be
+    # read as an array of 32-bit words, which is much faster than
+    # unpacking each record.
+    words = memoryview(data)[pos:pos + (len(data) - pos) // 4 * 4].cast('I')
+    count = len(words)
+    paths = []
+    add_path = paths.append
+    records = {}
+    i = 0
+    while i < count:
+        head = words[i]
+        size = (head & 0x7FFFFFFF) >> 2
+        i += 1
+        if i + size > count:
+            # Truncated record, e.g. from an interrupted build.
+            break
+        if head & 0x80000000:
+            if mtime_words == 2:
+                mtime = words[i + 2] << 32 | words[i + 1]
+            else:
+                mtime = words[i + 1]
+            records[words[i]] = (mtime, words[i + 1 + mtime_words:i + size])
+        else:
+            # Path records are NUL padded to a multiple of 4 bytes,
+            # and followed by a 4-byte checksum.
+            start = pos + i * 4
+            add_path(data[start:start + size * 4 - 4].rstrip(b'\0'))
+        i += size
+
+    # Drop records naming paths which don't exist, from a corrupt file.
+    count = len(paths)
+    records = {out_id: (mtime, inputs)
+               for out_id, (mtime, inputs) in records.items()
+               if out_id < count and (not inputs or max(inputs) < count)}
+    return paths, records
+
+
+def read_deps(path):
+    '''Read a .ninja_deps file.
+
+    Returns a dict mapping each output path (relative to the build
+    directory) to an (mtime, inputs) tuple: the output's modification
+    time when its dependencies were recorded, in Ninja's units, and
+    the list of input paths discovered for it.'''
+    paths, records = _read_deps_records(path)
+    paths = [_decode(path) for path in paths]
+    return {paths[out_id]: (mtime, [paths[i] for i in inputs])
+            for out_id, (mtime, inputs) in records.items()}
+
+
+def _decode(path):
+    return path.decode('utf-8', errors='replace')
+
+
+# A build statement, up to the colon ending its outputs. '$' escapes
+# the next character (including a newline, for continuation lines).
+_BUILD_OUTPUTS = re.compile(rb'^build((?:[^:$\n]|\$[\s\S])*):', re.M)
+_INCLUDE = re.compile(rb'^(?:include|subninja)[ \t]+(\S+)', re.M)
+
+
+def _unescape_paths(text):
+    # Split a list of paths (as bytes) from a Ninja file, undoing its
+    # escaping of spaces, colons and dollar signs, and skipping '|'
+    # separators.
+    text = text.replace(b'$$', b'\1').replace(b'$ ', b'\0').replace(
+        b'$:', b':')
+    text = re.sub(rb'\$\n[ \t]*', b' ', text)
+    ret = []
+    for token in text.split():
+        if token in (b'|', b'||', b'|@'):
+            continue
+        ret.append(token.replace(b'\0', b' ').replace(b'\1', b'$'))
+    return ret
+
+
+def _manifest_outputs(outdir, manifest, seen=None):
+    # Get the outputs of every build statement in a Ninja manifest and
+    # the files it includes, as bytes, relative to the build directory.
+    if seen is None:
+        seen = set()
+    path = os.path.join(outdir, manifest)
+    if path in seen or not os.path.isfile(path):
+        return set()
+    seen.add(path)
+    with open(path, 'rb') as f:
+        data = f.read()
+    ret = set(_unescape_paths(b' '.join(
+        match.group(1) for match in _BUILD_OUTPUTS.finditer(data))))
+    for match in _INCLUDE.finditer(data):
+        included = match.group(1).decode('utf-8', errors='replace')
+        ret |= _manifest_outputs(outdir, included, seen)
+    return ret
+
+
+def _regeneration_inputs(build_ninja):
+    # CMake writes a 'build build.ninja: RERUN_CMAKE ...' statement
+    # whose inputs are every file that affects the generated build
+    # system (CMakeLists.txt files, Kconfig and conf files, etc.).
+    with open(build_ninja, 'rb') as f:
+        data = f.read()
+    start = data.find(b'\nbuild build.ninja:')
+    if start < 0:
+        return []
+    end = start + 1
+    while True:
+        end = data.find(b'\n', end)
+        if end < 0 or data[end - 1:end] != b'$':
+            break
+        end += 1
+    statement = data[start + 1:end if end >= 0 else len(data)]
+    statement = statement.replace(b'$\n', b' ').decode('utf-8',
+                                                       errors='replace')
+    # Undo Ninja's escaping of spaces and colons in paths.
+    tokens = statement.replace('$ ', '\0').replace('$:', ':').split()
+    tokens = [t.replace('\0', ' ') for t in tokens[2:]]
+    return [t for t in tokens if t not in ('|', '||', 'RERUN_CMAKE')]
+
+
+class StatCache:
+    '''Memoizes modification times of files, or None if missing.'''
+
+    def __init__(self):
+        self.mtimes = {}
+
+    def mtime(self, path):
+        try:
+            return self.mtimes[path]
+        except KeyError:
+            try:
+                ret = os.stat(path).st_mtime
+            except OSError:
+                ret = None
+            self.mtimes[path] = ret
+            return ret
+
+
+def tree_status(outdir, stat_cache=None):
+    '''Determine whether a Ninja build directory is up to date.
+
+    This is an approximation of what Ninja itself would decide, using
+    only stat() calls and Ninja's own records: the build system must
+    be newer than all its CMake inputs, every output of the build
+    system which Ninja has built must still exist, and every such
+    output with recorded dependencies must be newer than all of them.
+    Records for outputs the build system no longer has (from an
+    earlier configuration) are ignored, as Ninja does. Changed command
+    lines for outputs without recorded dependencies aren't detected.
+
+    stat_cache, if given, is a StatCache shared between calls, so
+    common inputs (like Zephyr headers) are only looked at once.'''
+    if stat_cache is None:
+        stat_cache = StatCache()
+
+    build_ninja = os.path.join(outdir, 'build.ninja')
+    if not os.path.isfile(os.path.join(outdir, 'CMakeCache.txt')):
+        return TreeStatus(UNCONFIGURED, 'no CMakeCache.txt')
+    if not os.path.isfile(build_ninja):
+        return TreeStatus(UNCONFIGURED, 'no build.ninja')
+
+    prefix = os.path.join(outdir, '')
+
+    def abs_path(path):
+        # Ninja's paths are already normalized.
+        return path if os.path.isabs(path) else prefix + path
+
+    ninja_mtime = os.stat(build_ninja).st_mtime
+    for dep in _regeneration_inputs(build_ninja):
+        dep_mtime = stat_cache.mtime(abs_path(dep))
+        if dep_mtime is None or dep_mtime > ninja_mtime:
+            return TreeStatus(STALE, '{} changed; needs reconfigure'.format(
+                dep))
+
+    log = os.path.join(outdir, LOG_FILE)
+    if not os.path.isfile(log):
+        return TreeStatus(STALE, 'never built')
+    outputs = _manifest_outputs(outdir, 'build.ninja')
+    prefix = os.fsencode(prefix)
+    for output in _log_outputs(log) & outputs:
+        if stat_cache.mtime(output if output.startswith(b'/')
+                            else prefix + output) is None:
+            return TreeStatus(STALE, '{} is missing'.format(
+                _decode(output)))
+
+    deps_path = os.path.join(outdir, DEPS_FILE)
+    if not os.path.isfile(deps_path):
+        return TreeStatus(UP_TO_DATE, '')
+    paths, records = _read_deps_records(deps_path)
+    records = {out_id: record for out_id, record in records.items()
+               if paths[out_id] in outputs}
+    if not records:
+        return TreeStatus(UP_TO_DATE, '')
+    # Look up each path's modification time once, with missing inputs
+    # counting as newer than anything.
+    mtimes = [stat_cache.mtime(path if path.startswith(b'/')
+                               else prefix + path)
+              for path in paths]
+    missing = float('inf')
+    input_mtimes = [missing if m is None else m for m in mtimes]
+    out_mtimes = [mtimes[out_id] for out_id in records]
+    if None in out_mtimes:
+        output = paths[list(records)[out_mtimes.index(None)]]
+        return TreeStatus(STALE, '{} is missing'.format(_decode(output)))
+    # Usually, everything was built after the last change to any
+    # input, which is quick to check. Otherwise, check each output.
+    used = set()
+    for _, inputs in records.values():
+        used.update(inputs)
+    if max(map(input_mtimes.__getitem__, used), default=0) <= \
+       min(out_mtimes):
+        return TreeStatus(UP_TO_DATE, '')
+    for out_id, (_, inputs) in records.items():
+        out_mtime = mtimes[out_id]
+        if not inputs or \
+           max(map(input_mtimes.__getitem__, inputs)) <= out_mtime:
+            continue
+        for i in inputs:
+            if mtimes[i] is None:
+                return TreeStatus(STALE, '{} is missing'.format(
+                    _decode(paths[i])))
+            if mtimes[i] > out_mtime:
+                return TreeStatus(STALE, '{} is newer than {}'.format(
+                    _decode(paths[i]), _decode(paths[out_id])))
+
+    return TreeStatus(UP_TO_DATE, '')
+
+
+def build_profile(entries):
+    '''Summarize the LogEntry list from one Ninja run.
+
+    Returns a dict with:
+
+    - targets: list of (output, milliseconds) pairs, slowest first
+    - cpu_ms: total time spent running commands
+    - wall_ms: time from the first command's start to the last's end
+    - parallelism: cpu_ms / wall_ms, the average number of commands
+      running at once'''
+    if not entries:
+        return {'targets': [], 'cpu_ms': 0, 'wall_ms': 0, 'parallelism': 0.0}
+
+    latest = latest_entries(entries).values()
+    targets = sorted(((e.output, e.end - e.start) for e in latest),
+                     key=lambda target: (-target[1], target[0]))
+    cpu_ms = sum(ms for _, ms in targets)
+    wall_ms = max(e.end for e in latest) - min(e.start for e in latest)
+    return {'targets': targets,
+            'cpu_ms': cpu_ms,
+            'wall_ms': wall_ms,
+            'parallelism': cpu_ms / wall_ms if wall_ms else 0.0}
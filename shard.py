@@ -0,0 +1,153 @@
+# Copyright (c) 2018 Foundries.io Limited.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+'''Splitting builds into shards, for running them on several machines.
+
+Jobs for the same app and board (every output and variant) form one
+unit, and stay together, since they share most of their sources. Each
+unit has a cost: the sum of its jobs' build times from a BuildTimes
+history file, or an estimate for jobs without history.
+
+Every machine computes the assignment on its own, so the costs must
+only depend on what they all have: the units, and a history file which
+they all read the same copy of. Costs from a machine's own history
+would give each machine different shards, building some units twice
+and others not at all.
+
+Units are assigned to shards with rendezvous (highest random weight)
+hashing: every unit ranks the shards by a hash of the unit's and the
+shard's names, and goes to the first shard in its ranking which still
+has room. A shard has room for a unit if its cost would stay under a
+bound a little above the average shard cost. The ranking only depends
+on names, so a unit usually lands on the same shard from run to run,
+even as costs change and units come and go, which keeps caches on the
+machines running each shard warm. The bound keeps one shard from
+getting much more work than the others.'''
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import statistics
+
+# How much more than the average cost a shard may get, as a fraction.
+LOAD_SLACK = 0.1
+
+# How much a new build time counts against the recorded one. Smoothing
+# keeps an occasional slow or cached build from moving units around.
+HISTORY_WEIGHT = 0.5
+
+
+def parse(spec):
+    '''Parse a shard specification, 'I/N', into (I, N).
+
+    Shards are numbered from 1 to N. Raises ValueError if spec is
+    invalid.'''
+    index, sep, count = spec.partition('/')
+    try:
+        index, count = int(index), int(count)
+    except ValueError:
+        index = count = 0
+    if not sep or count < 1 or not 1 <= index <= count:
+        raise ValueError('invalid shard {}: expected I/N, with 1 <= I <= N'.
+                         format(spec))
+    return index, count
+
+
+def _weight(unit, shard):
+    digest = hashlib.sha256('{}\0{}'.format(unit, shard).encode()).digest()
+    return int.from_bytes(digest[:8], 'big')
+
+
+def assign(costs, count):
+    '''Assign units to count shards.
+
+    costs maps unit names to their costs. Returns a dict mapping each
+    unit to its shard, from 1 to count.'''
+    if not costs:
+        return {}
+    total = sum(costs.values())
+    bound = max(total / count * (1 + LOAD_SLACK), max(costs.values()))
+    loads = [0] * (count + 1)
+    ret = {}
+    # Placing the most expensive units first leaves the cheap ones to
+    # fill in the gaps.
+    for unit in sorted(costs, key=lambda u: (-costs[u], u)):
+        ranking = sorted(range(1, count + 1),
+                         key=lambda shard: _weight(unit, shard),
+                         reverse=True)
+        for shard in ranking:
+            if loads[shard] + costs[unit] <= bound:
+                break
+        else:
+            shard = min(ranking, key=lambda s: loads[s])
+        ret[unit] = shard
+        loads[shard] += costs[unit]
+    return ret
+
+
+def estimate_costs(recorded, estimates):
+    '''Fill in the costs of jobs without recorded build times.
+
+    recorded maps jobs to build times in seconds, or None if unknown.
+    estimates maps the same jobs to a heuristic cost. Estimates are
+    scaled by the median ratio of recorded time to estimate, over jobs
+    which have both, so they're comparable to recorded times.'''
+    ratios = [recorded[job] / estimates[job] for job in recorded
+              if recorded[job] is not None and estimates[job] > 0]
+    scale = statistics.median(ratios) if ratios else 1.0
+    return {job: recorded[job] if recorded[job] is not None
+            else estimates[job] * scale
+            for job in recorded}
+
+
+class BuildTimes:
+    '''Build time history file.
+
+    This is a JSON object mapping job names to smoothed build times,
+    in seconds. Several processes may update it at once.'''
+
+    def __init__(self, path):
+        self.path = path
+
+    def _read(self):
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return data if isinstance(data, dict) else {}
+
+    def load(self):
+        '''Get the recorded build times.'''
+        return self._read()
+
+    @contextlib.contextmanager
+    def _locked(self):
+        fd = os.open(self.path + '.lock', os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def record(self, times):
+        '''Add build times, a dict from job names to seconds.'''
+        if not times:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)),
+                    exist_ok=True)
+        with self._locked():
+            data = self._read()
+            for job, seconds in times.items():
+                old = data.get(job)
+                if isinstance(old, (int, float)):
+                    seconds = old + HISTORY_WEIGHT * (seconds - old)
+                data[job] = round(seconds, 2)
+            tmp = '{}.{}'.format(self.path, os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump(data, f, indent=1, sort_keys=True)
+                f.write('\n')
+            os.replace(tmp, self.path)
@@ -0,0 +1,131 @@
+# Copyright (c) 2018 Foundries.io Limited.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+'''Static stack usage, from GCC's -fstack-usage output.
+
+With -fstack-usage, GCC writes a .su file next to each object file,
+with a line for each function it compiled:
+
+    ../kernel/sched.c:412:6:z_swap_next_thread	24	static
+
+That is the function's location and name, the size of its stack frame
+in bytes, and whether the size is 'static', 'dynamic' (e.g. it uses
+alloca()), or 'dynamic,bounded'. Only the function's own frame is
+counted, not those of its callees.
+
+A module is the source file an object file was compiled from, as a
+path relative to the build directory with CMake's target directories
+left out, like zephyr/kernel/sched.c.'''
+
+from collections import namedtuple
+import os
+import re
+
+SU_SUFFIX = '.su'
+
+# A function from a .su file.
+#
+# - module: see above
+# - name: function name
+# - location: source file, line and column, as GCC gave them
+# - size: stack frame size, in bytes
+# - qualifiers: 'static', 'dynamic' or 'dynamic,bounded'
+Function = namedtuple('Function', 'module name location size qualifiers')
+
+_LOCATION = re.compile(r'^(.*:\d+:\d+):(.+)$')
+_CMAKE_TARGET_DIR = re.compile(r'CMakeFiles/[^/]+\.dir/')
+
+
+def module_name(su_path):
+    '''Get the module for a .su file path, relative to its build
+    directory.'''
+    rel = su_path.replace(os.path.sep, '/')
+    rel = _CMAKE_TARGET_DIR.sub('', rel)
+    # foo.c.obj.su or foo.c.su -> foo.c
+    rel = rel[:-len(SU_SUFFIX)]
+    for suffix in ('.obj', '.o'):
+        if rel.endswith(suffix):
+            rel = rel[:-len(suffix)]
+    return rel
+
+
+def read_su(path, module):
+    '''Read the functions in a .su file.'''
+    ret = []
+    with open(path, 'r', errors='replace') as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) != 3:
+                continue
+            match = _LOCATION.match(fields[0])
+            try:
+                size = int(fields[1])
+            except ValueError:
+                continue
+            if match is None:
+                location, name = '', fields[0]
+            else:
+                location, name = match.groups()
+            ret.append(Function(module, name, location, size, fields[2]))
+    return ret
+
+
+def collect(build_dir):
+    '''Read every .su file in a build directory.'''
+    ret = []
+    for dirpath, dirnames, filenames in os.walk(build_dir):
+        for name in filenames:
+            if not name.endswith(SU_SUFFIX):
+                continue
+            path = os.path.join(dirpath, name)
+            rel = os.path.relpath(path, build_dir)
+            ret.extend(read_su(path, module_name(rel)))
+    return ret
+
+
+def worst_functions(functions, count=None):
+    '''Get the functions with the largest frames, largest first.'''
+    ret = sorted(functions, key=lambda f: (-f.size, f.module, f.name))
+    return ret if count is None else ret[:count]
+
+
+def worst_modules(functions, count=None):
+    '''Get (module, largest frame, function count) tuples for the
+    modules with the largest frames, largest first.'''
+    largest = {}
+    counts = {}
+    for f in functions:
+        largest[f.module] = max(largest.get(f.module, 0), f.size)
+        counts[f.module] = counts.get(f.module, 0) + 1
+    ret = sorted(((m, size, counts[m]) for m, size in largest.items()),
+                 key=lambda item: (-item[1], item[0]))
+    return ret if count is None else ret[:count]
+
+
+def as_dict(functions):
+    '''Get a {'module:function': size} dict, as saved in baselines.
+
+    If a module has more than one function with the same name (static
+    functions in different headers), the largest is kept.'''
+    ret = {}
+    for f in functions:
+        key = '{}:{}'.format(f.module, f.name)
+        ret[key] = max(ret.get(key, 0), f.size)
+    return ret
+
+
+def diff(old, new):
+    '''Compare two as_dict() results.
+
+    Returns (key, old size, new size) tuples for the functions whose
+    sizes changed, largest change first. A size is None if the
+    function is only in the other dict.'''
+    ret = []
+    for key in set(old) | set(new):
+        before, after = old.get(key), new.get(key)
+        if before != after:
+            ret.append((key, before, after))
+    ret.sort(key=lambda item: (-abs((item[2] or 0) - (item[1] or 0)),
+                               item[0]))
+    return ret